@@ -1,25 +1,333 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from uuid import uuid4
 from datetime import datetime, timezone
+from concurrent import futures
+import json
+import logging
+import math
+import os
+import random
 import time
 import re
-import threading
+import sqlite3
+import zlib
 
 import database_handler
+import metrics
+import rate_limit
+import structured_log
+from device_state import make_state_store
+from waiters import WaitRegistry
 
 # /c:/Coding/briefkasten/api.py
 
 app = Flask(__name__)
 _start_time = time.time()
+
+# Logging über eine Queue: Request-Threads schreiben nie selbst nach stderr
+# (auch das Zugriffslog des Entwicklungsservers); Stufe und Sampling je Route zur Laufzeit über /log_level
+log = logging.getLogger("briefkasten.api")
+structured_log.configure(loggers=("werkzeug",))
 _users = {}
 
 EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
-entriegeln_flag = False
-entriegeln_lock = threading.Lock()
+# Obergrenze für 'limit' bei /letters
+LETTERS_MAX_LIMIT = 1000
+# Maximale Anzahl Briefe pro /new_letters-Anfrage
+NEW_LETTERS_MAX_BATCH = 5000
+# Maximale Anzahl MAC-Adressen pro /letters/summary-Anfrage
+SUMMARY_MAX_DEVICES = 1000
+
+# Zustand der Geräte: 'memory' (ein Prozess) oder 'sqlite' (mehrere Worker, z.B. gunicorn -w 4)
+STATE_BACKEND = os.environ.get("BRIEFKASTEN_STATE_BACKEND", "memory")
+# Bei 'sqlite' kann /entriegeln in einem anderen Prozess ankommen: wartende Anfragen prüfen so oft selbst nach
+STATE_POLL_SECONDS = 0.5
+
+# Long-Poll/SSE: wartende Geräte werden bei /entriegeln sofort geweckt
+unlock_waiters = WaitRegistry(poll_interval=STATE_POLL_SECONDS if STATE_BACKEND == "sqlite" else None)
+LONG_POLL_MAX_WAIT = 60
+SSE_KEEPALIVE_SECONDS = 15
+
+# /device/sync: empfohlener Abstand bis zur nächsten Abfrage, mit Jitter (±Anteil),
+# wächst mit der Zahl gerade bearbeiteter Anfragen (Last) bis SYNC_POLL_MAX_SECONDS
+SYNC_POLL_SECONDS = 30
+SYNC_POLL_MAX_SECONDS = 300
+SYNC_POLL_JITTER = 0.2
+SYNC_BUSY_REFERENCE = 32
+SYNC_MAX_EVENTS = 1000
+# Befehle, die ein Gerät abholen kann
+DEVICE_COMMANDS = ("entriegeln",)
+# Ereignisart -> Klappenstatus
+SYNC_FLAP_EVENTS = {"open": True, "close": False}
+
+# Idempotenz: Briefe mit bereits gesehener 'event_id' desselben Geräts werden verworfen.
+# Wiederholungen innerhalb des Fensters erkennt ein LRU-Set im Speicher, ältere der Unique-Index.
+IDEMPOTENCY_WINDOW_SECONDS = 600
+IDEMPOTENCY_MAX_KEYS = 100000
+EVENT_ID_MAX_LENGTH = 128
+
+# Group-Commit-Queue (BRIEFKASTEN_GROUP_COMMIT=1): ein Commit für bis zu
+# BRIEFKASTEN_GROUP_COMMIT_MAX_BATCH Briefe, die höchstens BRIEFKASTEN_GROUP_COMMIT_DELAY_MS
+# lang gesammelt werden (0 = was während des letzten Commits aufgelaufen ist).
+# /new_letter wartet höchstens GROUP_COMMIT_TIMEOUT_SECONDS auf den Commit, danach 503.
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("BRIEFKASTEN_GROUP_COMMIT_MAX_BATCH", "500"))
+GROUP_COMMIT_DELAY_MS = float(os.environ.get("BRIEFKASTEN_GROUP_COMMIT_DELAY_MS", "0"))
+GROUP_COMMIT_TIMEOUT_SECONDS = 30
+
+# Nicht abgeholte Entriegeln-Befehle verfallen nach dieser Zeit (None = nie)
+ENTRIEGELN_TTL_SECONDS = 300
+SNAPSHOT_INTERVAL_SECONDS = 5
+
+# Zugangskontrolle (nur im Speicher, vor jedem Datenbankzugriff): Token-Bucket je Gerät
+# (serial_number bzw. mac_address der Anfrage, bei Sammel-Uploads jedes enthaltenen Geräts),
+# BRIEFKASTEN_RATE_LIMIT="rate:burst" (Anfragen/s, "0" = aus),
+# und höchstens WRITE_CONCURRENCY gleichzeitige Anfragen auf schreibenden Routen.
+# Abgelehnte Anfragen bekommen sofort 429 mit Retry-After.
+DEVICE_RATE_LIMIT = rate_limit.parse_rate(os.environ.get("BRIEFKASTEN_RATE_LIMIT", "5:20"))
+WRITE_CONCURRENCY = int(os.environ.get("BRIEFKASTEN_WRITE_CONCURRENCY", "16"))
+WRITE_ADMISSION_WAIT_SECONDS = 0.05
+WRITE_ROUTES = frozenset((
+    "/register", "/new_letter", "/new_letters", "/letters/read",
+    "/entriegeln", "/open", "/close", "/device/sync",
+))
+
+device_limiter = rate_limit.TokenBucketLimiter(*DEVICE_RATE_LIMIT) if DEVICE_RATE_LIMIT else None
+write_slots = rate_limit.ConcurrencyLimit(WRITE_CONCURRENCY, WRITE_ADMISSION_WAIT_SECONDS)
+
+# Die neuesten Briefe je Gerät im Speicher (Write-Through), begrenzt auf RECENT_LETTERS_MAX insgesamt
+RECENT_LETTERS_PER_DEVICE = 32
+RECENT_LETTERS_MAX = 200000
+
+# Langlebige SQLite-Verbindungen der App; Schema wird einmalig beim Start angelegt
+db_pool = database_handler.ConnectionPool(
+    serial_cache=database_handler.SerialCache(),
+    recent_letters=database_handler.RecentLetters(RECENT_LETTERS_PER_DEVICE, RECENT_LETTERS_MAX),
+)
+db_pool.init_schema()
+
+letter_dedup = database_handler.IdempotencyCache(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_WINDOW_SECONDS)
+
+# Optional: Briefe über eine Group-Commit-Queue schreiben (BRIEFKASTEN_GROUP_COMMIT=1)
+letter_writer = None
+if os.environ.get("BRIEFKASTEN_GROUP_COMMIT") == "1":
+    letter_writer = database_handler.LetterWriter(
+        db_pool.db_path, max_batch=GROUP_COMMIT_MAX_BATCH, max_delay=GROUP_COMMIT_DELAY_MS / 1000,
+        recent_letters=db_pool.recent_letters,
+    ).start()
+
+# Befehle und Klappenstatus pro Gerät (Seriennummer); im Speicher mit periodischem
+# SQLite-Snapshot oder direkt in der gemeinsamen device_state-Tabelle
+device_state = make_state_store(db_pool, STATE_BACKEND)
+device_state.load(db_pool)
+device_state.start_snapshots(db_pool, SNAPSHOT_INTERVAL_SECONDS)
+
+# Metriken für /metrics (Prometheus-Textformat)
+registry = metrics.Registry()
+REQUESTS = registry.register(metrics.Counter(
+    "briefkasten_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status")))
+IN_FLIGHT = registry.register(metrics.Gauge(
+    "briefkasten_requests_in_flight", "Requests currently being handled."))
+LATENCY = registry.register(metrics.Histogram(
+    "briefkasten_request_duration_seconds", "Request latency by route.", ("route",)))
+DB_TIME = registry.register(metrics.Histogram(
+    "briefkasten_db_method_duration_seconds", "Time spent in DatabaseHandler methods.", ("method",)))
+metrics.instrument_methods(database_handler.DatabaseHandler, DB_TIME)
+registry.register(metrics.CallbackGauge(
+    "briefkasten_db_pool_connections", "SQLite connections of the pool by state.",
+    lambda: [((state,), value) for state, value in db_pool.stats().items()], ("state",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_serial_cache", "MAC to serial cache size, hits and misses.",
+    lambda: [((key,), value) for key, value in db_pool.serial_cache.stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_recent_letters", "In-memory recent letters cache: devices, letters, hits, misses, loads, evictions.",
+    lambda: [((key,), value) for key, value in db_pool.recent_letters.stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_letter_dedup", "Idempotency window size, repeats caught (hits) and new keys (misses).",
+    lambda: [((key,), value) for key, value in letter_dedup.stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_pending_commands", "Unlock commands not yet fetched by a device.",
+    lambda: [((), device_state.pending_commands())]))
+REJECTED = registry.register(metrics.Counter(
+    "briefkasten_requests_rejected_total", "Requests rejected with 429 or 503 by route and reason.", ("route", "reason")))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_rate_limiter", "Per-device token buckets: active buckets, allowed, limited, evictions.",
+    lambda: [((key,), value) for key, value in (device_limiter.stats() if device_limiter else {}).items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_write_slots", "Concurrency cap of DB-writing routes: limit, active, rejected.",
+    lambda: [((key,), value) for key, value in write_slots.stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_db_lock_retries", "Write transactions retried because the database was locked, and given up.",
+    lambda: [((key,), value) for key, value in database_handler.lock_stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_log_records", "Log records waiting for the writer thread and dropped on a full queue.",
+    lambda: [((key,), value) for key, value in structured_log.stats().items()], ("stat",)))
+registry.register(metrics.CallbackGauge(
+    "briefkasten_waiting_requests", "Long-poll and SSE requests waiting for a command.",
+    lambda: [((), unlock_waiters.waiting())]))
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+def _device_keys(data):
+    """Gerätekennungen einer Anfrage für den Rate-Limiter (ohne Datenbank): serial_number oder mac_address.
+
+    Eine Liste (/new_letters) liefert die Kennung jedes Eintrags, so belastet ein Sammel-Upload
+    eines Gateways die Buckets aller enthaltenen Geräte.
+    """
+    keys = {}
+    for item in data if isinstance(data, list) else [data]:
+        if item is None or not hasattr(item, "get"):
+            continue
+        for field in ("serial_number", "mac_address"):
+            value = item.get(field)
+            if isinstance(value, str) and value:
+                keys[f"{field}:{value}"] = None
+                break
+    return list(keys)
+
+
+def _admit(route, data):
+    """
+    Zulassung einer Anfrage vor der Route: Rate-Limit jedes Geräts der Anfrage und ein
+    Schreib-Slot für WRITE_ROUTES (freigeben mit write_slots.release()).
+    Gibt (reason, retry_after) zurück, wenn die Anfrage abgelehnt wird, sonst None.
+    """
+    if device_limiter is not None:
+        retry_after = max((device_limiter.acquire(key) for key in _device_keys(data)), default=0.0)
+        if retry_after:
+            return "device", retry_after
+    if route in WRITE_ROUTES and not write_slots.try_acquire():
+        return "write_concurrency", 1.0
+    return None
+
+
+def _rejection(route, reason, retry_after):
+    """Zählt die Ablehnung; gibt den JSON-Body und den Retry-After-Header (ganze Sekunden) der 429 zurück."""
+    REJECTED.inc(route, reason)
+    body = {"error": "too many requests", "reason": reason, "retry_after": round(retry_after, 3)}
+    return body, str(max(1, math.ceil(retry_after)))
+
+
+def _too_many_requests(route, reason, retry_after):
+    body, retry_after_header = _rejection(route, reason, retry_after)
+    response = jsonify(body)
+    response.status_code = 429
+    response.headers["Retry-After"] = retry_after_header
+    return response
+
+
+@app.before_request
+def _admission():
+    """Weist Anfragen über dem Gerätelimit bzw. ohne freien Schreib-Slot mit 429 ab, bevor die Route läuft."""
+    route = request.url_rule.rule if request.url_rule is not None else None
+    if route is None:
+        return None
+    data = request.get_json(silent=True) if request.is_json else request.args
+    rejected = _admit(route, data)
+    if rejected is not None:
+        return _too_many_requests(route, *rejected)
+    g.write_slot = route in WRITE_ROUTES
+    return None
+
+
+@app.errorhandler(sqlite3.OperationalError)
+def _database_error(exc):
+    """Datenbank trotz Busy-Timeout und Wiederholungen gesperrt: 503 mit Retry-After statt 500."""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if not database_handler.is_busy(exc):
+        log.error("database error", extra={"route": route}, exc_info=exc)
+        return jsonify({"error": "internal server error"}), 500
+    log.warning("database locked", extra={"route": route})
+    REJECTED.inc(route, "database_locked")
+    response = jsonify({"error": "database busy, retry later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def _release_write_slot():
+    """Gibt den Schreib-Slot der Anfrage frei (vor Long-Poll-Wartezeiten und am Ende der Anfrage)."""
+    if g.pop("write_slot", False):
+        write_slots.release()
+
+
+def _record_request(route, method, status, elapsed):
+    """Latenz und Statuscode einer Anfrage in die Metriken (auch für die nativen ASGI-Routen)."""
+    LATENCY.observe(elapsed, route)
+    REQUESTS.inc(route, method, str(status))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("request", extra={"route": route, "method": method, "status": status,
+                                    "ms": round(elapsed * 1000, 3)})
+
+
+@app.after_request
+def _metrics_record(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    _record_request(route, request.method, response.status_code, time.perf_counter() - g.metrics_start)
+    return response
+
+
+@app.teardown_request
+def _metrics_done(exc):
+    _release_write_slot()
+    IN_FLIGHT.dec()
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Gibt alle Metriken im Prometheus-Textformat aus."""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/log_level", methods=["GET", "POST"])
+def log_level():
+    """Zeigt oder ändert Log-Stufen und Sampling zur Laufzeit.
+
+    POST-Felder (alle optional):
+    - 'level': neue Stufe (z.B. "DEBUG"), 'logger': Name (Standard "briefkasten")
+    - 'sample': {route: Anteil 0..1} behalten unterhalb WARNING, null entfernt das Sampling der Route
+    """
+    if request.method == "POST":
+        if not request.is_json:
+            return jsonify({"error": "expected JSON"}), 400
+        data = request.get_json()
+        name = data.get("logger", structured_log.ROOT)
+        if not isinstance(name, str) or not (name == structured_log.ROOT or name.startswith(structured_log.ROOT + ".")
+                                             or name == "werkzeug"):
+            return jsonify({"error": "field 'logger' must name a briefkasten logger or 'werkzeug'"}), 400
+        sample = data.get("sample", {})
+        if not isinstance(sample, dict) or not all(
+                rate is None or (isinstance(rate, (int, float)) and not isinstance(rate, bool) and 0 <= rate <= 1)
+                for rate in sample.values()):
+            return jsonify({"error": "field 'sample' must map routes to a rate between 0 and 1 (or null)"}), 400
+        if "level" in data:
+            try:
+                structured_log.set_level(data["level"], name)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        for route, rate in sample.items():
+            if rate is None:
+                structured_log.sampler.rates.pop(route, None)
+            else:
+                structured_log.sampler.rates[route] = float(rate)
+        log.warning("log level changed", extra={"levels": structured_log.levels()})
+    return jsonify({
+        "levels": structured_log.levels(),
+        "sample": structured_log.sampler.rates,
+        **structured_log.stats(),
+    }), 200
+
+
+def _serial_for_mac(mac_address):
+    """Löst eine MAC-Adresse in die Seriennummer des Geräts auf (None, falls unbekannt)."""
+    with db_pool.handler() as db:
+        return db.getSerialNumberByMAC(mac_address)
 
-offen_flag = False
-offen_lock = threading.Lock()
 
 def now_iso():
     """Gibt die aktuelle UTC-Zeit im ISO-Format zurück."""
@@ -42,25 +350,205 @@ def status():
     })
 
 
+def _optional_int(data, field, minimum, maximum=None):
+    """Liest ein optionales Integer-Feld; gibt (wert, fehler) zurück."""
+    value = data.get(field)
+    if value is None:
+        return None, None
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum or (maximum is not None and value > maximum):
+        bounds = f">= {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+        return None, f"field '{field}' must be an integer {bounds}"
+    return value, None
+
+
+def _optional_time(data, field):
+    """Liest ein optionales Zeitfeld (Epoch-ms oder ISO 8601) als Epoch-ms; gibt (wert, fehler) zurück."""
+    value = data.get(field)
+    if value is None:
+        return None, None
+    try:
+        return database_handler.to_epoch_ms(value), None
+    except ValueError:
+        return None, f"field '{field}' must be epoch milliseconds or an ISO 8601 timestamp"
+
+
+def _event_id(data):
+    """Liest den optionalen Idempotenz-Schlüssel 'event_id' (String oder Zahl, z.B. ein tick); gibt (wert, fehler) zurück."""
+    value = data.get("event_id")
+    if value is None:
+        return None, None
+    if isinstance(value, bool) or not isinstance(value, (str, int)) or value == "" \
+            or len(str(value)) > EVENT_ID_MAX_LENGTH:
+        return None, f"field 'event_id' must be a non-empty string or integer (max. {EVENT_ID_MAX_LENGTH} characters)"
+    return str(value), None
+
+
+def _not_modified(etag):
+    """True, wenn der Client die Antwort mit diesem ETag schon hat (If-None-Match)."""
+    return request.if_none_match.contains_weak(etag)
+
+
+def _with_etag(response, etag):
+    """Setzt den ETag auf eine (response, status)-Antwort oder ein Response-Objekt."""
+    if isinstance(response, tuple):
+        response = app.make_response(response)
+    response.set_etag(etag)
+    return response
+
+
+def _stream_letters(serial_number, since_id, from_ms=None, to_ms=None):
+    """Generator für NDJSON: eine Zeile pro Brief, Verbindung bleibt bis zum Ende ausgeliehen."""
+    with db_pool.handler() as db:
+        for letter in db.iterLetters(serial_number, since_id, from_ms=from_ms, to_ms=to_ms):
+            yield json.dumps(letter) + "\n"
+
+
 @app.route("/letters", methods=["POST"])
 def letters():
-    """Erwartet JSON mit 'mac_address' und gibt die Briefliste für das zugehörige Gerät zurück."""
+    """Erwartet JSON mit 'mac_address' und gibt die Briefliste für das zugehörige Gerät zurück.
+
+    Optionale Felder:
+    - 'since_id': nur Briefe mit größerer id (Cursor)
+    - 'from' / 'to': nur Briefe mit from <= Zeit < to (Epoch-ms oder ISO 8601)
+    - 'limit': maximale Anzahl Briefe (höchstens LETTERS_MAX_LIMIT, größere Werte werden
+      begrenzt), Antwort enthält dann 'next_since_id'
+    - 'order': 'asc' (Standard, älteste zuerst) oder 'desc' (neueste zuerst, ohne 'next_since_id');
+      die neuesten Briefe kommen meist aus dem Speicher (RecentLetters)
+    - 'count_only': nur die Anzahl zurückgeben
+    - 'stream': alle passenden Briefe aufsteigend als NDJSON streamen; nicht mit 'limit'
+      oder 'order': 'desc' kombinierbar (400)
+    """
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
-    print(data)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("letters request", extra={"route": "/letters", "body": data})
     mac_address = data.get("mac_address")
     if not isinstance(mac_address, str) or not mac_address:
         return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
 
-    db = database_handler.DatabaseHandler()
+    since_id, error = _optional_int(data, "since_id", 0)
+    if error:
+        return jsonify({"error": error}), 400
+    limit, error = _optional_int(data, "limit", 1)
+    if error:
+        return jsonify({"error": error}), 400
+    if limit is not None:
+        limit = min(limit, LETTERS_MAX_LIMIT)
+    since_id = since_id or 0
+    from_ms, error = _optional_time(data, "from")
+    if error:
+        return jsonify({"error": error}), 400
+    to_ms, error = _optional_time(data, "to")
+    if error:
+        return jsonify({"error": error}), 400
+    order = data.get("order", "asc")
+    if order not in ("asc", "desc"):
+        return jsonify({"error": "field 'order' must be 'asc' or 'desc'"}), 400
+    if data.get("stream") and (limit is not None or order == "desc"):
+        return jsonify({"error": "field 'stream' cannot be combined with 'limit' or order 'desc'"}), 400
+
+    with db_pool.handler() as db:
+        # get the Serial Number by MAC address (cached)
+        serial_number = db.getSerialNumberByMAC(mac_address)
+
+        # ETag aus Zählerstand des Geräts (ein Index-Lookup) und den Anfrageparametern
+        last_id, count = db.getLetterVersion(serial_number)
+        params = (since_id, limit, from_ms, to_ms, order, bool(data.get("count_only")), bool(data.get("stream")))
+        etag = f"{last_id}-{count}-{zlib.crc32(repr(params).encode()):08x}"
+        if _not_modified(etag):
+            return _with_etag(Response(status=304), etag)
+
+        if data.get("count_only"):
+            return _with_etag((jsonify({"count": db.countLetters(serial_number, since_id, from_ms, to_ms)}), 200), etag)
+
+        if not data.get("stream"):
+            letters = db.getLetters(serial_number, since_id, limit, from_ms, to_ms, version=(last_id, count),
+                                    newest_first=order == "desc")
+            if limit is None or order == "desc":
+                return _with_etag((jsonify({"letters": letters}), 200), etag)
+            next_since_id = letters[-1]["id"] if len(letters) == limit else None
+            return _with_etag((jsonify({"letters": letters, "next_since_id": next_since_id}), 200), etag)
+
+    response = Response(stream_with_context(_stream_letters(serial_number, since_id, from_ms, to_ms)),
+                        mimetype="application/x-ndjson")
+    return _with_etag(response, etag)
+
+
+@app.route("/letters/summary", methods=["POST"])
+def letters_summary():
+    """Zusammenfassung (Anzahl, Zeit des letzten Briefs, ungelesen) aus den Zählern, ohne die Briefe zu lesen.
+
+    Erwartet JSON mit 'mac_address' (ein Gerät) oder 'mac_addresses' (Liste,
+    eine Abfrage für alle Geräte; unbekannte MACs liefern null).
+    """
+    if not request.is_json:
+        return jsonify({"error": "expected JSON"}), 400
+    data = request.get_json()
+    if "mac_addresses" in data:
+        macs = data.get("mac_addresses")
+        if not isinstance(macs, list) or not all(isinstance(m, str) and m for m in macs):
+            return jsonify({"error": "field 'mac_addresses' must be a list of non-empty strings"}), 400
+        if len(macs) > SUMMARY_MAX_DEVICES:
+            return jsonify({"error": f"at most {SUMMARY_MAX_DEVICES} mac addresses per request"}), 413
+        with db_pool.handler() as db:
+            return jsonify({"summaries": db.getLetterSummaries(macs)}), 200
 
-    # get the Serial Number by MAC address
-    serial_number = db.getSerialNumberByMAC(mac_address)
+    mac_address = data.get("mac_address")
+    if not isinstance(mac_address, str) or not mac_address:
+        return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
+    with db_pool.handler() as db:
+        summary = db.getLetterSummaries([mac_address])[mac_address]
+    if summary is None:
+        return jsonify({"error": "unknown mac_address"}), 404
+    return jsonify(summary), 200
 
-    letters = db.getLetters(serial_number)
 
-    return jsonify({"letters": letters}), 200
+@app.route("/letters/daily", methods=["POST"])
+def letters_daily():
+    """Tageswerte (Tag, Anzahl, erste/letzte Zeit) der bereits kompaktierten, älteren Briefe eines Geräts.
+
+    Erwartet 'mac_address', optional 'from' / 'to' wie bei /letters.
+    """
+    if not request.is_json:
+        return jsonify({"error": "expected JSON"}), 400
+    data = request.get_json()
+    mac_address = data.get("mac_address")
+    if not isinstance(mac_address, str) or not mac_address:
+        return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
+    from_ms, error = _optional_time(data, "from")
+    if error:
+        return jsonify({"error": error}), 400
+    to_ms, error = _optional_time(data, "to")
+    if error:
+        return jsonify({"error": error}), 400
+
+    with db_pool.handler() as db:
+        serial_number = db.getSerialNumberByMAC(mac_address)
+        if serial_number is None:
+            return jsonify({"error": "unknown mac_address"}), 404
+        return jsonify({"days": db.getDailyLetters(serial_number, from_ms, to_ms)}), 200
+
+
+@app.route("/letters/read", methods=["POST"])
+def letters_read():
+    """Markiert die Briefe eines Geräts als gelesen (bis 'up_to_id' oder bis zum neuesten)."""
+    if not request.is_json:
+        return jsonify({"error": "expected JSON"}), 400
+    data = request.get_json()
+    mac_address = data.get("mac_address")
+    if not isinstance(mac_address, str) or not mac_address:
+        return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
+    up_to_id, error = _optional_int(data, "up_to_id", 0)
+    if error:
+        return jsonify({"error": error}), 400
+
+    with db_pool.handler() as db:
+        serial_number = db.getSerialNumberByMAC(mac_address)
+        if serial_number is None:
+            return jsonify({"error": "unknown mac_address"}), 404
+        unread = db.markLettersRead(serial_number, up_to_id)
+    return jsonify({"status": "ok", "unread": unread}), 200
 
 
 @app.route("/register", methods=["POST"])
@@ -78,37 +566,141 @@ def register():
     if not isinstance(serial_number, str) or not serial_number:
         return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
 
-    db = database_handler.DatabaseHandler()
-    #db.create_user_table()
-    db.addUser(mac_address, serial_number)
-
-    db.create_letter_table(serial_number)
+    with db_pool.handler() as db:
+        db.addUser(mac_address, serial_number)
 
     return jsonify("test"), 201
 
 @app.route("/new_letter", methods=["POST"])
 def new_letter():
-    """Fügt einen neuen Brief-Eintrag zur Datenbank hinzu (erwartet 'serial_number' und 'time')."""
+    """Fügt einen neuen Brief-Eintrag zur Datenbank hinzu (erwartet 'serial_number' und 'time').
+
+    'time' ist Epoch-ms oder ein ISO-8601-Zeitstempel (ohne Angabe: jetzt) und
+    wird als Epoch-ms gespeichert. Mit 'event_id' (z.B. tick der Flanke oder eine
+    Ereignis-id des Geräts) werden Wiederholungen erkannt und mit 200 beantwortet.
+
+    Mit aktivierter Group-Commit-Queue wartet die Anfrage auf den Commit;
+    mit 'durable': false wird nur eingereiht und sofort 202 zurückgegeben.
+    """
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
     serial_number = data.get("serial_number")
-    time = data.get("time")
 
     if not isinstance(serial_number, str) or not serial_number:
         return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
+    try:
+        ts = database_handler.to_epoch_ms(data.get("time"))
+    except ValueError:
+        return jsonify({"error": "field 'time' must be epoch milliseconds or an ISO 8601 timestamp"}), 400
+    event_id, error = _event_id(data)
+    if error:
+        return jsonify({"error": error}), 400
+    if event_id is not None and letter_dedup.seen(serial_number, event_id):
+        return jsonify({"status": "duplicate letter ignored"}), 200
+
+    try:
+        if letter_writer is not None:
+            future = letter_writer.submit(serial_number, ts, event_id)
+            if data.get("durable", True) is False:
+                if event_id is not None:
+                    # Schlägt der Commit fehl, darf die Wiederholung des Geräts nicht als Duplikat gelten
+                    future.add_done_callback(
+                        lambda f: f.exception() is not None and letter_dedup.forget(serial_number, event_id))
+                return jsonify({"status": "letter queued"}), 202
+            added = future.result(timeout=GROUP_COMMIT_TIMEOUT_SECONDS)
+        else:
+            with db_pool.handler() as db:
+                added = db.addLetter(serial_number, ts, event_id)
+    except futures.TimeoutError:
+        # Der Brief kann noch committet werden; eine Wiederholung mit event_id erkennt dann der Unique-Index
+        if event_id is not None:
+            letter_dedup.forget(serial_number, event_id)
+        log.warning("letter commit timed out", extra={"route": "/new_letter", "serial": serial_number})
+        REJECTED.inc("/new_letter", "commit_timeout")
+        response = jsonify({"error": "letter not committed in time, retry later"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
+    except Exception:
+        if event_id is not None:
+            letter_dedup.forget(serial_number, event_id)
+        raise
+
+    if not added:
+        return jsonify({"status": "duplicate letter ignored"}), 200
+    return jsonify({"status": "letter added"}), 201
 
-    db = database_handler.DatabaseHandler()
 
-    db.addLetter(serial_number, time)
+@app.route("/new_letters", methods=["POST"])
+def new_letters():
+    """Fügt mehrere Brief-Einträge (auch verschiedener Geräte) in einer Transaktion hinzu.
 
-    return jsonify({"status": "letter added"}), 201
+    Erwartet eine JSON-Liste von Objekten mit 'serial_number', 'time' und optional
+    'event_id' (oder ein Objekt mit dieser Liste unter 'letters') und liefert ein
+    Ergebnis pro Eintrag; bereits bekannte event_ids werden als 'duplicate' übersprungen.
+    """
+    if not request.is_json:
+        return jsonify({"error": "expected JSON"}), 400
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get("letters")
+    if not isinstance(data, list) or not data:
+        return jsonify({"error": "expected a non-empty list of letters"}), 400
+    if len(data) > NEW_LETTERS_MAX_BATCH:
+        return jsonify({"error": f"at most {NEW_LETTERS_MAX_BATCH} letters per request"}), 413
+
+    rows = []
+    results = []
+    duplicates = 0
+    for index, item in enumerate(data):
+        serial_number = item.get("serial_number") if isinstance(item, dict) else None
+        if not isinstance(serial_number, str) or not serial_number:
+            results.append({"index": index, "error": "field 'serial_number' is required and must be a non-empty string"})
+            continue
+        try:
+            ts = database_handler.to_epoch_ms(item.get("time"))
+        except ValueError:
+            results.append({"index": index, "error": "field 'time' must be epoch milliseconds or an ISO 8601 timestamp"})
+            continue
+        event_id, error = _event_id(item)
+        if error:
+            results.append({"index": index, "error": error})
+            continue
+        if event_id is not None and letter_dedup.seen(serial_number, event_id):
+            results.append({"index": index, "status": "duplicate"})
+            duplicates += 1
+            continue
+        rows.append((serial_number, ts, event_id))
+        results.append({"index": index, "status": "letter added"})
+
+    rejected = len(results) - len(rows) - duplicates
+    if not rows:
+        status = 400 if rejected else 200
+        return jsonify({"added": 0, "duplicates": duplicates, "rejected": rejected, "results": results}), status
+
+    try:
+        with db_pool.handler() as db:
+            added = db.addLetters(rows)
+    except Exception:
+        for serial_number, _, event_id in rows:
+            if event_id is not None:
+                letter_dedup.forget(serial_number, event_id)
+        raise
+
+    # Vom Unique-Index verworfene Wiederholungen (außerhalb des Fensters oder von einem anderen Worker)
+    row_results = [r for r in results if r.get("status") == "letter added"]
+    for result, ok in zip(row_results, added):
+        if not ok:
+            result["status"] = "duplicate"
+            duplicates += 1
+    return jsonify({"added": sum(added), "duplicates": duplicates, "rejected": rejected, "results": results}), 201
 
 
 # MAC nicht Serial Number !!!!
 @app.route("/entriegeln", methods=["POST"])
 def entriegeln():
-    """Setzt das globale Flag 'entriegeln_flag' auf True für späteres Abfragen."""
+    """Legt einen Entriegeln-Befehl für das Gerät mit der angegebenen MAC-Adresse ab."""
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
@@ -116,84 +708,227 @@ def entriegeln():
     if not isinstance(mac_address, str) or not mac_address:
         return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
     
-    global entriegeln_flag
-    with entriegeln_lock:
-        entriegeln_flag = True
+    serial_number = _serial_for_mac(mac_address)
+    if serial_number is None:
+        return jsonify({"error": "unknown mac_address"}), 404
+
+    device_state.set_command(serial_number, "entriegeln", ENTRIEGELN_TTL_SECONDS)
+    unlock_waiters.notify(serial_number)
     return jsonify({"status": "entriegeln set to true"}), 200
 
 
+def _parse_wait(data):
+    """Liest das optionale Long-Poll-Feld 'wait'; gibt (sekunden, fehler) zurück."""
+    wait = data.get("wait", 0)
+    if isinstance(wait, bool) or not isinstance(wait, (int, float)) or not 0 <= wait <= LONG_POLL_MAX_WAIT:
+        return None, f"field 'wait' must be a number between 0 and {LONG_POLL_MAX_WAIT}"
+    return wait, None
+
+
+def _consume_entriegeln(serial_number):
+    """Gibt eine Funktion zurück, die den Entriegeln-Befehl des Geräts atomar abholt."""
+    return lambda: device_state.consume_command(serial_number, "entriegeln")
+
+
 @app.route("/frage_entriegeln", methods=["POST"])
 def frage_entriegeln():
-    """Gibt den aktuellen Wert von 'entriegeln_flag' zurück und setzt ihn atomar wieder auf False, falls True."""
+    """Gibt zurück, ob für das Gerät ein Entriegeln-Befehl vorliegt, und holt ihn dabei atomar ab.
+
+    Mit 'wait' (Sekunden, max. LONG_POLL_MAX_WAIT) blockiert die Anfrage als Long-Poll,
+    bis entriegelt wird oder die Zeit abläuft.
+    """
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
     serial_number = data.get("serial_number")
     if not isinstance(serial_number, str) or not serial_number:
         return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
-    
-    global entriegeln_flag
-    with entriegeln_lock:
-        entriegeln = entriegeln_flag
-        if entriegeln_flag:
-            entriegeln_flag = False
-            return jsonify({"entriegeln": True}), 200
-        else:
-            return jsonify({"entriegeln": False}), 200
+
+    wait, error = _parse_wait(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if wait:
+        entriegeln = unlock_waiters.wait(serial_number, _consume_entriegeln(serial_number), wait)
+    else:
+        entriegeln = device_state.consume_command(serial_number, "entriegeln")
+    return jsonify({"entriegeln": entriegeln}), 200
+
+
+@app.route("/entriegeln/stream", methods=["GET"])
+def entriegeln_stream():
+    """Server-Sent-Events: sendet ein 'entriegeln'-Event, sobald entriegelt wird.
+
+    Erwartet 'serial_number' als Query-Parameter. Zwischendurch werden Keepalive-Kommentare gesendet.
+    """
+    serial_number = request.args.get("serial_number")
+    if not serial_number:
+        return jsonify({"error": "query parameter 'serial_number' is required"}), 400
+
+    def events():
+        yield "retry: 5000\n\n"
+        while True:
+            if unlock_waiters.wait(serial_number, _consume_entriegeln(serial_number), SSE_KEEPALIVE_SECONDS):
+                yield 'event: entriegeln\ndata: {"entriegeln": true}\n\n'
+            else:
+                yield ": keepalive\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(events(), mimetype="text/event-stream", headers=headers)
 
 
 @app.route("/open", methods=["POST"])
 def open_klappe():
-    """Markiert die Klappe als geöffnet (setzt 'offen_flag' True) und loggt die Aktion."""
+    """Markiert die Klappe des Geräts als geöffnet und loggt die Aktion (optional mit dem Zeitpunkt 'time' vom Gerät)."""
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
     serial_number = data.get("serial_number")
     if not isinstance(serial_number, str) or not serial_number:
         return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
-    
-    # Here you would add the code to open the klappe (flap)
-    print(f"Klappe für Serial Number {serial_number} geöffnet.")
-    
-    global offen_flag
-    with offen_lock:
-        offen_flag = True
+    ts, error = _optional_time(data, "time")
+    if error:
+        return jsonify({"error": error}), 400
+
+    log.info("Klappe geöffnet", extra={"route": "/open", "serial": serial_number, "time": ts})
+    device_state.set_state(serial_number, "offen", True)
 
     return jsonify({"status": "klappe opened"}), 200
 
 @app.route("/close", methods=["POST"])
 def close_klappe():
-    """Markiert die Klappe als geschlossen (setzt 'offen_flag' False) und loggt die Aktion."""
+    """Markiert die Klappe des Geräts als geschlossen und loggt die Aktion (optional mit dem Zeitpunkt 'time' vom Gerät)."""
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
     serial_number = data.get("serial_number")
     if not isinstance(serial_number, str) or not serial_number:
         return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
-    
-    # Here you would add the code to close the klappe (flap)
-    print(f"Klappe für Serial Number {serial_number} geschlossen.")
-    
-    global offen_flag
-    with offen_lock:
-        offen_flag = False
+    ts, error = _optional_time(data, "time")
+    if error:
+        return jsonify({"error": error}), 400
+
+    log.info("Klappe geschlossen", extra={"route": "/close", "serial": serial_number, "time": ts})
+    device_state.set_state(serial_number, "offen", False)
 
     return jsonify({"status": "klappe closed"}), 200
 
 @app.route("/frage_offen", methods=["POST"])
 def frage_offen():
-    """Gibt zurück, ob die Klappe aktuell als offen markiert ist (offen_flag)."""
+    """Gibt zurück, ob die Klappe des Geräts mit der angegebenen MAC-Adresse als offen markiert ist."""
     if not request.is_json:
         return jsonify({"error": "expected JSON"}), 400
     data = request.get_json()
-    serial_number = data.get("mac_address")
-    if not isinstance(serial_number, str) or not serial_number:
+    mac_address = data.get("mac_address")
+    if not isinstance(mac_address, str) or not mac_address:
         return jsonify({"error": "field 'mac_address' is required and must be a non-empty string"}), 400
-    
-    global offen_flag
-    with offen_lock:
-        offen = offen_flag
-        return jsonify({"offen": offen}), 200
+
+    serial_number = _serial_for_mac(mac_address)
+    if serial_number is None:
+        return jsonify({"error": "unknown mac_address"}), 404
+
+    offen = device_state.get_state(serial_number, "offen", False)
+    etag = f"offen-{int(bool(offen))}"
+    if _not_modified(etag):
+        return _with_etag(Response(status=304), etag)
+    return _with_etag((jsonify({"offen": offen}), 200), etag)
+
+
+def _next_poll_after():
+    """Empfohlene Sekunden bis zur nächsten Synchronisation: Basis mal Last, mit Jitter gegen Herdeneffekte."""
+    # Wartende Long-Polls belasten den Server nicht, sie zählen nicht als Last
+    busy = max(0, IN_FLIGHT.value() - unlock_waiters.waiting() - 1)
+    base = min(SYNC_POLL_MAX_SECONDS, SYNC_POLL_SECONDS * (1 + busy / SYNC_BUSY_REFERENCE))
+    return round(base * random.uniform(1 - SYNC_POLL_JITTER, 1 + SYNC_POLL_JITTER), 2)
+
+
+def _consume_commands(serial_number):
+    """Holt alle anstehenden Befehle des Geräts atomar ab und gibt ihre Namen zurück."""
+    return [c for c in DEVICE_COMMANDS if device_state.consume_command(serial_number, c)]
+
+
+@app.route("/device/sync", methods=["POST"])
+def device_sync():
+    """Synchronisiert ein Gerät in einer Anfrage.
+
+    Erwartet 'serial_number' und optional 'events': Liste von Objekten mit
+    'kind' ('letter', 'open' oder 'close'), 'time' (Epoch-ms oder ISO 8601) und
+    optional 'event_id' (wie bei /new_letter), in der Reihenfolge ihres Auftretens. Optional 'wait' (Sekunden): Long-Poll,
+    falls gerade kein Befehl ansteht.
+
+    Antwort: Ergebnis pro Ereignis, alle abgeholten Befehle, der aktuelle
+    Klappenstatus und 'next_poll_after' (Sekunden bis zur nächsten Synchronisation).
+    """
+    if not request.is_json:
+        return jsonify({"error": "expected JSON"}), 400
+    data = request.get_json()
+    serial_number = data.get("serial_number")
+    if not isinstance(serial_number, str) or not serial_number:
+        return jsonify({"error": "field 'serial_number' is required and must be a non-empty string"}), 400
+    events = data.get("events", [])
+    if not isinstance(events, list):
+        return jsonify({"error": "field 'events' must be a list"}), 400
+    if len(events) > SYNC_MAX_EVENTS:
+        return jsonify({"error": f"at most {SYNC_MAX_EVENTS} events per request"}), 413
+    wait, error = _parse_wait(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    letters = []
+    offen = None
+    results = []
+    for index, event in enumerate(events):
+        kind = event.get("kind") if isinstance(event, dict) else None
+        if kind != "letter" and kind not in SYNC_FLAP_EVENTS:
+            results.append({"index": index, "error": "field 'kind' must be 'letter', 'open' or 'close'"})
+            continue
+        try:
+            ts = database_handler.to_epoch_ms(event.get("time"))
+        except ValueError:
+            results.append({"index": index, "error": "field 'time' must be epoch milliseconds or an ISO 8601 timestamp"})
+            continue
+        if kind == "letter":
+            event_id, error = _event_id(event)
+            if error:
+                results.append({"index": index, "error": error})
+                continue
+            if event_id is not None and letter_dedup.seen(serial_number, event_id):
+                results.append({"index": index, "status": "duplicate"})
+                continue
+            letters.append((serial_number, ts, event_id))
+        else:
+            offen = SYNC_FLAP_EVENTS[kind]
+        results.append({"index": index, "status": "ok"})
+
+    if letters:
+        try:
+            with db_pool.handler() as db:
+                added = db.addLetters(letters)
+        except Exception:
+            for _, _, event_id in letters:
+                if event_id is not None:
+                    letter_dedup.forget(serial_number, event_id)
+            raise
+        letter_results = [r for r, e in zip(results, events) if r.get("status") == "ok" and e.get("kind") == "letter"]
+        for result, ok in zip(letter_results, added):
+            if not ok:
+                result["status"] = "duplicate"
+    if offen is not None:
+        # Nur das letzte Klappen-Ereignis bestimmt den Status
+        device_state.set_state(serial_number, "offen", offen)
+
+    commands = _consume_commands(serial_number)
+    if not commands and wait:
+        # Beim Warten wird nichts geschrieben: Slot nicht über die ganze Long-Poll-Dauer belegen
+        _release_write_slot()
+        commands = unlock_waiters.wait(serial_number, lambda: _consume_commands(serial_number), wait)
+
+    return jsonify({
+        "results": results,
+        "commands": commands,
+        "offen": device_state.get_state(serial_number, "offen", False),
+        "next_poll_after": _next_poll_after(),
+    }), 200
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
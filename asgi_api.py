@@ -0,0 +1,261 @@
+"""
+ASGI variant of the Briefkasten API.
+
+Exposes the same routes as api.py. Idle device connections (long-poll
+/frage_entriegeln with 'wait' and the SSE stream /entriegeln/stream) are
+served natively on the event loop and hold no thread while they wait;
+they go through the same admission control (rate limit, 429 with
+Retry-After) and request metrics as the Flask routes. All other requests run the Flask app from api.py in a bounded thread
+pool, so validation, responses and the database work stay identical to
+the WSGI server and never block the event loop.
+
+Run with any ASGI server, e.g.:
+    uvicorn asgi_api:app --host 0.0.0.0 --port 5000
+
+BRIEFKASTEN_ASGI_WORKERS sets the size of the thread pool (default 16).
+"""
+from __future__ import annotations
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import api
+
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BRIEFKASTEN_ASGI_WORKERS", "16")),
+    thread_name_prefix="asgi-wsgi",
+)
+
+# Mit dem SQLite-Zustand schreibt das Abholen eines Befehls in die Datenbank (bis zum
+# Busy-Timeout blockierend): dann im Thread-Pool statt auf dem Event-Loop prüfen
+consume_executor = executor if api.STATE_BACKEND != "memory" else None
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return body
+
+
+async def _send_json(send, payload: Any, status: int = 200,
+                     headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        environ[key] = value.decode("latin-1")
+    return environ
+
+
+def _run_wsgi(environ: Dict[str, Any], loop: asyncio.AbstractEventLoop, events: "asyncio.Queue[tuple]") -> None:
+    """
+    Run the Flask app in a worker thread; status, headers and body chunks
+    are handed back to the event loop through the queue.
+    """
+    def emit(*event) -> None:
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+        emit("start", status, headers)
+
+    try:
+        result = api.app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    emit("body", chunk)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+    finally:
+        emit("end")
+
+
+async def _delegate(scope: Dict[str, Any], body: bytes, send) -> None:
+    loop = asyncio.get_running_loop()
+    events: "asyncio.Queue[tuple]" = asyncio.Queue()
+    future = loop.run_in_executor(executor, _run_wsgi, _environ(scope, body), loop, events)
+    started = False
+    while True:
+        event = await events.get()
+        if event[0] == "start":
+            status, headers = event[1], event[2]
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            })
+            started = True
+        elif event[0] == "body":
+            await send({"type": "http.response.body", "body": event[1], "more_body": True})
+        else:
+            break
+    try:
+        await future
+    except Exception:
+        if not started:
+            await _send_json(send, {"error": "internal server error"}, 500)
+            return
+    await send({"type": "http.response.body", "body": b""})
+
+
+def _long_poll_request(body: bytes) -> Optional[Tuple[Dict[str, Any], str, float]]:
+    """
+    Return (data, serial_number, wait) for a valid long-poll request, else
+    None (the request is then answered by the Flask route, including errors).
+    """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    serial_number = data.get("serial_number")
+    wait, error = api._parse_wait(data)
+    if not isinstance(serial_number, str) or not serial_number or error or not wait:
+        return None
+    return data, serial_number, wait
+
+
+async def _native(route: str, method: str, data: Any, send, handler) -> None:
+    """
+    Serve a route on the event loop with the admission control and request
+    metrics of api.py; handler(send) writes the response.
+    """
+    start = time.perf_counter()
+    api.IN_FLIGHT.inc()
+
+    async def recorded_send(message) -> None:
+        if message["type"] == "http.response.start":
+            api._record_request(route, method, message["status"], time.perf_counter() - start)
+        await send(message)
+
+    try:
+        rejected = api._admit(route, data)
+        if rejected is not None:
+            body, retry_after = api._rejection(route, *rejected)
+            await _send_json(recorded_send, body, 429, [(b"retry-after", retry_after.encode())])
+            return
+        try:
+            await handler(recorded_send)
+        finally:
+            if route in api.WRITE_ROUTES:
+                api.write_slots.release()
+    finally:
+        api.IN_FLIGHT.dec()
+
+
+async def _frage_entriegeln(serial_number: str, wait: float, send) -> None:
+    entriegeln = await api.unlock_waiters.wait_async(serial_number, api._consume_entriegeln(serial_number), wait,
+                                                      consume_executor)
+    await _send_json(send, {"entriegeln": entriegeln})
+
+
+async def _entriegeln_stream(serial_number: str, receive, send) -> None:
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")],
+    })
+
+    async def events() -> None:
+        await send({"type": "http.response.body", "body": b"retry: 5000\n\n", "more_body": True})
+        consume = api._consume_entriegeln(serial_number)
+        while True:
+            if await api.unlock_waiters.wait_async(serial_number, consume, api.SSE_KEEPALIVE_SECONDS, consume_executor):
+                chunk = b'event: entriegeln\ndata: {"entriegeln": true}\n\n'
+            else:
+                chunk = b": keepalive\n\n"
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+    task = asyncio.ensure_future(events())
+    try:
+        # Bis der Client die Verbindung schließt
+        while (await receive())["type"] != "http.disconnect":
+            pass
+    finally:
+        task.cancel()
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            api.device_state.stop_snapshots(api.db_pool)
+            if api.letter_writer is not None:
+                api.letter_writer.stop()
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    if path == "/entriegeln/stream" and method == "GET":
+        serial_number = parse_qs(scope.get("query_string", b"").decode()).get("serial_number", [""])[0]
+        if serial_number:
+            await _native(path, method, {"serial_number": serial_number}, send,
+                          lambda send: _entriegeln_stream(serial_number, receive, send))
+            return
+
+    body = await _read_body(receive)
+    if path == "/frage_entriegeln" and method == "POST":
+        long_poll = _long_poll_request(body)
+        if long_poll is not None:
+            data, serial_number, wait = long_poll
+            await _native(path, method, data, send, lambda send: _frage_entriegeln(serial_number, wait, send))
+            return
+
+    await _delegate(scope, body, send)
@@ -0,0 +1,146 @@
+"""
+Load test / benchmark for the Briefkasten API.
+
+Simulates N devices sending mixed traffic: polling /frage_entriegeln,
+bursts of /new_letter and /letters reads. Runs either in-process through
+the Flask test client or over a local socket (werkzeug server, one keep-alive
+requests.Session per simulated device). Reports throughput and
+p50/p95/p99 latency per route and writes the results as JSON, so runs can
+be compared between commits.
+
+Usage:
+    python bench_api.py [--mode inprocess|socket] [--devices N] [--duration S]
+                        [--output results.json] [--compare old.json]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+from bench_common import Recorder, bench_environment, device_identity
+
+# Anteile der Anfragen pro Gerät (Summe 1.0)
+DEFAULT_MIX = {
+    "/frage_entriegeln": 0.6,
+    "/new_letter": 0.25,
+    "/letters": 0.15,
+}
+LETTER_BURST = 5
+
+
+def make_client(mode, base_url, flask_app):
+    """Gibt post(route, payload) -> status_code zurück."""
+    if mode == "inprocess":
+        client = flask_app.test_client()
+        return lambda route, payload: client.post(route, json=payload).status_code
+    import requests
+    session = requests.Session()
+    return lambda route, payload: session.post(base_url + route, json=payload, timeout=30).status_code
+
+
+def device_loop(i, post, recorder, deadline, mix, seed):
+    rng = random.Random(seed + i)
+    mac, serial = device_identity(i)
+    routes, weights = zip(*mix.items())
+    while time.perf_counter() < deadline:
+        route = rng.choices(routes, weights)[0]
+        if route == "/new_letter":
+            calls = [{"serial_number": serial, "time": "2024-06-01T12:00:00Z"}] * LETTER_BURST
+        elif route == "/letters":
+            calls = [{"mac_address": mac, "limit": 20, "order": "desc"}]
+        else:
+            calls = [{"serial_number": serial}]
+        for payload in calls:
+            start = time.perf_counter()
+            try:
+                status = post(route, payload)
+            except Exception:
+                status = None
+            recorder.add(route, time.perf_counter() - start, status)
+
+
+def run(mode, devices, duration, mix, seed=1):
+    bench_environment("bench.db")
+    import api
+
+    server = None
+    base_url = None
+    if mode == "socket":
+        import logging
+        from werkzeug.serving import make_server
+        # Zugriffslog pro Anfrage würde die Messung dominieren
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    setup = api.app.test_client()
+    for i in range(devices):
+        mac, serial = device_identity(i)
+        setup.post("/register", json={"mac_address": mac, "serial_number": serial})
+
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=device_loop, args=(i, make_client(mode, base_url, api.app), recorder, deadline, mix, seed))
+        for i in range(devices)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+    return recorder.summary(elapsed)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"{result['config']['mode']}: {result['total_requests']} requests, {result['total_rps']} req/s")
+    print(f"{'route':<20}{'req':>8}{'err':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, r in result["routes"].items():
+        line = f"{route:<20}{r['requests']:>8}{r['errors']:>6}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}"
+        old = (baseline or {}).get("routes", {}).get(route)
+        if old:
+            line += f"   p95 {r['p95_ms'] - old['p95_ms']:+.3f} ms, req/s {r['rps'] - old['rps']:+.1f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mixed-traffic load test for the Briefkasten API")
+    parser.add_argument("--mode", choices=("inprocess", "socket"), default="inprocess")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    result = run(args.mode, args.devices, args.duration, DEFAULT_MIX, args.seed)
+    result["config"] = {"mode": args.mode, "devices": args.devices, "duration": args.duration,
+                        "seed": args.seed, "mix": DEFAULT_MIX, "revision": git_revision()}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Shared helpers for the benchmark and check scripts (bench_api.py,
+bench_events.py, stress_db.py, check_workers.py).
+
+- percentile(): nearest-rank percentile of a sorted list
+- device_identity(): deterministic MAC address and serial number per device
+- Recorder: thread-safe latencies and status codes per route; state() and
+  merge() carry the results of worker processes to the parent
+- bench_environment(): temporary database and benchmark defaults
+- spawn(): starts worker processes with the "spawn" start method (like
+  gunicorn -w N: every worker imports api on its own)
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+
+# Worker-Prozesse importieren api neu, statt den Zustand des Elternprozesses zu erben
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+def bench_environment(db_name):
+    """
+    Point BRIEFKASTEN_DB at a fresh temporary database and return its path.
+    Must run before api is imported; spawned workers inherit the environment.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), db_name)
+    os.environ["BRIEFKASTEN_DB"] = db_path
+    # Simulierte Geräte senden so schnell wie möglich: den Server messen, nicht den Rate-Limiter
+    os.environ.setdefault("BRIEFKASTEN_RATE_LIMIT", "0")
+    return db_path
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def device_identity(i, prefix="BENCH", group=0):
+    """MAC-Adresse und Seriennummer des i-ten simulierten Geräts; group (16 bit) trennt Prozesse/Threads."""
+    mac = ":".join(f"{b:02X}" for b in (0x02, (group >> 8) & 0xFF, group & 0xFF,
+                                        (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF))
+    return mac, f"{prefix}{i:06d}"
+
+
+class Recorder:
+    """Sammelt Latenzen und Statuscodes pro Route (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, route, seconds, status):
+        """status None: die Anfrage ist mit einer Exception gescheitert."""
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            codes = self.statuses.setdefault(route, {})
+            codes[status] = codes.get(status, 0) + 1
+
+    def state(self):
+        """Picklebarer Stand, z.B. für die Queue eines Worker-Prozesses."""
+        with self._lock:
+            return {route: list(values) for route, values in self.latencies.items()}, \
+                {route: dict(codes) for route, codes in self.statuses.items()}
+
+    def merge(self, state):
+        latencies, statuses = state
+        with self._lock:
+            for route, values in latencies.items():
+                self.latencies.setdefault(route, []).extend(values)
+            for route, codes in statuses.items():
+                merged = self.statuses.setdefault(route, {})
+                for status, n in codes.items():
+                    merged[status] = merged.get(status, 0) + n
+
+    def errors(self, route=None):
+        """Anfragen mit Exception oder 5xx, für eine Route oder alle."""
+        routes = [route] if route is not None else list(self.statuses)
+        return sum(n for r in routes for status, n in self.statuses.get(r, {}).items()
+                   if status is None or status >= 500)
+
+    def count(self, route, status):
+        return self.statuses.get(route, {}).get(status, 0)
+
+    def summary(self, elapsed):
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            routes[route] = {
+                "requests": len(values),
+                "errors": self.errors(route),
+                "rps": round(len(values) / elapsed, 1),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+            }
+        total = sum(r["requests"] for r in routes.values())
+        return {"total_requests": total, "total_rps": round(total / elapsed, 1), "routes": routes}
+
+
+def spawn(target, count, *args):
+    """
+    Start count processes running target(index, out, *args) and return them
+    with the queue out they report to. Further synchronisation primitives
+    must come from CONTEXT.
+    """
+    out = CONTEXT.Queue()
+    procs = [CONTEXT.Process(target=target, args=(i, out) + args, daemon=True) for i in range(count)]
+    for p in procs:
+        p.start()
+    return procs, out
+
+
+def collect(out, count, timeout):
+    """One message from each of count workers."""
+    return [out.get(timeout=timeout) for _ in range(count)]
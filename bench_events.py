@@ -0,0 +1,69 @@
+"""
+Benchmark: Ereignis-zu-API-Latenz des Geräts ohne Hardware.
+
+Startet die Flask-API lokal mit einer temporären Datenbank, lädt hw_code mit
+fake_lgpio, unterbricht die Lichtschranke N-mal (optional mit Prellen vor der
+stabilen Flanke) und gibt die Statistik der Ereignis-Pipeline aus (Latenz vom
+Callback bis zur Antwort der API).
+
+Usage:
+    python bench_events.py [--events N] [--interval S] [--hold-ms MS] [--debounce-ms MS] [--bounces N]
+"""
+import argparse
+import os
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from bench_common import bench_environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description="event-to-API latency with fake lgpio")
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between interruptions")
+    parser.add_argument("--hold-ms", type=float, default=0.0, help="how long the beam stays interrupted")
+    parser.add_argument("--debounce-ms", type=float, default=0.0, help="debounce window of the light barrier")
+    parser.add_argument("--bounces", type=int, default=0, help="extra short pulses before each stable edge")
+    args = parser.parse_args()
+
+    db_path = bench_environment("bench.db")
+    os.environ["BRIEFKASTEN_JOURNAL"] = os.path.join(os.path.dirname(db_path), "events.db")
+    os.environ["BRIEFKASTEN_FAKE_GPIO"] = "1"
+
+    import api
+    server = make_server("127.0.0.1", 0, api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["BRIEFKASTEN_API"] = f"http://127.0.0.1:{server.server_port}"
+
+    import fake_lgpio
+    from hw_code import hw
+    hw.debounce_ms[hw.LICHTSCHRANKE_PIN] = args.debounce_ms
+    # Ruhepegel der Lichtschranke: 1, unterbrochen: 0
+    fake_lgpio.levels[hw.LICHTSCHRANKE_PIN] = 1
+    hw.start(self_test=False)
+
+    start = time.perf_counter()
+    for i in range(args.events):
+        for _ in range(args.bounces):
+            fake_lgpio.trigger(hw.LICHTSCHRANKE_PIN, 0)
+            fake_lgpio.trigger(hw.LICHTSCHRANKE_PIN, 1)
+        fake_lgpio.trigger(hw.LICHTSCHRANKE_PIN, 0)
+        time.sleep(args.hold_ms / 1000)
+        fake_lgpio.trigger(hw.LICHTSCHRANKE_PIN, 1)
+        time.sleep(args.interval)
+    # Letzte Flanke wird erst nach dem Entprell-Fenster gemeldet
+    time.sleep(args.debounce_ms / 1000 + 0.05)
+    hw.events.stop()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.events} events in {elapsed:.3f} s")
+    print(hw.events.stats())
+    print("suppressed edges:", fake_lgpio.suppressed)
+    print("startup:", hw.startup_report)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark: per-row commit (DatabaseHandler.addLetter) vs. group commit (LetterWriter).
+
+Runs N threads that each insert M letters into a temporary database and
+prints the throughput of both paths.
+
+Usage:
+    python bench_writer.py [--threads N] [--rows M]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import database_handler
+
+
+def bench_per_row(db_path, threads, rows):
+    pool = database_handler.ConnectionPool(db_path, max_idle=threads)
+    pool.init_schema()
+
+    def work(t):
+        for i in range(rows):
+            with pool.handler() as db:
+                db.addLetter(f"SN{t}", i)
+
+    elapsed = _run_threads(work, threads)
+    pool.close_all()
+    return elapsed
+
+
+def bench_group_commit(db_path, threads, rows):
+    pool = database_handler.ConnectionPool(db_path)
+    pool.init_schema()
+    writer = database_handler.LetterWriter(db_path).start()
+
+    def work(t):
+        for i in range(rows):
+            writer.submit(f"SN{t}", i).result()
+
+    elapsed = _run_threads(work, threads)
+    writer.stop()
+    pool.close_all()
+    return elapsed
+
+
+def _run_threads(work, threads):
+    workers = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per-row commit vs. group commit")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=200)
+    args = parser.parse_args()
+    total = args.threads * args.rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bench in (("per-row commit", bench_per_row), ("group commit", bench_group_commit)):
+            elapsed = bench(os.path.join(tmp, f"{bench.__name__}.db"), args.threads, args.rows)
+            print(f"{name:>15}: {total} rows in {elapsed:.3f} s = {total / elapsed:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Multi-process check for the shared device state backend.
+
+Starts N worker processes (each serving api.app on its own port, all using
+one database, like gunicorn -w N) and checks that:
+- a device registered through one worker is known to all others at once,
+  even if they had just looked its MAC address up as unknown,
+- a command set through one worker is consumed exactly once, even when all
+  workers poll for it at the same time,
+- a long-poll waiting on one worker is woken by /entriegeln on another,
+- the flap state set on one worker is visible on all others.
+
+Usage:
+    python check_workers.py [--workers N] [--devices N] [--backend sqlite|memory]
+
+Exits with status 1 if any check fails (run with --backend memory to see the
+failures the shared backend prevents).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench_common import collect, device_identity, spawn
+
+
+def serve(index, ports, db_path, backend):
+    os.environ["BRIEFKASTEN_DB"] = db_path
+    os.environ["BRIEFKASTEN_STATE_BACKEND"] = backend
+    import logging
+    from werkzeug.serving import make_server
+    import api
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, api.app, threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def check_registration(urls, mac, serial, via):
+    """Let every worker look the MAC up as unknown, register it through one, ask all again."""
+    unknown = all(requests.post(url + "/frage_offen", json={"mac_address": mac}, timeout=10).status_code == 404
+                  for url in urls)
+    requests.post(via + "/register", json={"mac_address": mac, "serial_number": serial},
+                  timeout=10).raise_for_status()
+    return unknown and all(
+        requests.post(url + "/frage_offen", json={"mac_address": mac}, timeout=10).status_code == 200
+        for url in urls
+    )
+
+
+def check_consume_once(urls, mac, serial):
+    """Set the command via one worker, then let all workers race for it."""
+    requests.post(urls[0] + "/entriegeln", json={"mac_address": mac}, timeout=10).raise_for_status()
+    barrier = threading.Barrier(len(urls))
+    results = []
+
+    def poll(url):
+        barrier.wait()
+        r = requests.post(url + "/frage_entriegeln", json={"serial_number": serial}, timeout=10)
+        results.append(r.json().get("entriegeln"))
+
+    threads = [threading.Thread(target=poll, args=(url,)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results.count(True) == 1
+
+
+def check_cross_worker_wakeup(urls, mac, serial, wait=10):
+    """Long-poll on the last worker, unlock via the first one."""
+    result = {}
+
+    def poll():
+        start = time.perf_counter()
+        r = requests.post(urls[-1] + "/frage_entriegeln", json={"serial_number": serial, "wait": wait},
+                          timeout=wait + 5)
+        result["entriegeln"] = r.json().get("entriegeln")
+        result["seconds"] = time.perf_counter() - start
+
+    t = threading.Thread(target=poll)
+    t.start()
+    time.sleep(0.2)
+    requests.post(urls[0] + "/entriegeln", json={"mac_address": mac}, timeout=10).raise_for_status()
+    t.join()
+    return result.get("entriegeln") is True and result["seconds"] < wait, result.get("seconds")
+
+
+def check_state(urls, mac, serial):
+    requests.post(urls[0] + "/open", json={"serial_number": serial}, timeout=10).raise_for_status()
+    return all(
+        requests.post(url + "/frage_offen", json={"mac_address": mac}, timeout=10).json().get("offen") is True
+        for url in urls
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "workers.db")
+    procs, ports = spawn(serve, args.workers, db_path, args.backend)
+    try:
+        urls = [f"http://127.0.0.1:{port}" for port in collect(ports, args.workers, timeout=30)]
+        registered = sum(check_registration(urls, *device_identity(i, "WORKER"), urls[i % len(urls)])
+                         for i in range(args.devices))
+        consumed = sum(check_consume_once(urls, *device_identity(i, "WORKER")) for i in range(args.devices))
+        state = sum(check_state(urls, *device_identity(i, "WORKER")) for i in range(args.devices))
+        woken, seconds = check_cross_worker_wakeup(urls, *device_identity(0, "WORKER"))
+
+        print(f"{args.workers} workers, backend {args.backend}")
+        print(f"  registration seen:   {registered}/{args.devices} devices ok")
+        print(f"  consume-once:        {consumed}/{args.devices} devices ok")
+        print(f"  flap state shared:   {state}/{args.devices} devices ok")
+        print(f"  cross-worker wakeup: {'ok' if woken else 'FAILED'} ({seconds:.2f} s)")
+        ok = registered == args.devices and consumed == args.devices and state == args.devices and woken
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
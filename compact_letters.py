@@ -0,0 +1,60 @@
+"""
+Retention: roll old letters up into daily aggregates.
+
+Letters older than the retention age are summed per device and day into
+'letter_daily' (count, first and last timestamp) and the raw rows are
+deleted. This runs in small batches, each in its own short transaction,
+so it can run next to the API (e.g. nightly from cron). Totals in
+/letters/summary include the compacted letters; /letters/daily returns
+the aggregates.
+
+Usage:
+    python compact_letters.py [--db PATH] [--days N] [--batch-size N] [--pause S]
+
+The retention age defaults to BRIEFKASTEN_RETENTION_DAYS (or 365 days).
+"""
+from __future__ import annotations
+import argparse
+import os
+import time
+from typing import Optional
+
+import database_handler
+
+
+DEFAULT_RETENTION_DAYS = 365
+
+
+def compact(db_path: Optional[str] = None, days: float = DEFAULT_RETENTION_DAYS,
+            batch_size: int = 1000, pause: float = 0.01) -> int:
+    """
+    Compact all letters older than days. Returns the number of letters compacted.
+    """
+    cutoff_ms = database_handler.to_epoch_ms() - int(days * 86_400_000)
+    total = 0
+    with database_handler.DatabaseHandler(db_path) as db:
+        while True:
+            count = db.compactLetters(cutoff_ms, batch_size)
+            if not count:
+                break
+            total += count
+            if pause:
+                time.sleep(pause)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default=None, help="database file (default: briefkasten.db)")
+    parser.add_argument("--days", type=float,
+                        default=float(os.environ.get("BRIEFKASTEN_RETENTION_DAYS", DEFAULT_RETENTION_DAYS)),
+                        help="keep raw letters for this many days")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.01, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    total = compact(args.db, args.days, args.batch_size, args.pause)
+    print(f"done, {total} letters compacted")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,48 @@
 import requests
 import datetime
+import logging
 from hw_code import hw
+from device_events import retry_after_seconds
 import time
 
+log = logging.getLogger("briefkasten.connector")
+
 serial_number = "SN987654"
 api = "http://localhost:5000"
 
+# Long-Poll: der Server hält die Anfrage bis zu LONG_POLL_WAIT Sekunden offen
+LONG_POLL_WAIT = 30
+session = requests.Session()
+
 
 
 def entriegeln_loop():
 
     open = False
+    fehler = 0
 
     while True:
-        if not open:
-            if entriegeln():
-                print("entriegeln received")
+        try:
+            if not open and entriegeln(wait=LONG_POLL_WAIT):
+                log.info("entriegeln received")
                 hw.servo_open()
                 time.sleep(5)
                 #hw.servo_close()
-        time.sleep(5)
+            fehler = 0
+        except requests.RequestException as e:
+            # API nicht erreichbar oder gedrosselt (429): exponentiell länger warten (max. 60 s),
+            # mindestens so lange wie vom Server per Retry-After verlangt
+            fehler += 1
+            log.warning("Fehler bei frage_entriegeln", extra={"error": str(e)})
+            delay = min(60, 2 ** fehler)
+            if e.response is not None:
+                delay = max(delay, retry_after_seconds(e.response))
+            time.sleep(delay)
 
 
-def entriegeln():
-    response = requests.post(f"{api}/frage_entriegeln", json={"serial_number": serial_number})
+def entriegeln(wait=0):
+    response = session.post(f"{api}/frage_entriegeln", json={"serial_number": serial_number, "wait": wait}, timeout=wait + 10)
+    response.raise_for_status()
     return response.json().get("entriegeln", False)
 
 
@@ -38,4 +57,14 @@ def klappe_geoeffnet():
     pass
 
 
-entriegeln_loop()
\ No newline at end of file
+def main():
+    # Hardware erst hier starten: der Import dieses Moduls hat keine Nebenwirkungen
+    hw.start()
+    try:
+        entriegeln_loop()
+    finally:
+        hw.cleanup()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,8 +1,19 @@
 from __future__ import annotations
+import datetime
+import json
+import logging
+import math
 import os
+import queue
+import random
 import re
 import sqlite3
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 """
 /c:/Coding/briefkasten/database_handler.py
@@ -10,6 +21,9 @@ from typing import Any, Dict, List, Optional
 Simple SQLite database handler with:
 - create_table(table_name)
 - get_table_content(table_name) -> list[dict]
+- ConnectionPool for long-lived, pre-configured connections
+- write transactions that take the write lock up front (BEGIN IMMEDIATE)
+  and are retried with jittered backoff when the database stays locked
 
 Creates the database file next to this module by default.
 """
@@ -18,6 +32,392 @@ Creates the database file next to this module by default.
 
 _VALID_NAME = re.compile(r"^[A-Za-z0-9_]+$")
 
+T = TypeVar("T")
+
+log = logging.getLogger("briefkasten.db")
+
+# Write transactions that still find the database locked after the busy
+# timeout are retried this often, sleeping a jittered, doubling delay.
+WRITE_RETRIES = int(os.environ.get("BRIEFKASTEN_WRITE_RETRIES", "3"))
+WRITE_RETRY_BASE_DELAY = 0.02
+WRITE_RETRY_MAX_DELAY = 0.5
+
+# Applied once per connection when it is opened, never per request.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+
+def default_db_path() -> str:
+    """
+    Database file next to this module, overridable via BRIEFKASTEN_DB.
+    """
+    return os.environ.get("BRIEFKASTEN_DB") or os.path.join(os.path.dirname(__file__), "briefkasten.db")
+
+
+def default_busy_timeout() -> float:
+    """
+    Seconds a statement waits for another connection's lock before failing
+    with "database is locked"; BRIEFKASTEN_BUSY_TIMEOUT_MS (default 5000).
+    """
+    return int(os.environ.get("BRIEFKASTEN_BUSY_TIMEOUT_MS", "5000")) / 1000
+
+
+def is_busy(exc: BaseException) -> bool:
+    """
+    True for SQLITE_BUSY / SQLITE_LOCKED errors ("database is locked").
+    """
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(exc)
+    return "locked" in message or "busy" in message
+
+
+_lock_stats_lock = threading.Lock()
+_lock_stats = {"retries": 0, "failures": 0}
+
+
+def lock_stats() -> Dict[str, int]:
+    """
+    Write transactions retried because the database was locked, and those
+    that still failed after WRITE_RETRIES attempts (process-wide).
+    """
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+
+def _count_lock(key: str) -> None:
+    with _lock_stats_lock:
+        _lock_stats[key] += 1
+
+
+def to_epoch_ms(value: Any = None) -> int:
+    """
+    Normalize a letter timestamp to integer epoch milliseconds (UTC).
+    Accepts None (now), an int/float of epoch milliseconds or an ISO 8601
+    string; strings without a UTC offset are taken as UTC.
+    Raises ValueError for anything else, including non-finite numbers and
+    instants that format_epoch_ms() cannot represent.
+    """
+    if value is None:
+        return time.time_ns() // 1_000_000
+    if isinstance(value, bool):
+        raise ValueError("timestamp must be epoch milliseconds or an ISO 8601 string")
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError(f"invalid timestamp {value!r}")
+        return _in_range(int(value), value)
+    if not isinstance(value, str):
+        raise ValueError("timestamp must be epoch milliseconds or an ISO 8601 string")
+    text = value.strip()
+    if text.endswith(("Z", "z")):
+        text = text[:-1] + "+00:00"
+    try:
+        parsed = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"invalid timestamp {value!r}") from None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return _in_range(int(parsed.timestamp() * 1000), value)
+
+
+def _in_range(ms: int, value: Any) -> int:
+    try:
+        format_epoch_ms(ms)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"timestamp {value!r} out of range") from None
+    return ms
+
+
+def format_epoch_ms(ms: int) -> str:
+    """
+    Canonical ISO 8601 form (UTC, millisecond precision) of an epoch-ms timestamp.
+    """
+    dt = datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc)
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def letter_row(serial_number: str, value: Any = None) -> Tuple[str, str, int]:
+    """
+    Build a (serial, time, ts) row for the letters table from a raw timestamp.
+    """
+    ts = to_epoch_ms(value)
+    return serial_number, format_epoch_ms(ts), ts
+
+
+def connect(db_path: Optional[str] = None, busy_timeout: Optional[float] = None) -> sqlite3.Connection:
+    """
+    Open a connection with row factory, busy timeout (seconds, default see
+    default_busy_timeout()) and PRAGMAS applied.
+    The connection may be handed between threads (one user at a time).
+    """
+    conn = sqlite3.connect(
+        db_path or default_db_path(),
+        timeout=default_busy_timeout() if busy_timeout is None else busy_timeout,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class SerialCache:
+    """
+    LRU cache for MAC address -> serial number lookups.
+
+    Unknown MACs are cached as None (negative caching). Entries are dropped
+    locally by invalidate() (called from addUser) and globally whenever the
+    'users_version' counter in the database changes, which other workers
+    bump when they register a device. The counter is read at most every
+    max_age seconds, which bounds how stale a cached serial can get; a
+    cached "unknown" is only trusted after re-reading the counter, so a
+    device registered on another worker is found right away.
+    """
+
+    def __init__(self, max_size: int = 1024, max_age: float = 1.0) -> None:
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._db_version: Optional[int] = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self, read_version, force: bool = False) -> None:
+        """
+        Clear the cache if the database version changed; unless force is
+        set, read_version() is only called when the last check is older
+        than max_age.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.max_age:
+            return
+        version = read_version()
+        with self._lock:
+            self._checked_at = now
+            if version != self._db_version:
+                self._db_version = version
+                self._entries.clear()
+                self._generation += 1
+
+    def get(self, mac: str) -> Tuple[bool, Optional[str], int]:
+        """
+        Return (hit, serial, generation); pass generation on to put().
+        """
+        with self._lock:
+            if mac in self._entries:
+                self._entries.move_to_end(mac)
+                self.hits += 1
+                return True, self._entries[mac], self._generation
+            self.misses += 1
+            return False, None, self._generation
+
+    def put(self, mac: str, serial: Optional[str], generation: int) -> None:
+        """
+        Store a lookup result unless the cache was invalidated since get().
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[mac] = serial
+            self._entries.move_to_end(mac)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, mac: str) -> None:
+        with self._lock:
+            self._entries.pop(mac, None)
+            self._generation += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class _Ring:
+    __slots__ = ("letters", "floor", "version")
+
+    def __init__(self, letters: List[Tuple[int, Optional[str], Optional[int]]], floor: int,
+                 version: Tuple[int, int]) -> None:
+        # (id, time, ts) records in id order
+        self.letters = letters
+        # every letter of the device with id > floor is in letters
+        self.floor = floor
+        # (last_id, count) from letter_counters this ring is consistent with
+        self.version = version
+
+
+class RecentLetters:
+    """
+    Write-through cache of the latest letters per device.
+
+    Each device keeps up to per_device (id, time, ts) tuples. A ring is only
+    used while its version matches the device's (last_id, count) in
+    letter_counters, which /letters reads for its ETag anyway, so writes
+    by other workers, the LetterWriter or compaction simply make it stale
+    and it is reloaded on the next read. Cold devices are evicted (LRU)
+    once the total number of cached letters exceeds max_letters.
+    """
+
+    def __init__(self, per_device: int = 32, max_letters: int = 100000) -> None:
+        self.per_device = per_device
+        self.max_letters = max_letters
+        self._rings: "OrderedDict[str, _Ring]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, serial: str, since_id: int, limit: Optional[int], version: Tuple[int, int],
+            newest_first: bool = False) -> Optional[List[Dict[str, Any]]]:
+        """
+        Letters with id > since_id (at most limit, oldest or newest first), or
+        None if the ring is missing, stale or does not hold all requested letters.
+        """
+        with self._lock:
+            ring = self._rings.get(serial)
+            if ring is None or ring.version != version:
+                self.misses += 1
+                return None
+            rows = [r for r in ring.letters if r[0] > since_id]
+            # Older letters than the ring holds are only needed if the ring cannot fill the page
+            if since_id < ring.floor and not (newest_first and limit is not None and len(rows) >= limit):
+                self.misses += 1
+                return None
+            self._rings.move_to_end(serial)
+            self.hits += 1
+        if newest_first:
+            rows.reverse()
+        if limit is not None:
+            rows = rows[:limit]
+        return [{"id": i, "time": t, "ts": ts} for i, t, ts in rows]
+
+    def has(self, serial: str, version: Tuple[int, int]) -> bool:
+        with self._lock:
+            ring = self._rings.get(serial)
+            return ring is not None and ring.version == version
+
+    def cached(self, serials) -> List[str]:
+        """
+        The given serials that currently have a ring (candidates for write-through).
+        """
+        with self._lock:
+            return [serial for serial in serials if serial in self._rings]
+
+    def load(self, serial: str, newest_first: List[Tuple[int, Optional[str], Optional[int]]],
+             version: Tuple[int, int]) -> None:
+        """
+        Store the newest per_device letters of a device as read from the database.
+        """
+        letters = list(reversed(newest_first[:self.per_device]))
+        floor = letters[0][0] - 1 if len(newest_first) >= self.per_device else 0
+        with self._lock:
+            self._put(serial, _Ring(letters, floor, version))
+            self.loads += 1
+
+    def add(self, serial: str, rows: List[Tuple[int, Optional[str], Optional[int]]],
+            before: Optional[Tuple[int, int]], after: Tuple[int, int]) -> None:
+        """
+        Write-through for rows just inserted in one transaction, which read the
+        device's version before (None = not read) and after the inserts.
+        Cached devices only; the ring is dropped unless it was current right
+        before the insert, since any other write (another process inserting
+        or compacting) in between could otherwise leave it inconsistent.
+        """
+        with self._lock:
+            ring = self._rings.get(serial)
+            if ring is None:
+                return
+            if before is None or ring.version != before:
+                self._drop(serial)
+                return
+            letters = sorted(ring.letters + rows)
+            floor = ring.floor
+            if len(letters) > self.per_device:
+                floor = letters[-self.per_device - 1][0]
+                letters = letters[-self.per_device:]
+            self._put(serial, _Ring(letters, floor, after))
+
+    def _put(self, serial: str, ring: _Ring) -> None:
+        self._drop(serial)
+        self._rings[serial] = ring
+        self._size += len(ring.letters)
+        while self._size > self.max_letters and len(self._rings) > 1:
+            cold = next(iter(self._rings))
+            self._drop(cold)
+            self.evictions += 1
+
+    def _drop(self, serial: str) -> None:
+        ring = self._rings.pop(serial, None)
+        if ring is not None:
+            self._size -= len(ring.letters)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"devices": len(self._rings), "letters": self._size, "hits": self.hits,
+                    "misses": self.misses, "loads": self.loads, "evictions": self.evictions}
+
+
+class IdempotencyCache:
+    """
+    Bounded LRU/TTL set of recently seen (device, event_id) keys.
+
+    Answers "seen this letter before?" without touching the database for
+    repeats within ttl seconds (client retries, bouncing inputs). It is only
+    a fast path: the unique index on letters (serial, event_id) still
+    rejects repeats that fell out of the window or arrived at another worker.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, device: str, event_id: str) -> bool:
+        """
+        Return True if the key was added within ttl; otherwise add it and return False.
+        """
+        key = (device, event_id)
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+            self.misses += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return False
+
+    def forget(self, device: str, event_id: str) -> None:
+        """
+        Drop a key again, e.g. when storing the letter failed.
+        """
+        with self._lock:
+            self._entries.pop((device, event_id), None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
 
 class DatabaseHandler:
     """
@@ -29,18 +429,27 @@ class DatabaseHandler:
       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     """
 
-    def __init__(self, db_path: Optional[str] = None) -> None:
+    def __init__(self, db_path: Optional[str] = None, conn: Optional[sqlite3.Connection] = None,
+                 serial_cache: Optional[SerialCache] = None,
+                 recent_letters: Optional[RecentLetters] = None) -> None:
         if db_path is None:
-            db_path = os.path.join(os.path.dirname(__file__), "briefkasten.db")
+            db_path = default_db_path()
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-        self.conn.row_factory = sqlite3.Row
-
-        self.create_user_table()
+        self.serial_cache = serial_cache
+        self.recent_letters = recent_letters
+        # A borrowed connection (e.g. from ConnectionPool) is already configured
+        # and its schema is set up at startup; it is not closed by close().
+        self._owns_conn = conn is None
+        if conn is None:
+            self.conn = connect(self.db_path)
+            self.create_schema()
+        else:
+            self.conn = conn
 
     def close(self) -> None:
         if self.conn:
-            self.conn.close()
+            if self._owns_conn:
+                self.conn.close()
             self.conn = None  # type: ignore
 
     def __enter__(self) -> "DatabaseHandler":
@@ -92,13 +501,20 @@ class DatabaseHandler:
         rows = cur.fetchall()
         return [dict(row) for row in rows]
 
-    def create_user_table(self) -> None:
+    def create_schema(self) -> None:
         """
-        Create a 'users' table with id, username, email, created_at.
+        Create all tables and indexes used by the API.
         """
+        self.create_user_table()
+        self.create_letters_table()
+        self.create_device_state_table()
+        self.create_meta_table()
+        self.create_letter_daily_table()
 
-        print("Creating users table")
-
+    def create_user_table(self) -> None:
+        """
+        Create a 'users' table with id, mac, ser and an index on mac.
+        """
         sql = """
         CREATE TABLE IF NOT EXISTS users (
             id TEXT PRIMARY KEY,
@@ -108,77 +524,803 @@ class DatabaseHandler:
         """
         cur = self.conn.cursor()
         cur.execute(sql)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_mac ON users (mac)")
         self.conn.commit()
 
-    def create_letter_table(self, serial_number: str) -> None:
+    @contextmanager
+    def _schema_change(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Run check-then-alter schema steps under the database write lock, so
+        several worker processes starting at once cannot race each other.
         """
-        Create a table for letters with id, serial_number, content, created_at.
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def _write(self, work: Callable[[sqlite3.Cursor], T]) -> T:
         """
+        Run work(cur) in a BEGIN IMMEDIATE transaction and commit it.
 
-        print("Creating letter table for serial number:", serial_number)
+        Taking the write lock up front means the busy timeout covers the whole
+        transaction (a deferred transaction that reads first can fail on its
+        first write without waiting). If the lock is still not available,
+        the transaction is rolled back and work is run again, up to
+        WRITE_RETRIES times with jittered exponential backoff; work must
+        therefore only touch the database.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = work(self.conn.cursor())
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+                return result
+            except sqlite3.OperationalError as exc:
+                if not is_busy(exc):
+                    raise
+                if attempt >= WRITE_RETRIES:
+                    _count_lock("failures")
+                    raise
+                _count_lock("retries")
+                delay = min(WRITE_RETRY_MAX_DELAY, WRITE_RETRY_BASE_DELAY * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                attempt += 1
 
-        sql = f"""
-        CREATE TABLE IF NOT EXISTS {serial_number} (
+    def create_letters_table(self) -> None:
+        """
+        Create the shared 'letters' table (one row per letter, all devices)
+        with composite (serial, id) and (serial, ts) indexes.
+
+        'ts' is the letter time as integer epoch milliseconds (UTC); 'time'
+        holds the same instant as a canonical ISO string. Databases from
+        before 'ts' existed get the column and are backfilled from 'time'.
+        'event_id' is the optional client idempotency key, unique per device.
+        """
+        sql = """
+        CREATE TABLE IF NOT EXISTS letters (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            time TEXT
+            serial TEXT NOT NULL,
+            time TEXT,
+            ts INTEGER,
+            event_id TEXT
+        )
+        """
+        with self._schema_change() as cur:
+            cur.execute(sql)
+            columns = {row["name"] for row in cur.execute("PRAGMA table_info(letters)")}
+            if "ts" not in columns:
+                cur.execute("ALTER TABLE letters ADD COLUMN ts INTEGER")
+                # julianday() understands ISO strings with 'Z' or +HH:MM offsets; anything else stays NULL
+                cur.execute(
+                    "UPDATE letters SET ts = CAST(ROUND((julianday(time) - 2440587.5) * 86400000) AS INTEGER) "
+                    "WHERE ts IS NULL AND julianday(time) IS NOT NULL"
+                )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_letters_serial_id ON letters (serial, id)")
+            if "event_id" not in columns:
+                cur.execute("ALTER TABLE letters ADD COLUMN event_id TEXT")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_letters_serial_ts ON letters (serial, ts)")
+            # NULLs are distinct, so letters without a key are never affected
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_letters_serial_event ON letters (serial, event_id)")
+        self.create_letter_counters_table()
+
+    def create_letter_counters_table(self) -> None:
+        """
+        Create 'letter_counters' (serial, count, last_id, last_time, last_ts,
+        unread, read_id, archived), kept up to date by triggers on 'letters' in the
+        same transaction as every insert/delete. 'archived' counts letters
+        compacted into 'letter_daily'. Existing letters are counted once when
+        the table (or one of its columns) is first created.
+        """
+        with self._schema_change() as cur:
+            rebuild = self._create_letter_counters(cur)
+        if rebuild:
+            self.rebuildLetterCounters()
+
+    def _create_letter_counters(self, cur: sqlite3.Cursor) -> bool:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS letter_counters (
+            serial TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_id INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        columns = {row["name"] for row in cur.execute("PRAGMA table_info(letter_counters)")}
+        rebuild = "last_time" not in columns or "last_ts" not in columns
+        for column, decl in (("last_time", "TEXT"),
+                             ("last_ts", "INTEGER"),
+                             ("unread", "INTEGER NOT NULL DEFAULT 0"),
+                             ("read_id", "INTEGER NOT NULL DEFAULT 0"),
+                             ("archived", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                cur.execute(f"ALTER TABLE letter_counters ADD COLUMN {column} {decl}")
+        # Recreate the triggers so databases created by older versions pick up the current logic
+        cur.execute("DROP TRIGGER IF EXISTS letters_counters_insert")
+        cur.execute("""
+        CREATE TRIGGER letters_counters_insert AFTER INSERT ON letters
+        BEGIN
+            INSERT INTO letter_counters (serial, count, last_id, last_time, last_ts, unread)
+            VALUES (NEW.serial, 1, NEW.id, NEW.time, NEW.ts, 1)
+            ON CONFLICT(serial) DO UPDATE SET
+                count = count + 1,
+                unread = unread + (NEW.id > read_id),
+                -- Newest timestamp, not highest id: backfilled letters get new ids with old times
+                last_time = CASE WHEN last_ts IS NULL OR NEW.ts >= last_ts THEN NEW.time ELSE last_time END,
+                last_ts = COALESCE(MAX(last_ts, NEW.ts), last_ts, NEW.ts),
+                last_id = MAX(last_id, NEW.id);
+        END
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS letters_counters_delete")
+        cur.execute("""
+        CREATE TRIGGER letters_counters_delete AFTER DELETE ON letters
+        BEGIN
+            UPDATE letter_counters
+            SET count = count - 1,
+                unread = unread - (OLD.id > read_id)
+            WHERE serial = OLD.serial;
+        END
+        """)
+        return rebuild
+
+    def rebuildLetterCounters(self) -> None:
+        """
+        Recompute letter_counters from the raw 'letters' rows and 'letter_daily'.
+        The read marker (read_id) of each device is kept; last_id and
+        last_time/last_ts (the newest timestamp) never move backwards (the
+        newest letter may already be compacted).
+        """
+        has_daily = self._table_exists("letter_daily")
+
+        def work(cur: sqlite3.Cursor) -> None:
+            cur.execute("UPDATE letter_counters SET count = 0, unread = 0, archived = 0")
+            cur.execute("""
+            WITH agg AS (SELECT serial, COUNT(*) AS count, MAX(id) AS last_id, MAX(ts) AS last_ts
+                         FROM letters GROUP BY serial)
+            INSERT INTO letter_counters (serial, count, last_id, last_time, last_ts, unread)
+            SELECT agg.serial, agg.count, agg.last_id,
+                   (SELECT time FROM letters l WHERE l.serial = agg.serial ORDER BY l.ts DESC, l.id DESC LIMIT 1),
+                   agg.last_ts,
+                   (SELECT COUNT(*) FROM letters l WHERE l.serial = agg.serial AND l.id >
+                        COALESCE((SELECT read_id FROM letter_counters c WHERE c.serial = agg.serial), 0))
+            FROM agg WHERE true
+            ON CONFLICT(serial) DO UPDATE SET
+                count = excluded.count,
+                last_time = CASE WHEN last_ts IS NULL OR excluded.last_ts >= last_ts
+                            THEN excluded.last_time ELSE last_time END,
+                last_ts = COALESCE(MAX(last_ts, excluded.last_ts), last_ts, excluded.last_ts),
+                last_id = MAX(last_id, excluded.last_id),
+                unread = excluded.unread
+            """)
+            if has_daily:
+                cur.execute("""
+                INSERT INTO letter_counters (serial, archived)
+                SELECT serial, SUM(count) FROM letter_daily WHERE true GROUP BY serial
+                ON CONFLICT(serial) DO UPDATE SET archived = excluded.archived
+                """)
+
+        self._write(work)
+
+    def create_meta_table(self) -> None:
+        """
+        Create the 'meta' key/value table (e.g. the users_version counter).
+        """
+        cur = self.conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def _users_version(self) -> int:
+        cur = self.conn.cursor()
+        cur.execute("SELECT value FROM meta WHERE key = 'users_version'")
+        row = cur.fetchone()
+        return row["value"] if row else 0
+
+    def create_device_state_table(self) -> None:
+        """
+        Create the 'device_state' table holding snapshots of pending commands and device state.
+        """
+        sql = """
+        CREATE TABLE IF NOT EXISTS device_state (
+            device TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT,
+            expires_at REAL,
+            PRIMARY KEY (device, kind, name)
         )
         """
         cur = self.conn.cursor()
         cur.execute(sql)
         self.conn.commit()
 
-        # validate the serial number and insert a test row with the current timestamp
-        self._validate_table_name(serial_number)
-        cur.execute(f'INSERT INTO "{serial_number}" (time) VALUES (CURRENT_TIMESTAMP)')
+    def create_letter_daily_table(self) -> None:
+        """
+        Create 'letter_daily' (serial, day, count, first_ts, last_ts) holding
+        the per-day aggregates of letters removed by compactLetters().
+        """
+        sql = """
+        CREATE TABLE IF NOT EXISTS letter_daily (
+            serial TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            PRIMARY KEY (serial, day)
+        )
+        """
+        cur = self.conn.cursor()
+        cur.execute(sql)
         self.conn.commit()
 
     def getSerialNumberByMAC(self, mac_address: str) -> Optional[str]:
         """
         Retrieve the serial number associated with the given MAC address.
-        Returns None if not found.
+        Returns None if not found. Uses the serial cache if one is attached.
         """
+        cache = self.serial_cache
+        if cache is not None:
+            cache.check_version(self._users_version)
+            hit, serial, generation = cache.get(mac_address)
+            if hit and serial is None:
+                # Unbekannt: vielleicht inzwischen auf einem anderen Worker registriert
+                # (ein Primärschlüssel-Lookup auf meta)
+                cache.check_version(self._users_version, force=True)
+                hit, serial, generation = cache.get(mac_address)
+            if hit:
+                return serial
         cur = self.conn.cursor()
         cur.execute("SELECT ser FROM users WHERE mac = ?", (mac_address,))
         row = cur.fetchone()
-        if row:
-            return row["ser"]
-        return None
+        serial = row["ser"] if row else None
+        if cache is not None:
+            cache.put(mac_address, serial, generation)
+        return serial
     
-    def getLetters(self, serial_number: str) -> List[Dict[str, Any]]:
+    @staticmethod
+    def _letters_filter(serial_number: str, since_id: int, from_ms: Optional[int],
+                        to_ms: Optional[int]) -> Tuple[str, List[Any]]:
+        where = "serial = ? AND id > ?"
+        params: List[Any] = [serial_number, since_id]
+        if from_ms is not None:
+            where += " AND ts >= ?"
+            params.append(from_ms)
+        if to_ms is not None:
+            where += " AND ts < ?"
+            params.append(to_ms)
+        return where, params
+
+    def getLetters(self, serial_number: str, since_id: int = 0, limit: Optional[int] = None,
+                   from_ms: Optional[int] = None, to_ms: Optional[int] = None,
+                   version: Optional[Tuple[int, int]] = None, newest_first: bool = False) -> List[Dict[str, Any]]:
         """
-        Retrieve all letters associated with the given serial number.
+        Retrieve the letters associated with the given serial number.
+        Only letters with id > since_id and from_ms <= ts < to_ms (either bound
+        optional) are returned, at most limit (None = all), in id order or
+        newest first.
+        Recent letters come from the RecentLetters cache if one is attached;
+        pass version (from getLetterVersion) if already known.
         Returns a list of letters.
         """
-        if not self._table_exists(serial_number):
-            return []
-        
+        cache = self.recent_letters
+        if cache is not None and serial_number is not None and from_ms is None and to_ms is None:
+            if version is None:
+                version = self.getLetterVersion(serial_number)
+            letters = cache.get(serial_number, since_id, limit, version, newest_first)
+            if letters is None and not cache.has(serial_number, version):
+                self._loadRecentLetters(serial_number)
+                letters = cache.get(serial_number, since_id, limit, version, newest_first)
+            if letters is not None:
+                return letters
+        where, params = self._letters_filter(serial_number, since_id, from_ms, to_ms)
         cur = self.conn.cursor()
-        cur.execute(f'SELECT * FROM "{serial_number}"')
+        cur.execute(
+            f"SELECT id, time, ts FROM letters WHERE {where} ORDER BY id {'DESC' if newest_first else 'ASC'} LIMIT ?",
+            params + [-1 if limit is None else limit],
+        )
         rows = cur.fetchall()
         return [dict(row) for row in rows]
+
+    def _loadRecentLetters(self, serial_number: str) -> None:
+        """
+        Fill the RecentLetters ring of a device; letters and version are read in one snapshot.
+        """
+        cache = self.recent_letters
+        self.conn.execute("BEGIN")
+        try:
+            version = self.getLetterVersion(serial_number)
+            cur = self.conn.execute(
+                "SELECT id, time, ts FROM letters WHERE serial = ? ORDER BY id DESC LIMIT ?",
+                (serial_number, cache.per_device),
+            )
+            rows = [tuple(row) for row in cur.fetchall()]
+        finally:
+            self.conn.commit()
+        cache.load(serial_number, rows, version)
+
+    def _letterVersions(self, serials) -> Dict[str, Tuple[int, int]]:
+        return {serial: self.getLetterVersion(serial) for serial in serials}
+
+    def iterLetters(self, serial_number: str, since_id: int = 0, batch_size: int = 500,
+                    from_ms: Optional[int] = None, to_ms: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield letters one by one, fetching batch_size rows at a time,
+        so memory use does not grow with the length of the history.
+        """
+        where, params = self._letters_filter(serial_number, since_id, from_ms, to_ms)
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT id, time, ts FROM letters WHERE {where} ORDER BY id", params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+
+    def countLetters(self, serial_number: str, since_id: int = 0,
+                     from_ms: Optional[int] = None, to_ms: Optional[int] = None) -> int:
+        """
+        Return the number of letters for the given serial number (same filters as getLetters).
+        """
+        where, params = self._letters_filter(serial_number, since_id, from_ms, to_ms)
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM letters WHERE {where}", params)
+        return cur.fetchone()[0]
+
+    def getDailyLetters(self, serial_number: str, from_ms: Optional[int] = None,
+                        to_ms: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Return the daily aggregates (day, count, first_ts, last_ts) of compacted
+        letters whose day overlaps [from_ms, to_ms).
+        """
+        where = "serial = ?"
+        params: List[Any] = [serial_number]
+        if from_ms is not None:
+            where += " AND last_ts >= ?"
+            params.append(from_ms)
+        if to_ms is not None:
+            where += " AND first_ts < ?"
+            params.append(to_ms)
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT day, count, first_ts, last_ts FROM letter_daily WHERE {where} ORDER BY day", params)
+        return [dict(row) for row in cur.fetchall()]
+
+    def compactLetters(self, cutoff_ms: int, batch_size: int = 1000) -> int:
+        """
+        Roll up to batch_size of the oldest letters with ts < cutoff_ms into
+        'letter_daily' and delete them, all in one transaction.
+        Returns the number of letters compacted (0 when nothing is left).
+        """
+        def work(cur: sqlite3.Cursor) -> int:
+            cur.execute(
+                "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM letters WHERE ts < ? ORDER BY id LIMIT ?)",
+                (cutoff_ms, batch_size),
+            )
+            max_id, count = cur.fetchone()
+            if not count:
+                return 0
+            cur.execute("""
+            INSERT INTO letter_daily (serial, day, count, first_ts, last_ts)
+            SELECT serial, date(ts / 1000, 'unixepoch'), COUNT(*), MIN(ts), MAX(ts)
+            FROM letters WHERE ts < ? AND id <= ? GROUP BY serial, date(ts / 1000, 'unixepoch')
+            ON CONFLICT(serial, day) DO UPDATE SET
+                count = count + excluded.count,
+                first_ts = MIN(first_ts, excluded.first_ts),
+                last_ts = MAX(last_ts, excluded.last_ts)
+            """, (cutoff_ms, max_id))
+            cur.execute("""
+            UPDATE letter_counters SET archived = archived +
+                (SELECT COUNT(*) FROM letters l WHERE l.serial = letter_counters.serial AND l.ts < ? AND l.id <= ?)
+            WHERE serial IN (SELECT DISTINCT serial FROM letters WHERE ts < ? AND id <= ?)
+            """, (cutoff_ms, max_id, cutoff_ms, max_id))
+            cur.execute("DELETE FROM letters WHERE ts < ? AND id <= ?", (cutoff_ms, max_id))
+            return count
+
+        return self._write(work)
     
+    def getLetterVersion(self, serial_number: str) -> Tuple[int, int]:
+        """
+        Return (last_id, count) for the given serial number from letter_counters.
+        Changes whenever a letter is added or removed; (0, 0) if there are none.
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT last_id, count FROM letter_counters WHERE serial = ?", (serial_number,))
+        row = cur.fetchone()
+        return (row["last_id"], row["count"]) if row else (0, 0)
+
+    def getLetterSummaries(self, mac_addresses: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Return {mac: {"serial_number", "count", "last_time", "unread"}} for many
+        devices in one query; unknown MACs map to None.
+        """
+        summaries: Dict[str, Optional[Dict[str, Any]]] = {mac: None for mac in mac_addresses}
+        if not mac_addresses:
+            return summaries
+        placeholders = ",".join("?" * len(mac_addresses))
+        cur = self.conn.cursor()
+        cur.execute(
+            f"SELECT u.mac, u.ser, c.count + c.archived AS count, c.last_time, c.unread FROM users u "
+            f"LEFT JOIN letter_counters c ON c.serial = u.ser WHERE u.mac IN ({placeholders})",
+            list(mac_addresses),
+        )
+        for row in cur.fetchall():
+            summaries[row["mac"]] = {
+                "serial_number": row["ser"],
+                "count": row["count"] or 0,
+                "last_time": row["last_time"],
+                "unread": row["unread"] or 0,
+            }
+        return summaries
+
+    def markLettersRead(self, serial_number: str, up_to_id: Optional[int] = None) -> int:
+        """
+        Mark letters up to up_to_id (default: the latest) as read.
+        up_to_id is clamped to the latest letter id, so letters added later
+        count as unread. Returns the remaining unread count.
+        """
+        def work(cur: sqlite3.Cursor) -> int:
+            cur.execute("SELECT last_id FROM letter_counters WHERE serial = ?", (serial_number,))
+            row = cur.fetchone()
+            last_id = row["last_id"] if row else 0
+            read_id = last_id if up_to_id is None else min(up_to_id, last_id)
+            cur.execute("SELECT COUNT(*) FROM letters WHERE serial = ? AND id > ?", (serial_number, read_id))
+            unread = cur.fetchone()[0]
+            cur.execute(
+                "INSERT INTO letter_counters (serial, read_id, unread) VALUES (?, ?, ?) "
+                "ON CONFLICT(serial) DO UPDATE SET read_id = excluded.read_id, unread = excluded.unread",
+                (serial_number, read_id, unread),
+            )
+            return unread
+
+        return self._write(work)
+
     def addUser(self, mac: str, ser: str) -> None:
         """
         Add a user with the given MAC address and serial number.
+        Bumps users_version so cached lookups in other workers are dropped.
+        """
+        def work(cur: sqlite3.Cursor) -> None:
+            cur.execute("INSERT INTO users (mac, ser) VALUES (?, ?)", (mac, ser))
+            cur.execute(
+                "INSERT INTO meta (key, value) VALUES ('users_version', 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+            )
+
+        self._write(work)
+        if self.serial_cache is not None:
+            self.serial_cache.invalidate(mac)
+
+    def addLetter(self, serial_number: str, time: Any = None, event_id: Optional[str] = None) -> bool:
+        """
+        Add a letter entry for the given serial number.
+        time: epoch milliseconds or ISO 8601 string (None = now), see to_epoch_ms().
+        event_id: optional idempotency key; returns False if the device
+        already has a letter with this key (nothing is inserted).
+        """
+        row = letter_row(serial_number, time)
+        cached = self.recent_letters is not None and bool(self.recent_letters.cached([serial_number]))
+
+        def work(cur: sqlite3.Cursor) -> Tuple[bool, int, Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+            # Counter versions read inside the insert transaction, for the write-through cache
+            before = self.getLetterVersion(serial_number) if cached else None
+            cur.execute("INSERT OR IGNORE INTO letters (serial, time, ts, event_id) VALUES (?, ?, ?, ?)",
+                        row + (event_id,))
+            added = cur.rowcount == 1
+            after = self.getLetterVersion(serial_number) if added and self.recent_letters is not None else None
+            return added, cur.lastrowid, before, after
+
+        added, letter_id, before, after = self._write(work)
+        if after is not None:
+            self.recent_letters.add(serial_number, [(letter_id, row[1], row[2])], before, after)
+        return added
+
+    def addLetters(self, letters: List[Tuple[Any, ...]]) -> List[bool]:
+        """
+        Add many (serial_number, time[, event_id]) letter entries in a single transaction.
+        Returns one flag per entry: False if its event_id was already stored (skipped).
+        """
+        rows = [letter_row(item[0], item[1]) + (item[2] if len(item) > 2 else None,) for item in letters]
+        added: List[bool] = []
+        inserted: Dict[str, List[Tuple[int, Optional[str], Optional[int]]]] = {}
+        cached = self.recent_letters.cached({row[0] for row in rows}) if self.recent_letters is not None else []
+        before: Dict[str, Tuple[int, int]] = {}
+
+        def work(cur: sqlite3.Cursor) -> Dict[str, Tuple[int, int]]:
+            added.clear()
+            inserted.clear()
+            before.update(self._letterVersions(cached))
+            for row in rows:
+                cur.execute("INSERT OR IGNORE INTO letters (serial, time, ts, event_id) VALUES (?, ?, ?, ?)", row)
+                added.append(cur.rowcount == 1)
+                if cur.rowcount == 1:
+                    inserted.setdefault(row[0], []).append((cur.lastrowid, row[1], row[2]))
+            return self._letterVersions(inserted) if self.recent_letters is not None else {}
+
+        versions = self._write(work)
+        for serial, version in versions.items():
+            self.recent_letters.add(serial, inserted[serial], before.get(serial), version)
+        return added
+
+    def saveDeviceState(
+        self,
+        rows: List[Tuple[str, str, str, Any, Optional[float]]],
+        removed: List[Tuple[str, str, str]] = (),
+    ) -> None:
+        """
+        Upsert the given (device, kind, name, value, expires_at) rows and delete
+        the removed (device, kind, name) keys in one transaction. Entries that
+        are not mentioned stay as they are.
+        """
+        values = [(d, k, n, json.dumps(v), exp) for d, k, n, v, exp in rows]
+        removed = list(removed)
+
+        def work(cur: sqlite3.Cursor) -> None:
+            cur.executemany(
+                "INSERT INTO device_state (device, kind, name, value, expires_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(device, kind, name) DO UPDATE SET "
+                "value = excluded.value, expires_at = excluded.expires_at",
+                values,
+            )
+            cur.executemany("DELETE FROM device_state WHERE device = ? AND kind = ? AND name = ?", removed)
+
+        self._write(work)
+
+    def loadDeviceState(self) -> List[Tuple[str, str, str, Any, Optional[float]]]:
+        """
+        Return the stored device_state snapshot as (device, kind, name, value, expires_at) rows.
         """
         cur = self.conn.cursor()
-        cur.execute("INSERT INTO users (mac, ser) VALUES (?, ?)", (mac, ser))
-        self.conn.commit()
+        cur.execute("SELECT device, kind, name, value, expires_at FROM device_state")
+        return [(r["device"], r["kind"], r["name"], json.loads(r["value"]), r["expires_at"]) for r in cur.fetchall()]
+
+    def setDeviceCommand(self, device: str, command: str, expires_at: Optional[float]) -> None:
+        """
+        Store (or refresh) a pending command in device_state.
+        """
+        self._write(lambda cur: cur.execute(
+            "INSERT OR REPLACE INTO device_state (device, kind, name, value, expires_at) "
+            "VALUES (?, 'command', ?, 'null', ?)",
+            (device, command, expires_at),
+        ))
 
-    def addLetter(self, serial_number: str, time: str) -> None:
+    def consumeDeviceCommand(self, device: str, command: str, now: float) -> bool:
         """
-        Add a letter entry to the table associated with the given serial number.
+        Atomically remove a pending, unexpired command; True if this call got it.
+        A single DELETE decides, so of several processes only one can win.
+        Polls without a pending command only run a SELECT (no write lock in WAL
+        mode), so they do not queue behind letter writes.
         """
-        self._validate_table_name(serial_number)
+        cur = self.conn.execute(
+            "SELECT 1 FROM device_state WHERE device = ? AND kind = 'command' AND name = ? "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (device, command, now),
+        )
+        if cur.fetchone() is None:
+            return False
+        return self._write(lambda cur: cur.execute(
+            "DELETE FROM device_state WHERE device = ? AND kind = 'command' AND name = ? "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (device, command, now),
+        ).rowcount) == 1
+
+    def countDeviceCommands(self, now: float) -> int:
         cur = self.conn.cursor()
-        cur.execute(f'INSERT INTO "{serial_number}" (time) VALUES (?)', (time,))
-        self.conn.commit()
+        cur.execute(
+            "SELECT COUNT(*) FROM device_state WHERE kind = 'command' AND (expires_at IS NULL OR expires_at > ?)",
+            (now,),
+        )
+        return cur.fetchone()[0]
+
+    def purgeDeviceCommands(self, now: float) -> int:
+        """
+        Delete expired commands; returns how many were removed.
+        """
+        return self._write(lambda cur: cur.execute(
+            "DELETE FROM device_state WHERE kind = 'command' AND expires_at IS NOT NULL AND expires_at <= ?",
+            (now,),
+        ).rowcount)
+
+    def setDeviceState(self, device: str, name: str, value: Any) -> None:
+        value = json.dumps(value)
+        self._write(lambda cur: cur.execute(
+            "INSERT OR REPLACE INTO device_state (device, kind, name, value, expires_at) "
+            "VALUES (?, 'state', ?, ?, NULL)",
+            (device, name, value),
+        ))
+
+    def getDeviceState(self, device: str, name: str) -> Tuple[bool, Any]:
+        """
+        Return (found, value) for a state entry.
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT value FROM device_state WHERE device = ? AND kind = 'state' AND name = ?", (device, name))
+        row = cur.fetchone()
+        return (True, json.loads(row["value"])) if row else (False, None)
+
+class ConnectionPool:
+    """
+    Pool of long-lived SQLite connections owned by the application.
+
+    Connections are opened lazily, configured once (see PRAGMAS) and reused
+    across requests. Up to max_idle connections are kept; extra connections
+    opened under burst load are closed when they are returned.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_idle: int = 8,
+                 serial_cache: Optional[SerialCache] = None,
+                 recent_letters: Optional[RecentLetters] = None) -> None:
+        self.db_path = db_path or default_db_path()
+        # Shared by all handlers of this pool (see SerialCache, RecentLetters)
+        self.serial_cache = serial_cache
+        self.recent_letters = recent_letters
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=max_idle)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+
+    def init_schema(self) -> None:
+        """
+        Create the schema once at application startup.
+        """
+        with self.handler() as db:
+            db.create_schema()
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.db_path)
+            with self._lock:
+                self.created += 1
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+            with self._lock:
+                self.created -= 1
+
+    @contextmanager
+    def handler(self) -> Iterator[DatabaseHandler]:
+        """
+        Borrow a connection wrapped in a DatabaseHandler for one unit of work.
+        """
+        conn = self.acquire()
+        try:
+            yield DatabaseHandler(self.db_path, conn=conn, serial_cache=self.serial_cache,
+                                  recent_letters=self.recent_letters)
+        finally:
+            self.release(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"created": self.created, "in_use": self.in_use, "idle": self._idle.qsize()}
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.created -= 1
+
+
+class LetterWriter:
+    """
+    Optional write-behind queue for letter inserts (group commit).
+
+    A background thread drains a bounded queue and commits all queued
+    inserts together: up to max_batch rows, waiting at most max_delay
+    seconds for more (0 = commit whatever piled up during the previous
+    commit). submit() returns a Future that resolves once the
+    row is committed; callers that do not need the durable ack can ignore it.
+    If a commit fails, every future of the batch gets the exception and the
+    thread carries on with the next batch.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_batch: int = 500,
+                 max_delay: float = 0.0, queue_size: int = 10000,
+                 recent_letters: Optional[RecentLetters] = None) -> None:
+        self.db_path = db_path or default_db_path()
+        self.recent_letters = recent_letters
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.rows = 0
+        self.failed = 0
+
+    def start(self) -> "LetterWriter":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="letter-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Flush everything queued so far and stop the writer thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, serial_number: str, time: Any = None, event_id: Optional[str] = None) -> "Future[bool]":
+        """
+        Queue one letter; blocks only while the queue is full.
+        The future resolves to False if event_id was already stored for the device.
+        """
+        if self._thread is None:
+            raise RuntimeError("LetterWriter is not running")
+        future: "Future[bool]" = Future()
+        self._queue.put((letter_row(serial_number, time) + (event_id,), future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        conn = connect(self.db_path)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[tuple]) -> None:
+        try:
+            handler = DatabaseHandler(self.db_path, conn=conn, recent_letters=self.recent_letters)
+            # One statement per row (still one commit) to know which rows were duplicates
+            inserted = handler.addLetters([(row[0], row[2], row[3]) for row, _ in batch])
+        except Exception as exc:
+            log.error("letter batch failed", extra={"rows": len(batch)}, exc_info=exc)
+            for _, future in batch:
+                future.set_exception(exc)
+            self.failed += len(batch)
+            return
+        self.batches += 1
+        self.rows += sum(inserted)
+        for (_, future), ok in zip(batch, inserted):
+            future.set_result(ok)
+
 
 # Example usage (for quick manual testing; remove when used as a module):
 if __name__ == "__main__":
     db = DatabaseHandler()
     try:
-        db.create_user_table("00:11:22:33:44:55", "SN123456")
-        db.create_letter_table("SN123456")
+        db.addUser("00:11:22:33:44:55", "SN123456")
+        db.addLetter("SN123456")
     finally:
         db.close()
\ No newline at end of file
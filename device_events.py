@@ -0,0 +1,274 @@
+"""Ereignis-Pipeline des Geräts.
+
+lgpio-Callbacks legen Ereignisse (Brief eingeworfen, Klappe offen/zu) nur
+in eine Queue und kehren sofort zurück. Ein Worker-Thread schreibt sie in
+ein lokales Journal (SQLite) und lädt sie von dort über eine einzige
+Keep-Alive-requests.Session zur API hoch: Briefe gesammelt über /new_letters,
+Klappen-Ereignisse einzeln in der richtigen Reihenfolge. Ist die API nicht
+erreichbar, bleiben die Ereignisse im Journal und der Upload wird mit
+exponentiellem Backoff wiederholt; bestätigte Ereignisse werden gelöscht.
+
+Der Zeitstempel eines Briefs kommt aus dem lgpio-'tick' der Flanke, nicht
+aus dem Zeitpunkt des Uploads. Jedes Ereignis bekommt beim Einreihen eine
+zufällige event_id, die im Journal gespeichert und bei jedem Upload-Versuch
+mitgeschickt wird: wiederholte Uploads erkennt der Server als Duplikate.
+"""
+import collections
+import datetime
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+log = logging.getLogger("briefkasten.events")
+
+# Pfad pro Klappen-Ereignis (Briefe werden gesammelt über /new_letters gemeldet)
+ROUTES = {
+    "open": "/open",
+    "close": "/close",
+}
+
+
+def retry_after_seconds(response):
+    """Wartezeit aus dem Retry-After-Header einer 429/503-Antwort (Sekunden, 0 falls keiner)."""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", 0)))
+    except ValueError:
+        return 0.0
+
+
+def tick_to_datetime(tick):
+    """Rechnet einen lgpio-tick (ns) in eine UTC-Zeit um.
+
+    Je nach Kernel zählt der tick ab 1970 oder ab Systemstart (CLOCK_MONOTONIC).
+    """
+    now_ns = time.time_ns()
+    if abs(now_ns - tick) < 3600 * 10**9:
+        epoch_ns = tick
+    else:
+        epoch_ns = now_ns - (time.monotonic_ns() - tick)
+    return datetime.datetime.fromtimestamp(epoch_ns / 1e9, datetime.timezone.utc)
+
+
+def default_journal_path():
+    """Journal neben diesem Modul, überschreibbar mit BRIEFKASTEN_JOURNAL."""
+    return os.environ.get("BRIEFKASTEN_JOURNAL") or os.path.join(os.path.dirname(__file__), "events.db")
+
+
+class Event:
+    __slots__ = ("kind", "time", "queued_ns", "event_id")
+
+    def __init__(self, kind, tick=None):
+        self.kind = kind
+        self.event_id = uuid.uuid4().hex
+        if tick is None:
+            self.time = datetime.datetime.now(datetime.timezone.utc)
+        else:
+            self.time = tick_to_datetime(tick)
+        self.queued_ns = time.perf_counter_ns()
+
+
+class EventJournal:
+    """Append-only Journal der noch nicht bestätigten Ereignisse (lokale SQLite-Datei)."""
+
+    def __init__(self, path=None):
+        self.path = path or default_journal_path()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        # auto_vacuum muss vor dem Anlegen der Tabelle gesetzt werden
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, time TEXT NOT NULL, event_id TEXT)"
+        )
+        if "event_id" not in [row[1] for row in self.conn.execute("PRAGMA table_info(events)")]:
+            self.conn.execute("ALTER TABLE events ADD COLUMN event_id TEXT")
+        self.conn.commit()
+
+    def append(self, events):
+        """Schreibt Ereignisse in einer Transaktion; gibt die vergebenen ids zurück."""
+        ids = []
+        with self.conn:
+            for event in events:
+                cur = self.conn.execute("INSERT INTO events (kind, time, event_id) VALUES (?, ?, ?)",
+                                        (event.kind, event.time.isoformat(), event.event_id))
+                ids.append(cur.lastrowid)
+        return ids
+
+    def pending(self, limit):
+        """Die ältesten noch nicht bestätigten Ereignisse als (id, kind, time, event_id)."""
+        return self.conn.execute("SELECT id, kind, time, event_id FROM events ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def ack(self, last_id):
+        """Löscht alle Ereignisse bis einschließlich last_id und gibt freien Platz zurück."""
+        with self.conn:
+            self.conn.execute("DELETE FROM events WHERE id <= ?", (last_id,))
+        self.conn.execute("PRAGMA incremental_vacuum")
+
+    def close(self):
+        self.conn.close()
+
+
+class EventPipeline:
+    """Queue + Worker: Ereignisse werden journalisiert und gesammelt hochgeladen."""
+
+    def __init__(self, api, serial_number, maxsize=1000, session=None, timeout=5,
+                 journal=None, batch_size=100, backoff_max=60):
+        self.api = api
+        self.serial_number = serial_number
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.journal = journal or EventJournal()
+        self.batch_size = batch_size
+        self.backoff_max = backoff_max
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._thread = None
+        self._queued_ns = {}
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        # Zeit vom Einreihen bis zur Antwort der API (ms), letzte 1000 Ereignisse
+        self.latencies_ms = collections.deque(maxlen=1000)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="event-pipeline", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Journalisiert die Queue, versucht einen letzten Upload und beendet den Worker."""
+        if self._thread is not None:
+            self._stop.set()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, kind, tick=None):
+        """Reiht ein Ereignis ein, ohne zu blockieren (aus lgpio-Callbacks aufrufbar)."""
+        try:
+            self._queue.put_nowait(Event(kind, tick))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def pending(self):
+        return self._queue.qsize() + self.journal.count()
+
+    def _drain(self, timeout):
+        """Holt Ereignisse aus der Queue ins Journal; wartet höchstens timeout Sekunden auf das erste."""
+        events = []
+        try:
+            event = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+            while True:
+                if event is not None:
+                    events.append(event)
+                event = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        if events:
+            for row_id, event in zip(self.journal.append(events), events):
+                self._queued_ns[row_id] = event.queued_ns
+
+    def _post(self, path, payload):
+        response = self.session.post(f"{self.api}{path}", json=payload, timeout=self.timeout)
+        if response.status_code == 429:
+            # Vom Server gedrosselt: Ereignisse bleiben im Journal, erneut nach Retry-After
+            response.raise_for_status()
+        if 400 <= response.status_code < 500:
+            # Vom Server abgelehnt: erneutes Senden hilft nicht, Ereignis verwerfen
+            log.warning("Ereignis abgelehnt", extra={"path": path, "http_status": response.status_code,
+                                                     "response": response.text})
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def _acked(self, rows):
+        now = time.perf_counter_ns()
+        for row in rows:
+            queued_ns = self._queued_ns.pop(row[0], None)
+            if queued_ns is not None:
+                self.latencies_ms.append((now - queued_ns) / 1e6)
+        self.journal.ack(rows[-1][0])
+        self.sent += len(rows)
+
+    def upload(self):
+        """Lädt das Journal hoch (Briefe gesammelt, Klappen-Ereignisse einzeln).
+
+        Wirft requests.RequestException, wenn die API nicht erreichbar ist.
+        """
+        while True:
+            rows = self.journal.pending(self.batch_size)
+            if not rows:
+                return
+            letters = []
+            for row in rows:
+                if row[1] != "letter":
+                    break
+                letters.append(row)
+            if letters:
+                result = self._post("/new_letters", [
+                    {"serial_number": self.serial_number, "time": t, "event_id": event_id}
+                    for _, _, t, event_id in letters
+                ])
+                log.info("Briefe gemeldet", extra={"letters": len(letters), "added": result and result.get("added")})
+                self._acked(letters)
+            else:
+                _, kind, t, _ = rows[0]
+                result = self._post(ROUTES[kind], {"serial_number": self.serial_number, "time": t})
+                log.info("Ereignis gemeldet", extra={"kind": kind, "time": t, "result": result})
+                self._acked(rows[:1])
+
+    def _run(self):
+        fehler = 0
+        while True:
+            self._drain(None if fehler else 1.0)
+            try:
+                self.upload()
+                fehler = 0
+            except requests.RequestException as e:
+                fehler += 1
+                self.failed += 1
+                # Exponentieller Backoff mit Jitter; Ereignisse bleiben im Journal
+                delay = min(self.backoff_max, 2 ** fehler) * random.uniform(0.5, 1.0)
+                if e.response is not None:
+                    delay = max(delay, retry_after_seconds(e.response))
+                log.warning("Upload fehlgeschlagen", extra={"retry_in_s": round(delay, 1), "error": str(e)})
+                if self._stop.wait(delay):
+                    self._drain(None)
+                    break
+            if self._stop.is_set():
+                self._drain(None)
+                try:
+                    self.upload()
+                except requests.RequestException:
+                    pass
+                break
+
+    def stats(self):
+        latencies = sorted(self.latencies_ms)
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else None
+
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "pending": self.pending(),
+            "latency_ms_p50": pct(50),
+            "latency_ms_p95": pct(95),
+            "latency_ms_max": latencies[-1] if latencies else None,
+        }
@@ -0,0 +1,278 @@
+"""
+Per-device command and state store.
+
+Replaces the global entriegeln/offen flags in api.py. Entries are keyed by
+device (serial number) and spread over lock-striped shards, so devices only
+contend with the few others that hash to the same shard. Commands are
+set/consumed in O(1) and may carry a TTL; changed entries are
+snapshotted to SQLite periodically and the store is reloaded at startup.
+
+The in-memory store only works with a single server process. With several
+workers (gunicorn -w N) use SqliteDeviceStateStore, which keeps every entry
+in the shared device_state table; make_state_store() picks the backend.
+"""
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import database_handler
+
+log = logging.getLogger("briefkasten.state")
+
+_MISSING = object()
+
+
+class _Shard:
+    __slots__ = ("lock", "commands", "states", "dirty")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (device, command) -> expires_at (epoch seconds) or None
+        self.commands: Dict[Tuple[str, str], Optional[float]] = {}
+        # (device, name) -> value
+        self.states: Dict[Tuple[str, str], Any] = {}
+        # (device, kind, name) changed since the last snapshot
+        self.dirty: Set[Tuple[str, str, str]] = set()
+
+    def take_dirty(self) -> Tuple[List[Tuple[str, str, str, Any, Optional[float]]], List[Tuple[str, str, str]]]:
+        """
+        Current rows of the dirty keys and the keys that were removed; clears
+        the dirty set. Caller holds the lock.
+        """
+        rows, removed = [], []
+        for device, kind, name in self.dirty:
+            if kind == "command":
+                if (device, name) in self.commands:
+                    rows.append((device, kind, name, None, self.commands[(device, name)]))
+                    continue
+            elif (device, name) in self.states:
+                rows.append((device, kind, name, self.states[(device, name)], None))
+                continue
+            removed.append((device, kind, name))
+        self.dirty = set()
+        return rows, removed
+
+
+class DeviceStateStore:
+    """
+    Sharded in-memory store of pending commands and current state per device.
+
+    Every change marks its key dirty under the shard lock; a snapshot writes
+    only the dirty keys, so an idle store costs nothing and a busy one only
+    the entries that actually changed.
+    """
+
+    def __init__(self, shards: int = 64) -> None:
+        self._shards = [_Shard() for _ in range(shards)]
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _shard(self, device: str) -> _Shard:
+        return self._shards[hash(device) % len(self._shards)]
+
+    def set_command(self, device: str, command: str, ttl: Optional[float] = None) -> None:
+        """
+        Store a pending command; it expires after ttl seconds (None = never).
+        """
+        shard = self._shard(device)
+        expires_at = time.time() + ttl if ttl is not None else None
+        with shard.lock:
+            shard.commands[(device, command)] = expires_at
+            shard.dirty.add((device, "command", command))
+
+    def consume_command(self, device: str, command: str) -> bool:
+        """
+        Return True and remove the command if it is pending and not expired.
+        """
+        shard = self._shard(device)
+        with shard.lock:
+            if (device, command) not in shard.commands:
+                return False
+            expires_at = shard.commands.pop((device, command))
+            shard.dirty.add((device, "command", command))
+        return expires_at is None or expires_at > time.time()
+
+    def pending_commands(self) -> int:
+        return sum(len(shard.commands) for shard in self._shards)
+
+    def set_state(self, device: str, name: str, value: Any) -> None:
+        shard = self._shard(device)
+        with shard.lock:
+            if shard.states.get((device, name), _MISSING) == value:
+                return
+            shard.states[(device, name)] = value
+            shard.dirty.add((device, "state", name))
+
+    def get_state(self, device: str, name: str, default: Any = None) -> Any:
+        shard = self._shard(device)
+        with shard.lock:
+            return shard.states.get((device, name), default)
+
+    def purge_expired(self) -> int:
+        """
+        Drop expired commands; returns how many were removed.
+        """
+        now = time.time()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                expired = [k for k, exp in shard.commands.items() if exp is not None and exp <= now]
+                for device, command in expired:
+                    del shard.commands[(device, command)]
+                    shard.dirty.add((device, "command", command))
+            removed += len(expired)
+        return removed
+
+    def rows(self) -> List[Tuple[str, str, str, Any, Optional[float]]]:
+        """
+        Flatten the store into (device, kind, name, value, expires_at) rows.
+        """
+        rows = []
+        for shard in self._shards:
+            with shard.lock:
+                rows.extend((d, "command", c, None, exp) for (d, c), exp in shard.commands.items())
+                rows.extend((d, "state", n, v, None) for (d, n), v in shard.states.items())
+        return rows
+
+    def snapshot(self, pool: database_handler.ConnectionPool) -> bool:
+        """
+        Write the entries that changed since the last snapshot to SQLite
+        (upserts for present keys, deletes for removed ones). If the write
+        fails, the keys stay dirty for the next snapshot.
+        """
+        self.purge_expired()
+        taken: List[Tuple[_Shard, Set[Tuple[str, str, str]]]] = []
+        rows: List[Tuple[str, str, str, Any, Optional[float]]] = []
+        removed: List[Tuple[str, str, str]] = []
+        for shard in self._shards:
+            with shard.lock:
+                if not shard.dirty:
+                    continue
+                taken.append((shard, shard.dirty))
+                shard_rows, shard_removed = shard.take_dirty()
+            rows.extend(shard_rows)
+            removed.extend(shard_removed)
+        if not taken:
+            return False
+        try:
+            with pool.handler() as db:
+                db.saveDeviceState(rows, removed)
+        except Exception:
+            for shard, keys in taken:
+                with shard.lock:
+                    shard.dirty |= keys
+            raise
+        return True
+
+    def load(self, pool: database_handler.ConnectionPool) -> None:
+        """
+        Restore the store from the last snapshot. Expired commands are skipped
+        and marked dirty, so the next snapshot deletes them.
+        """
+        with pool.handler() as db:
+            rows = db.loadDeviceState()
+        now = time.time()
+        for device, kind, name, value, expires_at in rows:
+            shard = self._shard(device)
+            with shard.lock:
+                if kind != "command":
+                    shard.states[(device, name)] = value
+                elif expires_at is None or expires_at > now:
+                    shard.commands[(device, name)] = expires_at
+                else:
+                    shard.dirty.add((device, kind, name))
+
+    def start_snapshots(self, pool: database_handler.ConnectionPool, interval: float = 5.0) -> None:
+        """
+        Snapshot every interval seconds in a daemon thread.
+        """
+        if self._snapshot_thread is not None:
+            return
+
+        def run() -> None:
+            while not self._stop.wait(interval):
+                try:
+                    self.snapshot(pool)
+                except Exception:
+                    log.exception("device state snapshot failed, retrying in %.1f s", interval)
+
+        self._snapshot_thread = threading.Thread(target=run, name="device-state-snapshot", daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self, pool: Optional[database_handler.ConnectionPool] = None) -> None:
+        """
+        Stop the snapshot thread; with a pool, write a final snapshot.
+        """
+        self._stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        if pool is not None:
+            self.snapshot(pool)
+
+
+class SqliteDeviceStateStore:
+    """
+    Device store backed directly by the device_state table, shared by all
+    worker processes using the same database.
+
+    Same interface as DeviceStateStore. consume_command() is a single
+    DELETE, so a command is handed out exactly once even when several
+    processes poll for it at the same time. There is nothing to snapshot:
+    load()/snapshot()/start_snapshots() only purge expired commands.
+    """
+
+    def __init__(self, pool: database_handler.ConnectionPool) -> None:
+        self.pool = pool
+
+    def set_command(self, device: str, command: str, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.pool.handler() as db:
+            db.setDeviceCommand(device, command, expires_at)
+
+    def consume_command(self, device: str, command: str) -> bool:
+        with self.pool.handler() as db:
+            return db.consumeDeviceCommand(device, command, time.time())
+
+    def pending_commands(self) -> int:
+        with self.pool.handler() as db:
+            return db.countDeviceCommands(time.time())
+
+    def set_state(self, device: str, name: str, value: Any) -> None:
+        with self.pool.handler() as db:
+            db.setDeviceState(device, name, value)
+
+    def get_state(self, device: str, name: str, default: Any = None) -> Any:
+        with self.pool.handler() as db:
+            found, value = db.getDeviceState(device, name)
+        return value if found else default
+
+    def purge_expired(self) -> int:
+        with self.pool.handler() as db:
+            return db.purgeDeviceCommands(time.time())
+
+    def snapshot(self, pool: Optional[database_handler.ConnectionPool] = None) -> bool:
+        self.purge_expired()
+        return False
+
+    def load(self, pool: Optional[database_handler.ConnectionPool] = None) -> None:
+        self.purge_expired()
+
+    def start_snapshots(self, pool: Optional[database_handler.ConnectionPool] = None, interval: float = 5.0) -> None:
+        pass
+
+    def stop_snapshots(self, pool: Optional[database_handler.ConnectionPool] = None) -> None:
+        pass
+
+
+def make_state_store(pool: database_handler.ConnectionPool, backend: str = "memory"):
+    """
+    Create the device store: 'memory' (single process, default) or 'sqlite' (multi-worker).
+    """
+    if backend == "sqlite":
+        return SqliteDeviceStateStore(pool)
+    if backend != "memory":
+        raise ValueError(f"unknown state backend {backend!r}")
+    return DeviceStateStore()
@@ -0,0 +1,124 @@
+"""Ersatz für lgpio ohne Hardware (BRIEFKASTEN_FAKE_GPIO=1).
+
+Bildet die von hw_code und servo benutzten Funktionen nach. Mit trigger()
+lassen sich Flanken auslösen; die registrierten Callbacks laufen wie bei
+lgpio in einem eigenen Thread und bekommen einen tick in Nanosekunden.
+
+Entprellung wie bei lgpio (gpio_set_debounce_micros): ein Pegelwechsel wird
+erst gemeldet, wenn der Pegel so lange stabil geblieben ist; kürzere Wechsel
+zählen in suppressed.
+"""
+import queue
+import threading
+import time
+
+SET_PULL_DOWN = 64
+RISING_EDGE = 1
+FALLING_EDGE = 2
+BOTH_EDGES = 3
+
+
+
+class error(Exception):
+    """Wie lgpio.error: wird bei Fehlern geworfen (lgpio liefert dann keinen negativen Rückgabewert)."""
+
+
+levels = {}
+suppressed = {}
+_callbacks = []
+_events = queue.Queue()
+_thread = None
+_debounce_ns = {}
+_generation = {}
+_reported = {}
+_lock = threading.Lock()
+
+
+def gpiochip_open(chip):
+    return chip
+
+
+def gpiochip_close(handle):
+    return 0
+
+
+def gpio_claim_output(handle, gpio, level=0, lFlags=0):
+    levels[gpio] = level
+    return 0
+
+
+def gpio_claim_input(handle, gpio, lFlags=0):
+    levels.setdefault(gpio, 0)
+    return 0
+
+
+def gpio_claim_alert(handle, gpio, eFlags, lFlags=0, notify_handle=None):
+    return 0
+
+
+def gpio_set_debounce_micros(handle, gpio, debounce_micros):
+    _debounce_ns[gpio] = int(debounce_micros) * 1000
+    return 0
+
+
+def gpio_write(handle, gpio, level):
+    levels[gpio] = level
+    return 0
+
+
+def gpio_read(handle, gpio):
+    return levels.get(gpio, 0)
+
+
+def tx_servo(handle, gpio, pulse_width, servo_frequency=50, pulse_offset=0, pulse_cycles=0):
+    return 0
+
+
+def _dispatch():
+    while True:
+        chip, gpio, level, tick = _events.get()
+        for cb_gpio, edge, func in list(_callbacks):
+            if cb_gpio != gpio:
+                continue
+            if edge == BOTH_EDGES or (edge == RISING_EDGE and level == 1) or (edge == FALLING_EDGE and level == 0):
+                func(chip, gpio, level, tick)
+
+
+def callback(handle, gpio, edge=RISING_EDGE, func=None):
+    global _thread
+    _callbacks.append((gpio, edge, func))
+    if _thread is None:
+        _thread = threading.Thread(target=_dispatch, name="fake-lgpio-alerts", daemon=True)
+        _thread.start()
+    return None
+
+
+def trigger(gpio, level, chip=0):
+    """Löst eine Flanke aus; tick = time.monotonic_ns() wie bei neueren Kerneln."""
+    tick = time.monotonic_ns()
+    with _lock:
+        previous = _reported.get(gpio, levels.get(gpio, 0))
+        levels[gpio] = level
+        window_ns = _debounce_ns.get(gpio, 0)
+        generation = _generation[gpio] = _generation.get(gpio, 0) + 1
+        if not window_ns:
+            _reported[gpio] = level
+            _events.put((chip, gpio, level, tick))
+            return
+        _reported.setdefault(gpio, previous)
+    timer = threading.Timer(window_ns / 1e9, _settle, (chip, gpio, level, tick, generation))
+    timer.daemon = True
+    timer.start()
+
+
+def _settle(chip, gpio, level, tick, generation):
+    """Meldet den Pegelwechsel, falls der Pegel seit tick stabil geblieben ist."""
+    with _lock:
+        if _generation.get(gpio) != generation:
+            suppressed[gpio] = suppressed.get(gpio, 0) + 1
+            return
+        if _reported.get(gpio) == level:
+            # Kurzer Ausreißer, Pegel wieder wie zuletzt gemeldet
+            return
+        _reported[gpio] = level
+    _events.put((chip, gpio, level, tick))
@@ -0,0 +1,26 @@
+"""gunicorn-Konfiguration für den Betrieb mit mehreren Worker-Prozessen.
+
+    gunicorn -c gunicorn.conf.py api:app
+
+Jeder Worker ist ein eigener Prozess mit eigenem Speicher. Entriegeln-Befehle
+und Klappenstatus müssen deshalb in der gemeinsamen SQLite-Datenbank liegen
+(BRIEFKASTEN_STATE_BACKEND=sqlite), sonst landet /entriegeln in einem Worker
+und /frage_entriegeln im anderen. Das wird hier für workers > 1 automatisch
+gesetzt; alle Worker müssen dieselbe Datenbank (BRIEFKASTEN_DB) verwenden.
+
+Umgebungsvariablen:
+- WEB_CONCURRENCY: Anzahl Worker-Prozesse (Standard 4)
+- BRIEFKASTEN_THREADS: Threads pro Worker (Long-Poll-Anfragen belegen je einen)
+- BRIEFKASTEN_BIND: Adresse (Standard 0.0.0.0:5000)
+"""
+import os
+
+bind = os.environ.get("BRIEFKASTEN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+threads = int(os.environ.get("BRIEFKASTEN_THREADS", "8"))
+worker_class = "gthread"
+# Long-Poll-Anfragen warten bis zu LONG_POLL_MAX_WAIT (60 s)
+timeout = 90
+
+if workers > 1:
+    os.environ.setdefault("BRIEFKASTEN_STATE_BACKEND", "sqlite")
@@ -1,12 +1,45 @@
-import lgpio
+import logging
+import os
+import threading
 import time
-import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
 
+if os.environ.get("BRIEFKASTEN_FAKE_GPIO") == "1":
+    import fake_lgpio as lgpio
+else:
+    import lgpio
+
+import servo
+import structured_log
+from device_events import EventPipeline
+
 # BriefkastenHW kapselt GPIO- und API-Interaktionen für den Briefkasten.
 # - steuert LEDs und Servo
 # - verarbeitet Taster- und Lichtschranken-Events
 # - kommuniziert mit einer HTTP-API (z.B. um Briefe zu melden)
+#
+# Der Import hat keine Nebenwirkungen: GPIO, Servo und API werden erst mit
+# hw.start() angesprochen. start() ist nach dem Einrichten der Callbacks
+# sofort bereit für Ereignisse; die Selbsttests (Servo, LEDs, API) laufen
+# danach parallel im Hintergrund, jeweils mit Timeout.
+
+# Zeitpunkt des Imports, Bezug für den Startzeit-Bericht
+_IMPORT_TIME = time.perf_counter()
+# Maximale Dauer je Selbsttest-Schritt (Sekunden)
+SELF_TEST_TIMEOUT = 3.0
+
+# Meldungen aus den GPIO-Callbacks gehen nur in eine Queue (siehe structured_log)
+log = logging.getLogger("briefkasten.hw")
+
+
+def parse_debounce(value):
+    """Liest Entprellzeiten im Format "pin:ms,pin:ms" (z.B. aus BRIEFKASTEN_DEBOUNCE_MS)."""
+    result = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        pin, _, ms = part.partition(":")
+        result[int(pin)] = float(ms)
+    return result
 
 class BriefkastenHW:
     """Singleton-Klasse für Briefkasten Hardware-Steuerung"""
@@ -22,16 +55,13 @@ class BriefkastenHW:
         return cls._instance
     
     def __init__(self):
-        # Initialisierung nur einmal ausführen
+        # Initialisierung nur einmal ausführen; hier nur Konfiguration, keine Hardware
         if self._initialized:
             return
-        
-        print("hw initializing...")
 
         # Gerätekennung und API-URL (lokal, zum Testen)
         self.serial_number = "SN987654"
-        self.api = "http://localhost:5000"
-
+        self.api = os.environ.get("BRIEFKASTEN_API", "http://localhost:5000")
 
         # PIN ASSIGNMENTS - BCM-Nummern
         self.LED_RED_PIN = 17
@@ -40,7 +70,68 @@ class BriefkastenHW:
         self.SERVO_PIN = 23
         self.TASTER_PIN = 24
         self.LICHTSCHRANKE_PIN = 25
-        
+
+        # Entprellung je Eingangspin in ms (0 = aus), von lgpio selbst (gpio_set_debounce_micros):
+        # ein Pegelwechsel wird erst gemeldet, wenn er so lange stabil war; kürzeres Prellen
+        # fällt ganz weg, die letzte stabile Flanke (z.B. Taster losgelassen) geht nie verloren.
+        # Überschreibbar mit BRIEFKASTEN_DEBOUNCE_MS="25:10,24:20"
+        self.debounce_ms = {self.LICHTSCHRANKE_PIN: 10, self.TASTER_PIN: 20}
+        self.debounce_ms.update(parse_debounce(os.environ.get("BRIEFKASTEN_DEBOUNCE_MS", "")))
+
+        self.h = None
+        self.session = None
+        # Zuletzt angeforderter Pegel je LED (von Callbacks/Statusanzeige), siehe _set_led
+        self._leds = {}
+        self._led_lock = threading.Lock()
+        self.events = None
+        self.started = False
+        self.startup_report = {}
+        self._start_lock = threading.Lock()
+        self._self_test_thread = None
+        self._initialized = True
+
+    def start(self, self_test=True, block=False, timeout=SELF_TEST_TIMEOUT):
+        """Beansprucht GPIO, startet die Ereignis-Pipeline und registriert die Callbacks.
+
+        Kehrt zurück, sobald Ereignisse verarbeitet werden können. Die
+        Selbsttests laufen danach parallel im Hintergrund (block=True: darauf
+        warten); das Ergebnis steht in startup_report. Mehrfache Aufrufe sind harmlos.
+        """
+        with self._start_lock:
+            if self.started:
+                return self
+            t0 = time.perf_counter()
+            structured_log.configure()
+            log.info("hw initializing...")
+
+            # Keep-Alive-Session nur für den Upload-Thread der Pipeline (requests.Session ist
+            # nicht thread-sicher); Ereignisse aus den GPIO-Callbacks werden im Hintergrund gemeldet
+            self.session = requests.Session()
+            self.events = EventPipeline(self.api, self.serial_number, session=self.session).start()
+            t_events = time.perf_counter()
+
+            self._setup_gpio()
+            t_ready = time.perf_counter()
+            self.started = True
+            self.startup_report = {
+                "events_ms": round((t_events - t0) * 1000, 1),
+                "gpio_ms": round((t_ready - t_events) * 1000, 1),
+                "ready_ms": round((t_ready - t0) * 1000, 1),
+                "ready_since_import_ms": round((t_ready - _IMPORT_TIME) * 1000, 1),
+                "self_test": None,
+            }
+            log.info("hw bereit", extra={"ready_ms": self.startup_report["ready_ms"],
+                                         "ready_since_import_ms": self.startup_report["ready_since_import_ms"]})
+
+        if self_test:
+            self._self_test_thread = threading.Thread(target=self.self_test, args=(timeout,),
+                                                      name="hw-self-test", daemon=True)
+            self._self_test_thread.start()
+            if block:
+                self._self_test_thread.join()
+        return self
+
+    def _setup_gpio(self):
         # GPIO SETUP - öffne gpiochip und beanspruche Pins
         self.h = lgpio.gpiochip_open(0)
         
@@ -53,90 +144,146 @@ class BriefkastenHW:
         # Input Pins setzen: Taster mit Pull-Down, Lichtschranke ohne Extra-Pull
         lgpio.gpio_claim_input(self.h, self.TASTER_PIN, lgpio.SET_PULL_DOWN)
         lgpio.gpio_claim_input(self.h, self.LICHTSCHRANKE_PIN)
+        # Servo-Treiber: lgpio taktet die Pulse, Software-Schleife nur als Fallback
+        self.servo = servo.make_servo(self.h, self.SERVO_PIN)
+
         # Callback-Registrierung (siehe setup_callbacks)
         self.setup_callbacks()
 
-        # Initialbewegung des Servos: kurz öffnen -> schließen, als Selbsttest
-        time.sleep(1)
+    def _self_test_servo(self):
+        # Initialbewegung des Servos in die geschlossene Position
         self.servo_close()
-        # Gelbe LED als "in Betrieb"-Anzeige
+        return True
+
+    def _self_test_leds(self):
+        # Jede LED kurz einschalten und den Pegel zurücklesen; danach den Pegel wiederherstellen,
+        # den Callbacks inzwischen angefordert haben (nicht einfach ausschalten)
+        ok = True
+        for pin in (self.LED_RED_PIN, self.LED_YELLOW_PIN, self.LED_GREEN_PIN):
+            with self._led_lock:
+                lgpio.gpio_write(self.h, pin, 1)
+            time.sleep(0.05)
+            with self._led_lock:
+                ok = ok and lgpio.gpio_read(self.h, pin) == 1
+                lgpio.gpio_write(self.h, pin, self._leds.get(pin, 0))
+        return ok
+
+    def self_test(self, timeout=SELF_TEST_TIMEOUT):
+        """Führt die Selbsttests (Servo, LEDs, API) parallel aus, jeder höchstens timeout Sekunden.
+
+        Gibt {schritt: {"ok": bool, "ms": dauer, "error": ...}} zurück; danach
+        zeigt die gelbe LED "in Betrieb", die rote einen Fehler an.
+        """
+        steps = {
+            "servo": self._self_test_servo,
+            "leds": self._self_test_leds,
+            "api": lambda: self.test_connection(timeout=timeout),
+        }
+        results = {}
+        start = time.perf_counter()
+
+        def run(name, step):
+            t = time.perf_counter()
+            try:
+                ok = bool(step())
+                results[name] = {"ok": ok, "ms": round((time.perf_counter() - t) * 1000, 1)}
+            except Exception as e:
+                results[name] = {"ok": False, "ms": round((time.perf_counter() - t) * 1000, 1), "error": str(e)}
+
+        executor = ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="hw-self-test")
+        futures = [executor.submit(run, name, step) for name, step in steps.items()]
+        wait(futures, timeout)
+        # Hängende Schritte nicht abwarten (die Threads laufen im Hintergrund aus)
+        executor.shutdown(wait=False)
+        report = {}
+        for name in steps:
+            report[name] = results.get(name) or {"ok": False, "ms": round(timeout * 1000, 1), "error": "timeout"}
+
+        # Gelbe LED als "in Betrieb"-Anzeige, bei Fehler zusätzlich LED-Rot; die übrigen
+        # LEDs gehören den Callbacks (z.B. grün nach einem Briefeinwurf während des Tests)
         self.led_yellow()
-        # Teste API-Verbindung, bei Fehler LED-Rot einschalten
-        if not self.test_connection():
-            self.led_off()
+        if not all(r["ok"] for r in report.values()):
             self.led_red()
-        self._initialized = True
+
+        self.startup_report["self_test"] = report
+        self.startup_report["self_test_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        ok = all(r["ok"] for r in report.values())
+        log.log(logging.INFO if ok else logging.WARNING, "Selbsttest", extra={"self_test": report})
+        return report
     
-    # LED-Kurzfunktionen: schreiben einfach 0/1 auf die Pins
+    # LED-Kurzfunktionen: schreiben 0/1 auf die Pins und merken sich den Pegel
+    def _set_led(self, pin, level):
+        with self._led_lock:
+            self._leds[pin] = level
+            lgpio.gpio_write(self.h, pin, level)
+
     def led_red(self):
-        lgpio.gpio_write(self.h, self.LED_RED_PIN, 1)
+        self._set_led(self.LED_RED_PIN, 1)
     
     def led_yellow(self):
-        lgpio.gpio_write(self.h, self.LED_YELLOW_PIN, 1)
+        self._set_led(self.LED_YELLOW_PIN, 1)
     
     def led_green(self):
-        lgpio.gpio_write(self.h, self.LED_GREEN_PIN, 1)
+        self._set_led(self.LED_GREEN_PIN, 1)
     
     def led_off(self):
         # Alle LEDs ausschalten
-        lgpio.gpio_write(self.h, self.LED_RED_PIN, 0)
-        lgpio.gpio_write(self.h, self.LED_YELLOW_PIN, 0)
-        lgpio.gpio_write(self.h, self.LED_GREEN_PIN, 0)
+        for pin in (self.LED_RED_PIN, self.LED_YELLOW_PIN, self.LED_GREEN_PIN):
+            self._set_led(pin, 0)
     
-    def send_servo_pulse(self, pulse_us, duration_s=0.5, period_us=20000):
-        """Sende software-gesteuerte PWM-Pulse.
+    def send_servo_pulse(self, pulse_us, duration_s=0.5, period_us=20000, blocking=True, callback=None):
+        """Sende PWM-Pulse an den Servo (über den Servo-Treiber, siehe servo.py).
         
         pulse_us: Pulsbreite in Mikrosekunden (z.B. 600..2400)
         duration_s: wie lange die Pulsfolge gesendet wird
         period_us: Periode des Servosignals (typisch 20000µs = 20ms = 50Hz)
+        blocking: False -> sofort zurückkehren, callback() nach Abschluss aufrufen
+        Bewegungen laufen in der Reihenfolge der Aufrufe (siehe servo.py).
         """
-        end = time.time() + duration_s
-        while time.time() < end:
-            lgpio.gpio_write(self.h, self.SERVO_PIN, 1)
-            time.sleep(pulse_us / 1_000_000.0)                     # High-Zeit
-            lgpio.gpio_write(self.h, self.SERVO_PIN, 0)
-            time.sleep((period_us - pulse_us) / 1_000_000.0)       # Rest der Periode
-        # Sicherstellen, dass Pin am Ende Low ist
-        lgpio.gpio_write(self.h, self.SERVO_PIN, 0)
+        return self.servo.move(pulse_us, duration_s, period_us, blocking=blocking, callback=callback)
+
+    def _moved(self, open, callback):
+        # self.open gibt die Position nach der letzten abgeschlossenen Bewegung wieder
+        def done():
+            self.open = open
+            if callback is not None:
+                callback()
+        return done
     
-    def servo_open(self):
+    def servo_open(self, blocking=True, callback=None):
         """Bewege Servo in die 'offen'-Position (Pulse-Wert anpassen falls nötig)."""
-        self.open = True
         # 1400µs ist ein Testwert; kalibrieren auf dein Servo
-        self.send_servo_pulse(1400, duration_s=0.6)
+        return self.send_servo_pulse(1400, duration_s=0.6, blocking=blocking, callback=self._moved(True, callback))
     
-    def servo_close(self):
+    def servo_close(self, blocking=True, callback=None):
         """Bewege Servo in die 'geschlossen'-Position (Pulse-Wert anpassen falls nötig)."""
-        self.open = False
         # 500µs ist ein Testwert; kalibrieren auf dein Servo
-        self.send_servo_pulse(500, duration_s=0.6)
+        return self.send_servo_pulse(500, duration_s=0.6, blocking=blocking, callback=self._moved(False, callback))
     
     # Callback-Funktionen für Taster/Lichtschranke:
     # Diese Funktionen werden von lgpio aufgerufen, wenn ein Event eintrifft.
+    # Sie dürfen nicht blockieren: Servo-Bewegungen laufen nicht-blockierend,
+    # API-Meldungen gehen über die Ereignis-Pipeline.
     def taster_offen_callback(self, chip, gpio, level, tick):
         """Handler für 'Taster offen' (z.B. losgelassen)."""
-        print("Taster gedrückt!")
         self.klappe_geoeffnet()
-        self.servo_close()
-        # Informiere API, dass Klappe geschlossen ist (Endpoint '/closed' erwartet)
-        response = requests.post(f"{self.api}/closed", json={"serial_number": self.serial_number})
+        self.servo_close(blocking=False)
+        # Informiere API, dass Klappe geschlossen ist (Endpoint '/close')
+        self.events.submit("close", tick)
 
     def taster_geschlossen_callback(self, chip, gpio, level, tick):
         """Handler für 'Taster geschlossen' (z.B. gedrückt)."""
-        print("Taster losgelassen!")
-        self.servo_open()
+        self.servo_open(blocking=False)
         self.led_off()
         self.led_yellow()
-        # Informiere API, dass Klappe offen ist (Endpoint '/open' erwartet)
-        response = requests.post(f"{self.api}/open", json={"serial_number": self.serial_number})
+        # Informiere API, dass Klappe offen ist (Endpoint '/open')
+        self.events.submit("open", tick)
     
     def lichtschranke_callback(self, chip, gpio, level, tick):
         """Handler für Lichtschranke-Unterbrechung (Briefwurf erkannt)."""
-        print("Lichtschranke unterbrochen!")
+        log.info("Lichtschranke unterbrochen", extra={"tick": tick})
         self.led_green()
-        self.brief_eingeworfen()
-        # kurze Anzeigezeit, danach ggf. ausschalten
-        time.sleep(2)
+        self.brief_eingeworfen(tick)
         #self.led_off()
 
     def taster_edge_callback(self, chip, gpio, level, tick):
@@ -146,11 +293,11 @@ class BriefkastenHW:
         """
         if level == 1:
             self.taster = True
-            print("Taster gedrückt!")
+            log.info("Taster gedrückt", extra={"tick": tick})
             self.taster_geschlossen_callback(chip, gpio, level, tick)
         else:
             self.taster = False
-            print("Taster losgelassen!")
+            log.info("Taster losgelassen", extra={"tick": tick})
             self.taster_offen_callback(chip, gpio, level, tick)
     
     def setup_callbacks(self):
@@ -158,18 +305,23 @@ class BriefkastenHW:
 
         - Lichtschranke: FALLING_EDGE (Unterbrechung)
         - Taster: BOTH_EDGES (sorgt dafür, dass sowohl drücken als auch loslassen erkannt werden)
+
+        Beide werden von lgpio entprellt (siehe debounce_ms).
         """
         # Lichtschranke bei FALLING_EDGE registrieren
         lgpio.gpio_claim_alert(self.h, self.LICHTSCHRANKE_PIN, lgpio.FALLING_EDGE)
-        
+        lgpio.gpio_set_debounce_micros(self.h, self.LICHTSCHRANKE_PIN,
+                                       int(self.debounce_ms.get(self.LICHTSCHRANKE_PIN, 0) * 1000))
+
         # Callback für Lichtschranke setzen (führt lichtschranke_callback aus)
         lgpio.callback(self.h, self.LICHTSCHRANKE_PIN, lgpio.FALLING_EDGE, self.lichtschranke_callback)
 
         # Taster: BOTH_EDGES verwenden, damit sowohl FALLING als auch RISING erkannt werden.
         # Der Callback ruft taster_edge_callback mit dem übergebenen level auf.
         lgpio.gpio_claim_alert(self.h, self.TASTER_PIN, lgpio.BOTH_EDGES)
-        lgpio.callback(self.h, self.TASTER_PIN, lgpio.BOTH_EDGES, lambda c, g, l, t: self.taster_edge_callback(c, g, l, t))
-        print("Callbacks eingerichtet.")
+        lgpio.gpio_set_debounce_micros(self.h, self.TASTER_PIN, int(self.debounce_ms.get(self.TASTER_PIN, 0) * 1000))
+        lgpio.callback(self.h, self.TASTER_PIN, lgpio.BOTH_EDGES, self.taster_edge_callback)
+        log.info("Callbacks eingerichtet")
     
     def test(self):
         """Einfacher Test-Loop, der LEDs und Servo zyklisch bewegt (für manuelle Tests)."""
@@ -188,8 +340,8 @@ class BriefkastenHW:
             time.sleep(2)
     
     def test_callbacks(self):
-        """Startet die Callback-Registrierung und hält das Programm am Leben, damit Callbacks laufen."""
-        self.setup_callbacks()
+        """Startet die Hardware (inkl. Callbacks) und hält das Programm am Leben, damit Callbacks laufen."""
+        self.start()
         try:
             while True:
                 time.sleep(1)
@@ -199,31 +351,44 @@ class BriefkastenHW:
             lgpio.gpiochip_close(self.h)
     
     def cleanup(self):
-        """Räume GPIO-Ressourcen auf (schließt gpiochip)."""
-        lgpio.gpiochip_close(self.h)
+        """Räume GPIO-Ressourcen auf (schließt gpiochip) und meldet ausstehende Ereignisse."""
+        with self._start_lock:
+            if not self.started:
+                return
+            self.events.stop()
+            lgpio.gpiochip_close(self.h)
+            self.started = False
 
 
-    def brief_eingeworfen(self):
-        """Meldet einen neuen Brief an die API mit aktuellem UTC-Timestamp."""
-        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        response = requests.post(f"{self.api}/new_letter", json={"serial_number": self.serial_number, "time": timestamp})
-        print("Brief eingeworfen:", response.json())
-        return response.json()
+    def brief_eingeworfen(self, tick=None):
+        """Meldet einen neuen Brief an die API (asynchron über die Ereignis-Pipeline).
+
+        tick: lgpio-Zeitstempel der Flanke; ohne tick wird die aktuelle UTC-Zeit verwendet.
+        """
+        return self.events.submit("letter", tick)
 
     def klappe_geoeffnet(self):
         """Interner Hook, wird aufgerufen wenn Klappe geöffnet wurde (Platzhalter)."""
-        print("Klappe wurde geöffnet.")
+        log.info("Klappe wurde geöffnet")
         return
 
-    def test_connection(self):
-        """Prüft, ob die API erreichbar ist (Endpoint /status) und gibt True/False zurück."""
-        response = requests.post(f"{self.api}/status", json={})
-        print("API Status:", response.json())
+    def test_connection(self, timeout=5):
+        """Prüft, ob die API erreichbar ist (Endpoint /status) und gibt True/False zurück.
+
+        Eigene Verbindung: läuft im Selbsttest parallel zum Upload-Thread der Pipeline.
+        """
+        try:
+            response = requests.post(f"{self.api}/status", json={}, timeout=timeout)
+        except requests.RequestException as e:
+            # Offline: Ereignisse werden im Journal gepuffert und später nachgemeldet
+            log.warning("API nicht erreichbar", extra={"error": str(e)})
+            return False
+        log.info("API Status", extra={"status": response.json()})
         status = response.status_code
         if status != 200:
-            print("Fehler bei der Verbindung zur API:", status)
+            log.warning("Fehler bei der Verbindung zur API", extra={"http_status": status})
             return False
         else:
             return True
-# Globale Instanz
-hw = BriefkastenHW()
\ No newline at end of file
+# Globale Instanz (noch ohne Hardware-Zugriff, siehe start())
+hw = BriefkastenHW()
@@ -0,0 +1,155 @@
+"""
+Migrate legacy per-serial letter tables into the shared 'letters' table.
+
+Older databases keep one table per serial number ("SN987654" with columns
+id, time). This tool streams those rows into 'letters' in small batches,
+each in its own short write transaction (BEGIN IMMEDIATE with retries, like
+the API), so the API keeps serving requests while it runs. Progress is
+stored in 'letters_migration', so an interrupted run can simply be started
+again.
+
+The test rows the old create_letter_table() inserted (CURRENT_TIMESTAMP,
+"YYYY-MM-DD HH:MM:SS" without time zone) are skipped. Rows are copied in
+timestamp order and the letter counters are rebuilt at the end. Letters get
+ids in insertion order, so run the migration before devices start sending
+to the new API; letters already stored for a device keep their lower ids.
+
+Usage:
+    python migrate_letters.py [--db PATH] [--batch-size N] [--pause S] [--keep]
+"""
+from __future__ import annotations
+import argparse
+import re
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+import database_handler
+
+
+# Wert von CURRENT_TIMESTAMP: Testzeile der alten create_letter_table(), kein Brief
+_SEED_TIME = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+
+_RESERVED = {"users", "letters", "letters_migration", "letter_counters", "letter_daily", "device_state", "meta"}
+
+
+def find_legacy_tables(conn: sqlite3.Connection) -> List[str]:
+    """
+    Return the names of all per-serial letter tables (columns: id, time).
+    """
+    cur = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )
+    tables = []
+    for row in cur.fetchall():
+        name = row["name"]
+        if name in _RESERVED or not database_handler._VALID_NAME.match(name):
+            continue
+        columns = [c["name"] for c in conn.execute(f'PRAGMA table_info("{name}")')]
+        if columns == ["id", "time"]:
+            tables.append(name)
+    return tables
+
+
+def legacy_row(serial: str, value: Optional[str]) -> Tuple[str, Optional[str], Optional[int]]:
+    """
+    Normalize a legacy timestamp; unparseable values are kept as text with ts NULL.
+    """
+    try:
+        return database_handler.letter_row(serial, value) if value is not None else (serial, None, None)
+    except ValueError:
+        return serial, value, None
+
+
+def is_seed_row(value: Optional[str]) -> bool:
+    """
+    True for the CURRENT_TIMESTAMP test rows of the legacy tables.
+    """
+    return value is not None and _SEED_TIME.fullmatch(value) is not None
+
+
+def migrate_table(db: database_handler.DatabaseHandler, serial: str, batch_size: int = 500,
+                  pause: float = 0.0) -> int:
+    """
+    Copy the rows of one legacy table into 'letters', oldest timestamp first
+    (unparseable times before all others). Returns the number of rows copied.
+    Each batch and its progress marker are committed together (exactly-once).
+    """
+    conn = db.conn
+    row = conn.execute("SELECT last_key, last_id FROM letters_migration WHERE serial = ?", (serial,)).fetchone()
+    last_key, last_id = (row["last_key"], row["last_id"]) if row else (-1.0, 0)
+    copied = 0
+    while True:
+        rows = conn.execute(
+            f'SELECT id, time, COALESCE(julianday(time), 0) AS key FROM "{serial}" '
+            "WHERE (COALESCE(julianday(time), 0), id) > (?, ?) ORDER BY 3, id LIMIT ?",
+            (last_key, last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        last_key, last_id = rows[-1]["key"], rows[-1]["id"]
+        letters = [legacy_row(serial, r["time"]) for r in rows if not is_seed_row(r["time"])]
+
+        def work(cur: sqlite3.Cursor) -> None:
+            cur.executemany("INSERT INTO letters (serial, time, ts) VALUES (?, ?, ?)", letters)
+            cur.execute(
+                "INSERT INTO letters_migration (serial, last_key, last_id) VALUES (?, ?, ?) "
+                "ON CONFLICT(serial) DO UPDATE SET last_key = excluded.last_key, last_id = excluded.last_id",
+                (serial, last_key, last_id),
+            )
+
+        db._write(work)
+        copied += len(letters)
+        if pause:
+            # Lässt wartenden API-Schreibzugriffen den Vortritt
+            time.sleep(pause)
+    return copied
+
+
+def migrate(db_path: Optional[str] = None, batch_size: int = 500, pause: float = 0.0, drop: bool = True) -> int:
+    """
+    Migrate every legacy table. Tables are dropped after a complete copy unless drop is False.
+    """
+    conn = database_handler.connect(db_path)
+    try:
+        db = database_handler.DatabaseHandler(db_path, conn=conn)
+        db.create_schema()
+
+        def create_progress(cur: sqlite3.Cursor) -> None:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS letters_migration "
+                "(serial TEXT PRIMARY KEY, last_key REAL NOT NULL, last_id INTEGER NOT NULL)"
+            )
+
+        db._write(create_progress)
+        total = 0
+        for serial in find_legacy_tables(conn):
+            copied = migrate_table(db, serial, batch_size, pause)
+            total += copied
+            print(f"{serial}: {copied} rows migrated")
+            if drop:
+                def finish(cur: sqlite3.Cursor) -> None:
+                    cur.execute(f'DROP TABLE "{serial}"')
+                    cur.execute("DELETE FROM letters_migration WHERE serial = ?", (serial,))
+
+                db._write(finish)
+        if total:
+            db.rebuildLetterCounters()
+        return total
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default=None, help="database file (default: briefkasten.db)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.01, help="seconds to sleep between batches")
+    parser.add_argument("--keep", action="store_true", help="keep legacy tables after migrating")
+    args = parser.parse_args()
+    total = migrate(args.db, args.batch_size, args.pause, drop=not args.keep)
+    print(f"done, {total} rows migrated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Admission control: per-device token buckets and a concurrency cap.
+
+TokenBucketLimiter keeps one bucket per key (serial number or MAC address)
+in an LRU-ordered dict. acquire() refills the bucket from the time since its
+last use and takes a token in O(1); if the bucket is empty it returns the
+seconds until the next token instead. Buckets idle long enough to be full
+again are indistinguishable from new ones and are evicted from the cold end
+on every call, so memory follows the number of recently active devices.
+
+ConcurrencyLimit caps how many requests may run a section at once (the
+DB-writing routes); try_acquire() waits at most a short moment for a slot.
+
+Both only touch memory. Limits apply per process: with N workers a device
+may send up to N times the configured rate.
+"""
+from __future__ import annotations
+import collections
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+def parse_rate(value: str) -> Optional[Tuple[float, float]]:
+    """Parse "rate:burst" (tokens per second, bucket size); "0" or "" disables the limit."""
+    rate, _, burst = value.strip().partition(":")
+    if not rate or float(rate) <= 0:
+        return None
+    return float(rate), float(burst) if burst else max(1.0, float(rate))
+
+
+class _Bucket:
+    __slots__ = ("tokens", "last")
+
+    def __init__(self, tokens: float, last: float) -> None:
+        self.tokens = tokens
+        self.last = last
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets with idle eviction."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # After this long without requests a bucket is full again
+        self.idle_seconds = burst / rate
+        self._clock = clock
+        self._buckets: "collections.OrderedDict[str, _Bucket]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+
+    def acquire(self, key: str, cost: float = 1.0) -> float:
+        """
+        Take cost tokens from the bucket of key. Returns 0.0 if the request
+        is admitted, otherwise the seconds until enough tokens are available.
+        """
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last) * self.rate)
+                bucket.last = now
+                self._buckets.move_to_end(key)
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                self.allowed += 1
+                retry_after = 0.0
+            else:
+                self.limited += 1
+                retry_after = (cost - bucket.tokens) / self.rate
+            self._evict(now)
+        return retry_after
+
+    def _evict(self, now: float) -> None:
+        # Oldest first: stop at the first bucket that is still in use
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket.last < self.idle_seconds and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"buckets": len(self._buckets), "allowed": self.allowed,
+                    "limited": self.limited, "evictions": self.evictions}
+
+
+class ConcurrencyLimit:
+    """At most limit holders at a time; callers wait up to wait seconds for a slot."""
+
+    def __init__(self, limit: int, wait: float = 0.0) -> None:
+        self.limit = limit
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        if self._slots.acquire(timeout=self.wait) if self.wait else self._slots.acquire(blocking=False):
+            with self._lock:
+                self.active += 1
+            return True
+        with self._lock:
+            self.rejected += 1
+        return False
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"limit": self.limit, "active": self.active, "rejected": self.rejected}
@@ -0,0 +1,54 @@
+"""
+Rebuild the per-device 'letter_counters' table from the raw letters.
+
+The counters (count, last letter id/time, unread) are normally kept up to
+date by triggers in the same transaction as every insert and delete. Use
+this tool after manual edits to 'letters' or to check that the counters
+still match: with --check it only reports the devices that differ.
+
+Usage:
+    python rebuild_counters.py [--db PATH] [--check]
+"""
+from __future__ import annotations
+import argparse
+from typing import List
+
+import database_handler
+
+
+def find_drift(db: database_handler.DatabaseHandler) -> List[str]:
+    """
+    Return the serial numbers whose counters differ from the letters table
+    (count, unread, newest id or newest timestamp).
+    """
+    cur = db.conn.execute("""
+    WITH agg AS (SELECT serial, COUNT(*) AS count, MAX(id) AS last_id, MAX(ts) AS last_ts
+                 FROM letters GROUP BY serial)
+    SELECT agg.serial FROM agg LEFT JOIN letter_counters c ON c.serial = agg.serial
+    WHERE c.serial IS NULL OR c.count != agg.count OR c.last_id < agg.last_id
+       OR c.last_ts < agg.last_ts OR (c.last_ts IS NULL AND agg.last_ts IS NOT NULL)
+       OR c.unread != (SELECT COUNT(*) FROM letters l WHERE l.serial = agg.serial AND l.id > c.read_id)
+    UNION
+    SELECT c.serial FROM letter_counters c LEFT JOIN agg ON agg.serial = c.serial
+    WHERE agg.serial IS NULL AND c.count != 0
+    ORDER BY 1
+    """)
+    return [row[0] for row in cur.fetchall()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default=None, help="database file (default: briefkasten.db)")
+    parser.add_argument("--check", action="store_true", help="only report devices whose counters differ")
+    args = parser.parse_args()
+    with database_handler.DatabaseHandler(args.db) as db:
+        drift = find_drift(db)
+        if args.check:
+            print(f"{len(drift)} device(s) with stale counters" + (": " + ", ".join(drift) if drift else ""))
+            return
+        db.rebuildLetterCounters()
+    print(f"done, counters rebuilt ({len(drift)} device(s) were stale)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Servo-Treiber für den Briefkasten.
+
+Backends:
+- LgpioServo: Pulse werden von lgpio (tx_servo) im Hintergrund getaktet,
+  Python schläft nur noch bis zum Ende der Bewegung (Standard).
+- SoftwareServo: die alte Schleife mit gpio_write + time.sleep (Fallback).
+- SimulatedServo: wie SoftwareServo, schreibt aber keine Pins, sondern zeichnet
+  die Flanken auf, damit die Puls-Genauigkeit ohne Hardware gemessen werden kann.
+
+Alle Backends führen Bewegungen in einem Worker-Thread pro Servo aus, streng in der
+Reihenfolge der Aufrufe (FIFO). move(..., blocking=False, callback=...) stellt die
+Bewegung nur in die Warteschlange, der Aufrufer (z.B. ein lgpio-Callback) wird nicht blockiert.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    if os.environ.get("BRIEFKASTEN_FAKE_GPIO") == "1":
+        import fake_lgpio as lgpio
+    else:
+        import lgpio
+except ImportError:  # z.B. auf Entwicklungsrechnern ohne lgpio
+    lgpio = None
+
+log = logging.getLogger("briefkasten.servo")
+
+
+class ServoDriver:
+    """Basisklasse: Bewegungen laufen nacheinander in einem Worker-Thread (FIFO-Warteschlange)."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def _pulse(self, pulse_us, duration_s, period_us):
+        raise NotImplementedError
+
+    def _run(self):
+        while True:
+            pulse_us, duration_s, period_us, callback, future = self._queue.get()
+            try:
+                self._pulse(pulse_us, duration_s, period_us)
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                log.error("Servo-Bewegung fehlgeschlagen", extra={"pulse_us": pulse_us}, exc_info=e)
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+    def move(self, pulse_us, duration_s=0.5, period_us=20000, blocking=True, callback=None):
+        """Sende Servo-Pulse mit pulse_us Pulsbreite für duration_s Sekunden.
+
+        Die Bewegung beginnt, wenn alle vorher angeforderten abgeschlossen sind.
+        blocking=False: kehrt sofort zurück und gibt ein Future der Bewegung zurück;
+        callback() wird nach Abschluss (im Worker-Thread) aufgerufen und darf selbst
+        nicht blockierend auf eine Bewegung warten.
+        """
+        future = Future()
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="servo", daemon=True)
+                self._worker.start()
+        self._queue.put((pulse_us, duration_s, period_us, callback, future))
+        if blocking:
+            future.result()
+            return None
+        return future
+
+
+class LgpioServo(ServoDriver):
+    """Servo-Pulse über lgpio.tx_servo, getaktet von lgpio statt von Python."""
+
+    def __init__(self, handle, gpio, fallback=None):
+        super().__init__()
+        self.handle = handle
+        self.gpio = gpio
+        self.fallback = fallback
+
+    def _pulse(self, pulse_us, duration_s, period_us):
+        frequency = round(1_000_000 / period_us)
+        cycles = max(1, round(duration_s * frequency))
+        # lgpio wirft bei Fehlern lgpio.error; ältere Versionen liefern einen negativen Statuswert
+        try:
+            status = lgpio.tx_servo(self.handle, self.gpio, pulse_us, frequency, 0, cycles)
+        except lgpio.error:
+            status = -1
+        if status < 0:
+            if self.fallback is None:
+                raise RuntimeError("lgpio.tx_servo failed")
+            self.fallback._pulse(pulse_us, duration_s, period_us)
+            return
+        # lgpio sendet die Pulse selbst; nur bis zum Ende der Bewegung warten
+        time.sleep(cycles / frequency)
+
+
+class SoftwareServo(ServoDriver):
+    """Software-PWM: write(level) wird im Takt von time.sleep aufgerufen."""
+
+    def __init__(self, write):
+        super().__init__()
+        self.write = write
+
+    def _pulse(self, pulse_us, duration_s, period_us):
+        end = time.time() + duration_s
+        while time.time() < end:
+            self.write(1)
+            time.sleep(pulse_us / 1_000_000.0)                     # High-Zeit
+            self.write(0)
+            time.sleep((period_us - pulse_us) / 1_000_000.0)       # Rest der Periode
+        # Sicherstellen, dass Pin am Ende Low ist
+        self.write(0)
+
+
+class SimulatedServo(SoftwareServo):
+    """Zeichnet (zeitpunkt_ns, level) jeder Flanke auf, statt Pins zu schreiben."""
+
+    def __init__(self):
+        super().__init__(self._record)
+        self.edges = []
+
+    def _record(self, level):
+        self.edges.append((time.perf_counter_ns(), level))
+
+    def timing(self, pulse_us, period_us=20000):
+        """Gibt Anzahl Pulse sowie mittlere/maximale Abweichung (µs) von Pulsbreite und Periode zurück."""
+        rises = [t for i, (t, level) in enumerate(self.edges)
+                 if level == 1 and (i == 0 or self.edges[i - 1][1] == 0)]
+        highs = [(t2 - t1) / 1000 for (t1, l1), (t2, l2) in zip(self.edges, self.edges[1:]) if l1 == 1 and l2 == 0]
+        periods = [(b - a) / 1000 for a, b in zip(rises, rises[1:])]
+        pulse_err = [abs(h - pulse_us) for h in highs]
+        period_err = [abs(p - period_us) for p in periods]
+        return {
+            "pulses": len(highs),
+            "pulse_error_mean_us": sum(pulse_err) / len(pulse_err) if pulse_err else 0.0,
+            "pulse_error_max_us": max(pulse_err, default=0.0),
+            "period_error_mean_us": sum(period_err) / len(period_err) if period_err else 0.0,
+            "period_error_max_us": max(period_err, default=0.0),
+        }
+
+
+def make_servo(handle, gpio, backend="lgpio"):
+    """Erzeugt den Servo-Treiber: 'lgpio' (Standard, mit Software-Fallback), 'software' oder 'simulated'."""
+    if backend == "simulated":
+        return SimulatedServo()
+    software = SoftwareServo(lambda level: lgpio.gpio_write(handle, gpio, level))
+    if backend == "lgpio" and lgpio is not None and hasattr(lgpio, "tx_servo"):
+        return LgpioServo(handle, gpio, fallback=software)
+    return software
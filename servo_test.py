@@ -0,0 +1,9 @@
+import servo
+
+# Misst die Puls-Genauigkeit der Software-PWM ohne Hardware (SimulatedServo)
+
+if __name__ == "__main__":
+    for pulse_us in (500, 1400, 2400):
+        sim = servo.make_servo(None, None, backend="simulated")
+        sim.move(pulse_us, duration_s=0.6)
+        print(pulse_us, sim.timing(pulse_us))
@@ -0,0 +1,145 @@
+"""
+Concurrency stress test for the SQLite write path.
+
+Starts N worker processes on one temporary database (like gunicorn -w N);
+each runs api.app in-process from T threads (Flask test client). Every
+thread registers its own devices and then loops over a mix of /register,
+/new_letter and /letters until the duration is up. Reports throughput, the
+status codes and latency per route, the error rate (5xx: "database is
+locked" surfacing as 500, or 503 after the write retries gave up) and the
+write retries, and checks that every acknowledged letter and registration
+is in the database.
+
+Usage:
+    python stress_db.py [--processes N] [--threads N] [--duration S]
+                        [--busy-timeout-ms MS] [--retries N]
+
+Run with --busy-timeout-ms 0 --retries 0 to see the lock errors the busy
+timeout and retries prevent. Exits with status 1 on any 5xx response or
+missing row.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+from bench_common import CONTEXT, Recorder, bench_environment, collect, device_identity, percentile, spawn
+
+# Anteile der Anfragen pro Thread (Summe 1.0)
+MIX = {
+    "/register": 0.1,
+    "/new_letter": 0.6,
+    "/letters": 0.3,
+}
+
+
+def client_loop(process, thread, client, deadline, recorder, seed):
+    rng = random.Random(seed * 1000 + thread)
+    routes, weights = zip(*MIX.items())
+    prefix, group = f"STRESS{process:03d}{thread:03d}", ((process & 0xFF) << 8) | (thread & 0xFF)
+    devices = []
+
+    def call(route, payload):
+        start = time.perf_counter()
+        status = client.post(route, json=payload).status_code
+        recorder.add(route, time.perf_counter() - start, status)
+        return status
+
+    while time.perf_counter() < deadline:
+        route = rng.choices(routes, weights)[0] if devices else "/register"
+        if route == "/register":
+            mac, serial = device_identity(len(devices), prefix, group)
+            if call(route, {"mac_address": mac, "serial_number": serial}) == 201:
+                devices.append((mac, serial))
+            continue
+        mac, serial = rng.choice(devices)
+        if route == "/new_letter":
+            call(route, {"serial_number": serial})
+        else:
+            call(route, {"mac_address": mac, "limit": 20, "order": "desc"})
+
+
+def worker(index, out, args, start_lock, go):
+    os.environ["BRIEFKASTEN_BUSY_TIMEOUT_MS"] = str(args.busy_timeout_ms)
+    os.environ["BRIEFKASTEN_WRITE_RETRIES"] = str(args.retries)
+    # Nur die Datenbank belasten: ein Schreib-Slot pro Thread, kein Log-Rauschen
+    os.environ["BRIEFKASTEN_WRITE_CONCURRENCY"] = str(args.threads)
+    os.environ["BRIEFKASTEN_LOG_LEVEL"] = "ERROR"
+    # Schema-Setup der Worker nacheinander, die Last dann gleichzeitig
+    with start_lock:
+        import api
+        import database_handler
+    out.put(("ready", index))
+    go.wait()
+
+    recorder = Recorder()
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=client_loop, args=(index, t, api.app.test_client(), deadline, recorder, index))
+        for t in range(args.threads)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out.put(("done", (recorder.state(), database_handler.lock_stats())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="client threads per process")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--busy-timeout-ms", type=int, default=5000)
+    parser.add_argument("--retries", type=int, default=3, help="write transaction retries after the busy timeout")
+    args = parser.parse_args()
+
+    db_path = bench_environment("stress.db")
+    start_lock, go = CONTEXT.Lock(), CONTEXT.Event()
+    procs, out = spawn(worker, args.processes, args, start_lock, go)
+    collect(out, args.processes, timeout=60)
+    start = time.perf_counter()
+    go.set()
+    done = [message for _, message in collect(out, args.processes, timeout=args.duration + 120)]
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.join()
+
+    recorder, locks = Recorder(), {"retries": 0, "failures": 0}
+    for state, lock_stats in done:
+        recorder.merge(state)
+        for key in locks:
+            locks[key] += lock_stats[key]
+
+    total = sum(len(values) for values in recorder.latencies.values())
+    errors = recorder.errors()
+    print(f"{args.processes} processes x {args.threads} threads, {elapsed:.1f} s, "
+          f"busy timeout {args.busy_timeout_ms} ms, {args.retries} retries")
+    print(f"{total} requests, {total / elapsed:.1f} req/s, {errors} errors ({errors / max(1, total):.2%})")
+    print(f"{'route':<14}{'req':>8}{'req/s':>10}{'5xx':>7}{'p50 ms':>10}{'p99 ms':>10}  status codes")
+    for route in MIX:
+        codes = recorder.statuses.get(route, {})
+        values = sorted(recorder.latencies.get(route, []))
+        n = len(values)
+        p50, p99 = (round((percentile(values, p) or 0) * 1000, 2) for p in (50, 99))
+        print(f"{route:<14}{n:>8}{n / elapsed:>10.1f}{recorder.errors(route):>7}{p50:>10}{p99:>10}  "
+              + ", ".join(f"{s}: {v}" for s, v in sorted(codes.items())))
+    print(f"write retries: {locks['retries']}, given up: {locks['failures']}")
+
+    conn = sqlite3.connect(db_path)
+    letters = conn.execute("SELECT COUNT(*) FROM letters").fetchone()[0]
+    users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    conn.close()
+    acked_letters = recorder.count("/new_letter", 201)
+    acked_users = recorder.count("/register", 201)
+    consistent = letters == acked_letters and users == acked_users
+    print(f"rows: {letters} letters / {acked_letters} acknowledged, {users} users / {acked_users} acknowledged"
+          f" -> {'ok' if consistent else 'MISMATCH'}")
+    sys.exit(0 if errors == 0 and consistent else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Structured, non-blocking logging.
+
+Log calls on request threads and GPIO callbacks only put the record on a
+bounded in-memory queue (QueueHandler); a single background thread
+(QueueListener) formats each record as one JSON line and writes it to
+stderr. When the queue is full the record is dropped and counted instead of
+blocking the caller.
+
+Fields passed with extra={...} become JSON keys. Records with a 'route'
+field can be sampled per route (RouteSampler): e.g. keep 1 % of the DEBUG
+records of /letters. Warnings and errors are always kept. Levels can be
+changed at runtime with set_level().
+
+Environment:
+- BRIEFKASTEN_LOG_LEVEL: level of the 'briefkasten' loggers (default INFO)
+- BRIEFKASTEN_LOG_SAMPLE: per-route sample rates, e.g. "/letters:0.01,/new_letter:0.1"
+"""
+from __future__ import annotations
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from typing import Dict, Iterable, Optional, TextIO
+
+ROOT = "briefkasten"
+QUEUE_SIZE = 10000
+
+# Attributes every LogRecord has; everything else came in through extra={...}
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def parse_sample(value: str) -> Dict[str, float]:
+    """Parse per-route sample rates in the form "route:rate,route:rate"."""
+    result = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        route, _, rate = part.rpartition(":")
+        result[route] = min(1.0, max(0.0, float(rate)))
+    return result
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg plus the extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RouteSampler(logging.Filter):
+    """Keeps only a fraction of the records below WARNING of each configured route."""
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None) -> None:
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "route", None))
+        return rate is None or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record."""
+
+    def __init__(self, q: queue.Queue) -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the args (they may change after the call); JSON formatting
+        # happens on the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_lock = threading.Lock()
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+sampler = RouteSampler()
+
+
+def configure(level: Optional[str] = None, sample: Optional[Dict[str, float]] = None,
+              loggers: Iterable[str] = (), stream: Optional[TextIO] = None) -> DroppingQueueHandler:
+    """
+    Attach the queue handler to the 'briefkasten' logger (and the given other
+    loggers, e.g. 'werkzeug') and start the writer thread. Safe to call more
+    than once; later calls only attach further loggers.
+    """
+    global _handler, _listener
+    with _lock:
+        if _handler is None:
+            q: queue.Queue = queue.Queue(QUEUE_SIZE)
+            _handler = DroppingQueueHandler(q)
+            _handler.addFilter(sampler)
+            sampler.rates.update(parse_sample(os.environ.get("BRIEFKASTEN_LOG_SAMPLE", "")))
+            writer = logging.StreamHandler(stream or sys.stderr)
+            writer.setFormatter(JsonFormatter())
+            _listener = logging.handlers.QueueListener(q, writer)
+            _listener.start()
+            atexit.register(shutdown)
+
+            root = logging.getLogger(ROOT)
+            root.addHandler(_handler)
+            root.propagate = False
+            root.setLevel(os.environ.get("BRIEFKASTEN_LOG_LEVEL", "INFO").upper())
+        if level is not None:
+            set_level(level)
+        if sample is not None:
+            sampler.rates.update(sample)
+        for name in loggers:
+            logger = logging.getLogger(name)
+            if _handler not in logger.handlers:
+                logger.addHandler(_handler)
+                logger.propagate = False
+                if logger.level == logging.NOTSET:
+                    logger.setLevel(logging.INFO)
+        return _handler
+
+
+def shutdown() -> None:
+    """Flush the queue and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def set_level(level: str, name: str = ROOT) -> None:
+    """Change the level of a logger at runtime; raises ValueError for unknown levels."""
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"unknown log level {level!r}")
+    logging.getLogger(name).setLevel(value)
+
+
+def levels() -> Dict[str, str]:
+    """Levels of the 'briefkasten' loggers that set one."""
+    result = {ROOT: logging.getLevelName(logging.getLogger(ROOT).level)}
+    for name, logger in list(logging.root.manager.loggerDict.items()):
+        if name.startswith(ROOT + ".") and isinstance(logger, logging.Logger) and logger.level:
+            result[name] = logging.getLevelName(logger.level)
+    return result
+
+
+def stats() -> Dict[str, int]:
+    """Records waiting for the writer thread and records dropped on a full queue."""
+    if _handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
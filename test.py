@@ -37,4 +37,10 @@ def get_letters():
         letters = [letters]
     return list(letters)
 
-print(len(get_letters()))
\ No newline at end of file
+def count_letters():
+    # Server zählt selbst, statt die komplette Liste zu übertragen
+    response = requests.post("http://192.168.5.1:5000/letters", json={
+        "mac_address": mac, "count_only": True})
+    return response.json().get("count", 0)
+
+print(count_letters())
\ No newline at end of file
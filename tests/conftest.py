@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Die Module liegen im Wurzelverzeichnis des Repos (kein Paket)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# api.py liest die Konfiguration beim Import: eigene Datenbank, kein Rate-Limit
+os.environ.setdefault("BRIEFKASTEN_DB", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("BRIEFKASTEN_RATE_LIMIT", "0")
+os.environ.setdefault("BRIEFKASTEN_LOG_LEVEL", "WARNING")
+os.environ.setdefault("BRIEFKASTEN_FAKE_GPIO", "1")
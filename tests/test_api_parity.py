@@ -0,0 +1,336 @@
+"""Gemeinsame Tests für beide Server: Flask (api.app) und ASGI (asgi_api.app)."""
+import asyncio
+import itertools
+import json
+import threading
+from urllib.parse import urlencode
+
+import pytest
+
+import api
+import asgi_api
+import database_handler
+import rate_limit
+
+_devices = itertools.count()
+
+
+class FlaskClient:
+    def __init__(self):
+        self.client = api.app.test_client()
+        self.headers = {}
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        self.headers = {k.lower(): v for k, v in response.headers.items()}
+        return response.status_code, response.get_json()
+
+    def get(self, path):
+        response = self.client.get(path)
+        self.headers = {k.lower(): v for k, v in response.headers.items()}
+        return response.status_code, response.get_json()
+
+    def sse_until_event(self, serial_number):
+        """Liest den SSE-Stream bis zum ersten 'entriegeln'-Event."""
+        response = self.client.get("/entriegeln/stream?" + urlencode({"serial_number": serial_number}),
+                                   buffered=False)
+        text = ""
+        chunks = response.iter_encoded()
+        try:
+            while "event: entriegeln" not in text:
+                text += next(chunks).decode()
+        finally:
+            response.close()
+        return text
+
+
+class AsgiClient:
+    """Minimaler ASGI-Client: ein Aufruf der App pro Anfrage, Antwort aus den send()-Nachrichten."""
+
+    def __init__(self):
+        self.headers = {}
+
+    async def _call(self, method, path, query=b"", body=b"", stop_on=None):
+        scope = {
+            "type": "http", "method": method, "path": path, "query_string": query,
+            "headers": [(b"content-type", b"application/json")], "http_version": "1.1", "scheme": "http",
+        }
+        disconnect = asyncio.Event()
+        sent_body = False
+        status, chunks = None, []
+
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                self.headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in message["headers"]}
+            else:
+                chunks.append(message.get("body", b""))
+                if stop_on is not None and stop_on in b"".join(chunks):
+                    disconnect.set()
+
+        await asyncio.wait_for(asgi_api.app(scope, receive, send), 20)
+        return status, b"".join(chunks)
+
+    def post(self, path, payload):
+        status, body = asyncio.run(self._call("POST", path, body=json.dumps(payload).encode()))
+        return status, json.loads(body) if body else None
+
+    def get(self, path):
+        path, _, query = path.partition("?")
+        status, body = asyncio.run(self._call("GET", path, query=query.encode()))
+        return status, json.loads(body) if body else None
+
+    def sse_until_event(self, serial_number):
+        query = urlencode({"serial_number": serial_number}).encode()
+        status, body = asyncio.run(self._call("GET", "/entriegeln/stream", query=query, stop_on=b"event: entriegeln"))
+        assert status == 200
+        return body.decode()
+
+
+@pytest.fixture(params=["flask", "asgi"])
+def client(request):
+    return FlaskClient() if request.param == "flask" else AsgiClient()
+
+
+@pytest.fixture
+def device(client):
+    """Registriert ein neues Gerät und gibt (mac, serial) zurück."""
+    n = next(_devices)
+    mac, serial = f"02:00:00:AA:{n >> 8:02X}:{n & 0xFF:02X}", f"PARITY{n:05d}"
+    status, _ = client.post("/register", {"mac_address": mac, "serial_number": serial})
+    assert status == 201
+    return mac, serial
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """Rate-Limit von 2 Anfragen pro Gerät, danach ein Token alle 2 s (in den übrigen Tests aus)."""
+    limiter = rate_limit.TokenBucketLimiter(rate=0.5, burst=2)
+    monkeypatch.setattr(api, "device_limiter", limiter)
+    return limiter
+
+
+def unlock_later(mac, delay=0.2):
+    """Entriegelt aus einem anderen Thread, während der Test auf die Antwort wartet."""
+    timer = threading.Timer(delay, lambda: api.app.test_client().post("/entriegeln", json={"mac_address": mac}))
+    timer.start()
+    return timer
+
+
+def test_status(client):
+    status, body = client.get("/status")
+    assert status == 200 and body["status"] == "ok"
+
+
+def test_register_rejects_invalid_mac(client):
+    status, body = client.post("/register", {"mac_address": "nope", "serial_number": "X"})
+    assert status == 400 and "error" in body
+
+
+def test_new_letter_and_letters(client, device):
+    mac, serial = device
+    assert client.post("/new_letter", {"serial_number": serial, "time": 1_700_000_000_000})[0] == 201
+    assert client.post("/new_letter", {"serial_number": serial, "time": 1_700_000_000_001})[0] == 201
+    status, body = client.post("/letters", {"mac_address": mac})
+    assert status == 200
+    assert [letter["ts"] for letter in body["letters"]] == [1_700_000_000_000, 1_700_000_000_001]
+    status, body = client.post("/letters", {"mac_address": "02:00:00:FF:FF:FF"})
+    assert status == 200 and body["letters"] == []
+
+
+def test_letters_limit_is_clamped_and_stream_rejects_paging(client, device):
+    mac, serial = device
+    assert client.post("/new_letter", {"serial_number": serial})[0] == 201
+    status, body = client.post("/letters", {"mac_address": mac, "limit": api.LETTERS_MAX_LIMIT + 1})
+    assert status == 200 and len(body["letters"]) == 1 and body["next_since_id"] is None
+    assert client.post("/letters", {"mac_address": mac, "stream": True, "limit": 10})[0] == 400
+    assert client.post("/letters", {"mac_address": mac, "stream": True, "order": "desc"})[0] == 400
+
+
+def test_entriegeln_is_consumed_once(client, device):
+    mac, serial = device
+    assert client.post("/frage_entriegeln", {"serial_number": serial}) == (200, {"entriegeln": False})
+    assert client.post("/entriegeln", {"mac_address": mac})[0] == 200
+    assert client.post("/frage_entriegeln", {"serial_number": serial}) == (200, {"entriegeln": True})
+    assert client.post("/frage_entriegeln", {"serial_number": serial}) == (200, {"entriegeln": False})
+
+
+def test_open_close_frage_offen(client, device):
+    mac, serial = device
+    assert client.post("/open", {"serial_number": serial})[0] == 200
+    assert client.post("/frage_offen", {"mac_address": mac}) == (200, {"offen": True})
+    assert client.post("/close", {"serial_number": serial})[0] == 200
+    assert client.post("/frage_offen", {"mac_address": mac}) == (200, {"offen": False})
+
+
+def test_open_close_accept_edge_time(client, device):
+    mac, serial = device
+    assert client.post("/open", {"serial_number": serial, "time": 1700000000000})[0] == 200
+    assert client.post("/frage_offen", {"mac_address": mac}) == (200, {"offen": True})
+    assert client.post("/close", {"serial_number": serial, "time": "2023-11-14T22:13:21Z"})[0] == 200
+    assert client.post("/close", {"serial_number": serial, "time": "yesterday"})[0] == 400
+
+
+def test_long_poll_is_woken_by_entriegeln(client, device):
+    mac, serial = device
+    timer = unlock_later(mac)
+    status, body = client.post("/frage_entriegeln", {"serial_number": serial, "wait": 10})
+    timer.join()
+    assert (status, body) == (200, {"entriegeln": True})
+
+
+def test_long_poll_times_out(client, device):
+    _, serial = device
+    assert client.post("/frage_entriegeln", {"serial_number": serial, "wait": 0.2}) == (200, {"entriegeln": False})
+
+
+def test_sse_stream_delivers_entriegeln(client, device):
+    mac, serial = device
+    timer = unlock_later(mac)
+    text = client.sse_until_event(serial)
+    timer.join()
+    assert text.startswith("retry: 5000")
+    assert 'event: entriegeln\ndata: {"entriegeln": true}' in text
+    # Der Befehl wurde vom Stream abgeholt
+    assert client.post("/frage_entriegeln", {"serial_number": serial}) == (200, {"entriegeln": False})
+
+
+def test_rate_limit_answers_429_with_retry_after(client, device, limiter):
+    _, serial = device
+    rejected = api.REJECTED.value("/frage_entriegeln", "device")
+    for _ in range(2):
+        assert client.post("/frage_entriegeln", {"serial_number": serial})[0] == 200
+    status, body = client.post("/frage_entriegeln", {"serial_number": serial})
+    assert status == 429 and body["reason"] == "device"
+    assert client.headers["retry-after"] == "2"
+    assert api.REJECTED.value("/frage_entriegeln", "device") == rejected + 1
+
+
+def test_rate_limit_applies_to_long_poll_and_sse(client, device, limiter):
+    _, serial = device
+    limiter.acquire(f"serial_number:{serial}", cost=2)
+    assert client.post("/frage_entriegeln", {"serial_number": serial, "wait": 5})[0] == 429
+    assert client.get("/entriegeln/stream?" + urlencode({"serial_number": serial}))[0] == 429
+    assert client.headers["retry-after"] == "2"
+
+
+def test_new_letters_batch_is_charged_to_every_device(client, device, limiter):
+    _, first = device
+    other = f"PARITY-BATCH{next(_devices):05d}"
+    limiter.acquire(f"serial_number:{other}", cost=2)
+    status, body = client.post("/new_letters", [{"serial_number": first}, {"serial_number": other}])
+    assert status == 429 and body["reason"] == "device"
+
+
+def test_write_concurrency_cap(client, device, monkeypatch):
+    _, serial = device
+    slots = rate_limit.ConcurrencyLimit(1)
+    monkeypatch.setattr(api, "write_slots", slots)
+    assert slots.try_acquire()
+    status, body = client.post("/open", {"serial_number": serial})
+    assert status == 429 and body["reason"] == "write_concurrency" and client.headers["retry-after"] == "1"
+    slots.release()
+    assert client.post("/open", {"serial_number": serial})[0] == 200
+    assert slots.stats()["active"] == 0
+
+
+def test_long_poll_is_counted_in_request_metrics(client, device):
+    _, serial = device
+    before = api.REQUESTS.value("/frage_entriegeln", "POST", "200")
+    assert client.post("/frage_entriegeln", {"serial_number": serial, "wait": 0.1})[0] == 200
+    assert api.REQUESTS.value("/frage_entriegeln", "POST", "200") == before + 1
+
+
+def letter_count(client, mac):
+    return client.post("/letters", {"mac_address": mac, "count_only": True})[1]["count"]
+
+
+def forget_recent_event_ids(monkeypatch):
+    """Leeres Idempotenz-Fenster, wie nach Ablauf oder auf einem anderen Worker: nur der Unique-Index bleibt."""
+    monkeypatch.setattr(api, "letter_dedup", database_handler.IdempotencyCache())
+
+
+@pytest.mark.parametrize("expired", [False, True], ids=["in-window", "after-window"])
+def test_new_letter_repeated_event_id_is_stored_once(client, device, monkeypatch, expired):
+    mac, serial = device
+    letter = {"serial_number": serial, "time": 1_700_000_000_000, "event_id": "tick-42"}
+    assert client.post("/new_letter", letter)[0] == 201
+    if expired:
+        forget_recent_event_ids(monkeypatch)
+    assert client.post("/new_letter", letter) == (200, {"status": "duplicate letter ignored"})
+    assert letter_count(client, mac) == 1
+
+
+@pytest.mark.parametrize("expired", [False, True], ids=["in-window", "after-window"])
+def test_new_letters_repeated_event_id_is_stored_once(client, device, monkeypatch, expired):
+    mac, serial = device
+    batch = [{"serial_number": serial, "event_id": "e1"}, {"serial_number": serial, "event_id": "e1"},
+             {"serial_number": serial, "event_id": "e2"}]
+    status, body = client.post("/new_letters", batch)
+    assert status == 201 and (body["added"], body["duplicates"]) == (2, 1)
+    if expired:
+        forget_recent_event_ids(monkeypatch)
+    status, body = client.post("/new_letters", batch[:1])
+    assert body["added"] == 0 and body["results"] == [{"index": 0, "status": "duplicate"}]
+    assert letter_count(client, mac) == 2
+
+
+@pytest.mark.parametrize("expired", [False, True], ids=["in-window", "after-window"])
+def test_device_sync_repeated_event_id_is_stored_once(client, device, monkeypatch, expired):
+    mac, serial = device
+    events = [{"kind": "letter", "time": 1_700_000_000_000, "event_id": "s1"}]
+    status, body = client.post("/device/sync", {"serial_number": serial, "events": events})
+    assert status == 200 and body["results"] == [{"index": 0, "status": "ok"}]
+    if expired:
+        forget_recent_event_ids(monkeypatch)
+    status, body = client.post("/device/sync", {"serial_number": serial, "events": events})
+    assert status == 200 and body["results"] == [{"index": 0, "status": "duplicate"}]
+    assert letter_count(client, mac) == 1
+
+
+def test_device_sync_mixed_events_and_command(client, device):
+    mac, serial = device
+    assert client.post("/entriegeln", {"mac_address": mac})[0] == 200
+    events = [
+        {"kind": "open", "time": 1_700_000_000_000},
+        {"kind": "letter", "time": 1_700_000_000_100, "event_id": "m1"},
+        {"kind": "letter", "time": 1_700_000_000_100, "event_id": "m1"},
+        {"kind": "wave"},
+        {"kind": "letter", "time": "yesterday"},
+        {"kind": "close", "time": "2023-11-14T22:13:21Z"},
+        {"kind": "letter", "time": 1_700_000_000_200},
+        {"kind": "open", "time": 1_700_000_000_300},
+    ]
+    status, body = client.post("/device/sync", {"serial_number": serial, "events": events})
+    assert status == 200
+    assert [r.get("status", "error") for r in body["results"]] == \
+        ["ok", "ok", "duplicate", "error", "error", "ok", "ok", "ok"]
+    assert body["commands"] == ["entriegeln"] and body["offen"] is True
+    assert letter_count(client, mac) == 2
+    assert client.post("/frage_offen", {"mac_address": mac}) == (200, {"offen": True})
+
+    # Befehl nur einmal ausgeliefert; die bekannte event_id wird abgewiesen
+    status, body = client.post("/device/sync", {"serial_number": serial, "events": [
+        {"kind": "letter", "event_id": "m1"}, {"kind": "close"}]})
+    assert status == 200 and body["commands"] == [] and body["offen"] is False
+    assert body["results"] == [{"index": 0, "status": "duplicate"}, {"index": 1, "status": "ok"}]
+    assert letter_count(client, mac) == 2
+
+
+def test_device_sync_long_poll_returns_command(client, device):
+    mac, serial = device
+    timer = unlock_later(mac)
+    status, body = client.post("/device/sync", {"serial_number": serial, "events": [{"kind": "letter"}], "wait": 10})
+    timer.join()
+    assert status == 200 and body["results"] == [{"index": 0, "status": "ok"}]
+    assert body["commands"] == ["entriegeln"]
+    assert client.post("/frage_entriegeln", {"serial_number": serial}) == (200, {"entriegeln": False})
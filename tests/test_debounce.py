@@ -0,0 +1,71 @@
+import time
+
+import fake_lgpio
+import hw_code
+
+
+def settle(hw):
+    time.sleep(hw.debounce_ms[hw.TASTER_PIN] / 1000 + 0.05)
+
+
+def test_taster_release_is_not_lost(monkeypatch):
+    hw = hw_code.BriefkastenHW()
+    seen = []
+    monkeypatch.setattr(hw, "h", 0)
+    monkeypatch.setattr(hw, "taster_geschlossen_callback", lambda *args: seen.append("pressed"))
+    monkeypatch.setattr(hw, "taster_offen_callback", lambda *args: seen.append("released"))
+    hw.setup_callbacks()
+    pin = hw.TASTER_PIN
+
+    # Prellen beim Drücken, dann stabil gedrückt und wieder losgelassen
+    for level in (1, 0, 1, 0, 1):
+        fake_lgpio.trigger(pin, level)
+    settle(hw)
+    fake_lgpio.trigger(pin, 0)
+    settle(hw)
+    assert seen == ["pressed", "released"]
+    assert hw.taster is False
+
+    # Druck kürzer als das Entprell-Fenster: weder gedrückt noch losgelassen gemeldet
+    fake_lgpio.trigger(pin, 1)
+    time.sleep(0.005)
+    fake_lgpio.trigger(pin, 0)
+    settle(hw)
+    assert seen == ["pressed", "released"]
+    assert hw.taster is False
+
+
+def fresh_hw(monkeypatch, debounce_env=None):
+    """Neue BriefkastenHW-Instanz (am Singleton vorbei), die Konfiguration wird neu gelesen."""
+    monkeypatch.setattr(hw_code.BriefkastenHW, "_instance", None)
+    if debounce_env is None:
+        monkeypatch.delenv("BRIEFKASTEN_DEBOUNCE_MS", raising=False)
+    else:
+        monkeypatch.setenv("BRIEFKASTEN_DEBOUNCE_MS", debounce_env)
+    hw = hw_code.BriefkastenHW()
+    hw.h = 0
+    return hw
+
+
+def applied_debounce(hw, monkeypatch):
+    """Ruft setup_callbacks auf und gibt die an lgpio übergebenen Entprellzeiten (µs) je Pin zurück."""
+    micros = {}
+    monkeypatch.setattr(fake_lgpio, "gpio_set_debounce_micros",
+                        lambda handle, gpio, value: micros.__setitem__(gpio, value))
+    monkeypatch.setattr(fake_lgpio, "callback", lambda *args, **kwargs: None)
+    hw.setup_callbacks()
+    return micros
+
+
+def test_setup_callbacks_applies_default_debounce(monkeypatch):
+    hw = fresh_hw(monkeypatch)
+    assert applied_debounce(hw, monkeypatch) == {
+        hw.LICHTSCHRANKE_PIN: hw.debounce_ms[hw.LICHTSCHRANKE_PIN] * 1000,
+        hw.TASTER_PIN: hw.debounce_ms[hw.TASTER_PIN] * 1000,
+    }
+    assert hw.debounce_ms == {hw.LICHTSCHRANKE_PIN: 10, hw.TASTER_PIN: 20}
+
+
+def test_debounce_env_override_reaches_lgpio(monkeypatch):
+    hw = fresh_hw(monkeypatch, "25:2.5,24:0")
+    assert applied_debounce(hw, monkeypatch) == {25: 2500, 24: 0}
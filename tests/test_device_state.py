@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+
+import pytest
+
+import database_handler
+from device_state import DeviceStateStore
+
+
+def make_pool(tmp_path):
+    pool = database_handler.ConnectionPool(str(tmp_path / "state.db"))
+    pool.init_schema()
+    return pool
+
+
+def stored(pool):
+    with pool.handler() as db:
+        return sorted((d, k, n, v) for d, k, n, v, _ in db.loadDeviceState())
+
+
+def test_snapshot_writes_only_changed_entries(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path)
+    store = DeviceStateStore()
+    store.set_state("S1", "offen", True)
+    store.set_state("S2", "offen", False)
+    store.set_command("S1", "entriegeln")
+    assert store.snapshot(pool)
+    assert stored(pool) == [("S1", "command", "entriegeln", None), ("S1", "state", "offen", True),
+                            ("S2", "state", "offen", False)]
+
+    saved = []
+    save = database_handler.DatabaseHandler.saveDeviceState
+
+    def spy(self, rows, removed=()):
+        saved.append((sorted(r[:3] for r in rows), sorted(removed)))
+        return save(self, rows, removed)
+
+    monkeypatch.setattr(database_handler.DatabaseHandler, "saveDeviceState", spy)
+
+    # Unverändert: kein Schreibzugriff
+    store.set_state("S2", "offen", False)
+    assert not store.snapshot(pool)
+    assert saved == []
+
+    assert store.consume_command("S1", "entriegeln")
+    store.set_state("S2", "offen", True)
+    assert store.snapshot(pool)
+    assert saved == [([("S2", "state", "offen")], [("S1", "command", "entriegeln")])]
+    assert stored(pool) == [("S1", "state", "offen", True), ("S2", "state", "offen", True)]
+
+
+def test_failed_snapshot_keeps_changes_dirty(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path)
+    store = DeviceStateStore()
+    store.set_state("S1", "offen", True)
+
+    def fail(self, rows, removed=()):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as m:
+        m.setattr(database_handler.DatabaseHandler, "saveDeviceState", fail)
+        with pytest.raises(sqlite3.OperationalError):
+            store.snapshot(pool)
+
+    assert store.snapshot(pool)
+    assert stored(pool) == [("S1", "state", "offen", True)]
+
+
+def test_concurrent_changes_are_all_snapshotted(tmp_path):
+    pool = make_pool(tmp_path)
+    store = DeviceStateStore(shards=4)
+    stop = threading.Event()
+
+    def snapshots():
+        while not stop.is_set():
+            store.snapshot(pool)
+
+    snapshotter = threading.Thread(target=snapshots)
+    snapshotter.start()
+    writers = [threading.Thread(target=lambda w=w: [store.set_state(f"S{w}-{i}", "offen", i)
+                                                   for i in range(200)]) for w in range(4)]
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    snapshotter.join()
+    store.snapshot(pool)
+
+    assert len(stored(pool)) == 800
+    reloaded = DeviceStateStore()
+    reloaded.load(pool)
+    assert reloaded.get_state("S3-199", "offen") == 199
+    assert not reloaded.snapshot(pool)
@@ -0,0 +1,46 @@
+import database_handler
+import rebuild_counters
+
+
+def counters(db, serial):
+    return dict(db.conn.execute("SELECT count, unread, last_time, last_ts FROM letter_counters WHERE serial = ?",
+                                (serial,)).fetchone())
+
+
+def make_db(tmp_path):
+    pool = database_handler.ConnectionPool(str(tmp_path / "letters.db"))
+    pool.init_schema()
+    return pool
+
+
+def test_mark_read_beyond_last_id_keeps_later_letters_unread(tmp_path):
+    with make_db(tmp_path).handler() as db:
+        db.addLetter("S1", 1_700_000_000_000)
+        db.addLetter("S1", 1_700_000_000_001)
+        assert db.markLettersRead("S1", 1000) == 0
+        db.addLetter("S1", 1_700_000_000_002)
+        assert counters(db, "S1")["unread"] == 1
+        assert rebuild_counters.find_drift(db) == []
+        db.rebuildLetterCounters()
+        assert counters(db, "S1")["unread"] == 1
+
+
+def test_last_time_follows_newest_timestamp_not_highest_id(tmp_path):
+    with make_db(tmp_path).handler() as db:
+        db.addLetter("S1", 1_700_000_000_000)
+        db.addLetter("S1", 1_600_000_000_000)  # nachgetragen: neue id, alte Zeit
+        row = counters(db, "S1")
+        assert row["last_ts"] == 1_700_000_000_000
+        assert row["last_time"] == database_handler.format_epoch_ms(1_700_000_000_000)
+        db.rebuildLetterCounters()
+        assert counters(db, "S1") == row
+
+
+def test_find_drift_reports_wrong_unread(tmp_path):
+    with make_db(tmp_path).handler() as db:
+        db.addLetter("S1", 1_700_000_000_000)
+        db.conn.execute("UPDATE letter_counters SET unread = 5")
+        db.conn.commit()
+        assert rebuild_counters.find_drift(db) == ["S1"]
+        db.rebuildLetterCounters()
+        assert rebuild_counters.find_drift(db) == []
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+import api
+import database_handler
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = database_handler.LetterWriter(api.db_pool.db_path).start()
+    monkeypatch.setattr(api, "letter_writer", writer)
+    yield writer
+    writer.stop()
+
+
+def failing_add_letters(self, letters):
+    raise RuntimeError("disk full")
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_writer_survives_non_sqlite_errors(writer, monkeypatch):
+    monkeypatch.setattr(database_handler.DatabaseHandler, "addLetters", failing_add_letters)
+    with pytest.raises(RuntimeError):
+        writer.submit("WRITER1", 1_700_000_000_000).result(5)
+    monkeypatch.undo()
+    assert writer.submit("WRITER1", 1_700_000_000_001).result(5) is True
+    assert writer.failed == 1
+
+
+def test_failed_queued_letter_can_be_retried(writer, monkeypatch):
+    client = api.app.test_client()
+    payload = {"serial_number": "WRITER2", "event_id": "tick-1", "durable": False}
+    with monkeypatch.context() as patch:
+        patch.setattr(database_handler.DatabaseHandler, "addLetters", failing_add_letters)
+        assert client.post("/new_letter", json=payload).status_code == 202
+        wait_for(lambda: writer.failed == 1)
+    response = client.post("/new_letter", json=dict(payload, durable=True))
+    assert response.status_code == 201
+
+
+def test_durable_wait_times_out_with_503(writer, monkeypatch):
+    def slow_add_letters(self, letters):
+        time.sleep(0.3)
+        return [True] * len(letters)
+
+    monkeypatch.setattr(database_handler.DatabaseHandler, "addLetters", slow_add_letters)
+    monkeypatch.setattr(api, "GROUP_COMMIT_TIMEOUT_SECONDS", 0.05)
+    response = api.app.test_client().post("/new_letter", json={"serial_number": "WRITER3"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
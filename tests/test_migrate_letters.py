@@ -0,0 +1,27 @@
+import sqlite3
+
+import database_handler
+import migrate_letters
+
+
+def make_legacy_db(path, times):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE SN1 (id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT)")
+    conn.executemany("INSERT INTO SN1 (time) VALUES (?)", [(t,) for t in times])
+    conn.commit()
+    conn.close()
+
+
+def test_migration_skips_seed_rows_and_copies_in_time_order(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    make_legacy_db(path, ["2025-11-18 13:01:58", "2024-06-02T12:00:00Z", "2025-11-18 14:19:12",
+                          "2024-06-01T12:00:00Z"])
+
+    assert migrate_letters.migrate(path, batch_size=1) == 2
+
+    with database_handler.DatabaseHandler(path) as db:
+        rows = db.conn.execute("SELECT id, time FROM letters ORDER BY id").fetchall()
+        assert [r["time"] for r in rows] == ["2024-06-01T12:00:00.000Z", "2024-06-02T12:00:00.000Z"]
+        counters = db.conn.execute("SELECT count, unread, last_time FROM letter_counters WHERE serial = 'SN1'").fetchone()
+        assert tuple(counters) == (2, 2, "2024-06-02T12:00:00.000Z")
+        assert migrate_letters.find_legacy_tables(db.conn) == []
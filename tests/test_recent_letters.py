@@ -0,0 +1,47 @@
+import database_handler
+
+
+def newest_ids(db, serial, version=None, limit=None):
+    return [row["id"] for row in db.getLetters(serial, limit=limit, version=version, newest_first=True)]
+
+
+def test_write_through_drops_ring_after_foreign_compaction_and_insert(tmp_path):
+    """Another process compacts and inserts between the ring load and this worker's insert."""
+    db_path = str(tmp_path / "letters.db")
+    cached = database_handler.ConnectionPool(db_path, recent_letters=database_handler.RecentLetters(per_device=32))
+    cached.init_schema()
+    other = database_handler.ConnectionPool(db_path)
+
+    with cached.handler() as db:
+        db.addLetter("S1", 1000)
+        for ms in range(2_000_000_000_000, 2_000_000_000_004):
+            db.addLetter("S1", ms)
+        assert newest_ids(db, "S1", db.getLetterVersion("S1")) == [5, 4, 3, 2, 1]
+
+    with other.handler() as db:
+        assert db.compactLetters(cutoff_ms=2000, batch_size=1) == 1
+        db.addLetter("S1", 2_000_000_000_010)
+
+    with cached.handler() as db:
+        db.addLetter("S1", 2_000_000_000_020)
+        version = db.getLetterVersion("S1")
+        from_cache = newest_ids(db, "S1", version, limit=6)
+    with other.handler() as db:
+        from_sql = newest_ids(db, "S1", limit=6)
+
+    assert from_sql == [7, 6, 5, 4, 3, 2]
+    assert from_cache == from_sql
+
+
+def test_write_through_extends_current_ring(tmp_path):
+    recent = database_handler.RecentLetters(per_device=3)
+    pool = database_handler.ConnectionPool(str(tmp_path / "letters.db"), recent_letters=recent)
+    pool.init_schema()
+    with pool.handler() as db:
+        for ms in range(1000, 1004):
+            db.addLetter("S1", ms)
+        newest_ids(db, "S1", db.getLetterVersion("S1"))
+        loads = recent.loads
+        db.addLetters([("S1", 1005), ("S1", 1006)])
+        assert newest_ids(db, "S1", db.getLetterVersion("S1"), limit=3) == [6, 5, 4]
+        assert recent.loads == loads
@@ -0,0 +1,61 @@
+import fake_lgpio
+import hw_code
+
+
+def make_hw(monkeypatch):
+    monkeypatch.setattr(hw_code.BriefkastenHW, "_instance", None)
+    hw = hw_code.BriefkastenHW()
+    hw.h = 0
+    for pin in (hw.LED_RED_PIN, hw.LED_YELLOW_PIN, hw.LED_GREEN_PIN):
+        fake_lgpio.gpio_claim_output(hw.h, pin)
+    return hw
+
+
+def test_led_test_keeps_led_set_by_callback_meanwhile(monkeypatch):
+    hw = make_hw(monkeypatch)
+    real_sleep = hw_code.time.sleep
+    calls = []
+
+    def sleep(seconds):
+        # Während die rote LED geprüft wird, meldet die Lichtschranke einen Brief
+        if not calls:
+            hw.led_green()
+        calls.append(seconds)
+        real_sleep(0)
+
+    monkeypatch.setattr(hw_code.time, "sleep", sleep)
+    assert hw._self_test_leds() is True
+    assert fake_lgpio.levels[hw.LED_GREEN_PIN] == 1
+    assert fake_lgpio.levels[hw.LED_RED_PIN] == 0
+    assert fake_lgpio.levels[hw.LED_YELLOW_PIN] == 0
+
+
+def test_self_test_only_sets_its_status_leds(monkeypatch):
+    hw = make_hw(monkeypatch)
+    monkeypatch.setattr(hw, "_self_test_servo", lambda: True)
+    monkeypatch.setattr(hw, "_self_test_leds", lambda: True)
+    monkeypatch.setattr(hw, "test_connection", lambda timeout: True)
+    hw.led_green()
+    report = hw.self_test(timeout=1)
+    assert all(step["ok"] for step in report.values())
+    assert fake_lgpio.levels[hw.LED_GREEN_PIN] == 1
+    assert fake_lgpio.levels[hw.LED_YELLOW_PIN] == 1
+    assert fake_lgpio.levels[hw.LED_RED_PIN] == 0
+
+
+def test_connection_check_does_not_use_the_pipeline_session(monkeypatch):
+    hw = make_hw(monkeypatch)
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {"status": "ok"}
+
+    class PipelineSession:
+        def post(self, *args, **kwargs):
+            raise AssertionError("self test must not share the upload thread's session")
+
+    monkeypatch.setattr(hw, "session", PipelineSession())
+    monkeypatch.setattr(hw_code.requests, "post", lambda *args, **kwargs: Response())
+    assert hw.test_connection(timeout=1) is True
@@ -0,0 +1,15 @@
+import database_handler
+
+
+def test_unknown_mac_is_found_after_registration_on_another_worker(tmp_path):
+    db_path = str(tmp_path / "users.db")
+    worker_a = database_handler.ConnectionPool(db_path, serial_cache=database_handler.SerialCache())
+    worker_a.init_schema()
+    worker_b = database_handler.ConnectionPool(db_path, serial_cache=database_handler.SerialCache())
+
+    with worker_b.handler() as db:
+        assert db.getSerialNumberByMAC("02:00:00:00:00:01") is None
+    with worker_a.handler() as db:
+        db.addUser("02:00:00:00:00:01", "S1")
+    with worker_b.handler() as db:
+        assert db.getSerialNumberByMAC("02:00:00:00:00:01") == "S1"
@@ -0,0 +1,57 @@
+import threading
+
+import fake_lgpio
+import hw_code
+import servo
+
+
+class GatedServo(servo.ServoDriver):
+    """Zeichnet die Pulsbreiten auf; die erste Bewegung wartet, bis gate gesetzt ist."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.pulses = []
+
+    def _pulse(self, pulse_us, duration_s, period_us):
+        self.gate.wait(5)
+        self.pulses.append(pulse_us)
+
+
+def test_lgpio_servo_falls_back_when_tx_servo_raises(monkeypatch):
+    def failing_tx_servo(*args):
+        raise fake_lgpio.error("GPIO not allocated")
+
+    monkeypatch.setattr(servo, "lgpio", fake_lgpio)
+    monkeypatch.setattr(fake_lgpio, "tx_servo", failing_tx_servo)
+    fallback = servo.SimulatedServo()
+    done = []
+    future = servo.LgpioServo(0, 23, fallback=fallback).move(1400, 0.05, blocking=False,
+                                                             callback=lambda: done.append(True))
+    future.result(5)
+    assert done == [True]
+    assert fallback.timing(1400)["pulses"] > 0
+
+
+def test_moves_run_in_request_order():
+    driver = GatedServo()
+    futures = [driver.move(pulse_us, blocking=False) for pulse_us in (1400, 500, 1400, 500, 1400)]
+    driver.gate.set()
+    for future in futures:
+        future.result(5)
+    assert driver.pulses == [1400, 500, 1400, 500, 1400]
+
+
+def test_flap_state_changes_when_move_completes(monkeypatch):
+    hw = hw_code.BriefkastenHW()
+    driver = GatedServo()
+    monkeypatch.setattr(hw, "servo", driver, raising=False)
+    monkeypatch.setattr(hw, "open", False)
+    hw.servo_open(blocking=False)
+    future = hw.servo_close(blocking=False)
+    last = hw.servo_open(blocking=False)
+    assert hw.open is False
+    driver.gate.set()
+    future.result(5)
+    last.result(5)
+    assert hw.open is True
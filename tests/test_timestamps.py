@@ -0,0 +1,16 @@
+import math
+
+import pytest
+
+import database_handler
+
+
+@pytest.mark.parametrize("value", [10 ** 18, -10 ** 18, 1e400, math.inf, -math.inf, math.nan])
+def test_to_epoch_ms_rejects_unrepresentable_values(value):
+    with pytest.raises(ValueError):
+        database_handler.to_epoch_ms(value)
+
+
+def test_letter_row_round_trips_valid_values():
+    assert database_handler.letter_row("S1", 1_700_000_000_000) == ("S1", "2023-11-14T22:13:20.000Z", 1_700_000_000_000)
+    assert database_handler.letter_row("S1", "2023-11-14T22:13:20Z")[2] == 1_700_000_000_000
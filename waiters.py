@@ -0,0 +1,163 @@
+"""
+Per-device wait registry for long-poll and SSE requests.
+
+A request waits on the condition of its device key until a command is
+available (or the timeout expires); the route that sets the command calls
+notify() for that key. Conditions are created on demand and dropped when
+the last waiter leaves, so idle devices cost nothing.
+
+Threads (Flask) block in wait(); asyncio tasks (asgi_api) await
+wait_async() and are woken through their event loop, so one registry
+serves both servers.
+
+notify() only reaches waiters in the same process. When the command may be
+set by another worker (shared state backend), pass poll_interval: waiters
+then also re-check consume() that often. If consume() does blocking I/O
+(the SQLite backend), pass an executor to wait_async() so it runs there
+instead of on the event loop.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Entry:
+    __slots__ = ("condition", "waiters", "events")
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.waiters = 0
+        self.events: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+
+class WaitRegistry:
+    """
+    Map of device key -> threading.Condition (plus asyncio events).
+    """
+
+    def __init__(self, poll_interval: Optional[float] = None) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+        self.poll_interval = poll_interval
+
+    def _enter(self, key: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.waiters += 1
+            return entry
+
+    def _leave(self, key: str, entry: _Entry) -> None:
+        with self._lock:
+            entry.waiters -= 1
+            if entry.waiters == 0 and self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def wait(self, key: str, consume: Callable[[], T], timeout: float) -> T:
+        """
+        Block until consume() returns a truthy value or timeout seconds pass.
+        consume() is called under the device condition, so a notify() issued
+        after the command was stored can never be missed.
+        Returns the last value of consume().
+        """
+        entry = self._enter(key)
+        result = None
+
+        def ready() -> T:
+            nonlocal result
+            result = consume()
+            return result
+
+        try:
+            with entry.condition:
+                if self.poll_interval is None:
+                    entry.condition.wait_for(ready, timeout)
+                    return result
+                deadline = time.monotonic() + timeout
+                while not ready():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    entry.condition.wait(min(remaining, self.poll_interval))
+            return result
+        finally:
+            self._leave(key, entry)
+
+    async def wait_async(self, key: str, consume: Callable[[], T], timeout: float,
+                         executor: Optional[Executor] = None) -> T:
+        """
+        Like wait(), but awaits without holding a thread.
+        The event is registered before consume() runs, so no notify() is missed.
+        With an executor, consume() runs there (for blocking consume functions);
+        otherwise directly on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        entry = self._enter(key)
+
+        async def check() -> T:
+            if executor is None:
+                return consume()
+            return await loop.run_in_executor(executor, consume)
+
+        try:
+            while True:
+                waiter = (loop, asyncio.Event())
+                with self._lock:
+                    entry.events.add(waiter)
+                try:
+                    result = await check()
+                    remaining = deadline - loop.time()
+                    if result or remaining <= 0:
+                        return result
+                    if self.poll_interval is not None:
+                        remaining = min(remaining, self.poll_interval)
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), remaining)
+                    except asyncio.TimeoutError:
+                        if loop.time() >= deadline:
+                            return await check()
+                finally:
+                    with self._lock:
+                        entry.events.discard(waiter)
+        finally:
+            self._leave(key, entry)
+
+    def _wake(self, entry: _Entry) -> None:
+        with entry.condition:
+            entry.condition.notify_all()
+        with self._lock:
+            events = list(entry.events)
+        for loop, event in events:
+            loop.call_soon_threadsafe(event.set)
+
+    def notify(self, key: str) -> None:
+        """
+        Wake all requests waiting for the given device.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            self._wake(entry)
+
+    def notify_all(self) -> None:
+        """
+        Wake every waiting request (all devices).
+        """
+        with self._lock:
+            entries: List[_Entry] = list(self._entries.values())
+        for entry in entries:
+            self._wake(entry)
+
+    def waiting(self) -> int:
+        """
+        Number of requests currently waiting (threads and tasks).
+        """
+        with self._lock:
+            return sum(e.waiters for e in self._entries.values())